@@ -4,9 +4,15 @@ import tempfile
 import hashlib
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 from src.triage_utils import create_triage_retriever, create_triage_agent, severity_to_color
-from src.emergency_utils import create_emergency_retriever, create_emergency_agent
-from streamlit_js_eval import get_geolocation
+from src.emergency_utils import create_emergency_retriever, create_emergency_agent, model_router
+from src.index_bundle import IndexBundleError
+from src.docstore_engine import ShardedSearchEngine
+from src.streaming import stream_emergency_answer
+from src.speculation import SPECULATIVE_PREFETCH, EmergencyPrefetch
+from src.tracing import TRACE_PROMETHEUS_PATH, tracer
+from src.translation import same_language
 import time
+import asyncio
 
 
 st.set_page_config(page_title="llama-first-aid", page_icon="presentation/logo/logo.png", layout="wide", initial_sidebar_state="expanded")
@@ -14,11 +20,16 @@ st.set_page_config(page_title="llama-first-aid", page_icon="presentation/logo/lo
 STORE_SESSIONS_DATA_LOCALLY = False
 STORE_SESSIONS_DATA_GCS = False
 
-app_version = generate_app_id(
-    github_repo="Amatofrancesco99/llama-first-aid",
-    last_commit_file="data/app_version/last_commit.txt",
-    version_file="data/app_version/version.txt"
-)
+# La versione interroga GitHub: una volta per processo, non a ogni rerun dello script
+@st.cache_resource
+def load_app_version():
+    return generate_app_id(
+        github_repo="Amatofrancesco99/llama-first-aid",
+        last_commit_file="data/app_version/last_commit.txt",
+        version_file="data/app_version/version.txt"
+    )
+
+app_version = load_app_version()
 print(f"App version: {app_version}")
 
 
@@ -31,6 +42,8 @@ else:
 
 
 if st.sidebar.checkbox("Use my current location", value=False):
+    # Il componente di geolocalizzazione si carica solo se l'utente lo attiva
+    from streamlit_js_eval import get_geolocation
     with st.spinner("Searching for location..."):
         user_location_info = None
         while user_location_info is None:
@@ -50,8 +63,7 @@ YOUTUBE_API_KEY = st.secrets["YOUTUBE"]["YOUTUBE_API_KEY"]
 GOOGLE_MAPS_API_KEY = st.secrets["GOOGLE_MAPS"]["GOOGLE_MAPS_API_KEY"]
 llm_text_model_name = "llama3-70b-8192"
 llm_audio_model_name = "whisper-large-v3"
-file_path_triage = "data/doc_triage/pdf/Manuale-Triage.pdf"
-file_path_emergency = "data/doc_emergency/pdf/manuale_primo_soccorso.pdf"
+index_bundle_root = "data/index_bundle"
 prompt_emergency_file_path = "src/templates/emergency_prompt.jinja"
 prompt_everyday_file_path = "src/templates/everyday_prompt.jinja"
 prompt_emergency = load_template(prompt_emergency_file_path)
@@ -62,13 +74,18 @@ triage_agent=None
 
 # Funzione per creare il retriever
 @st.cache_resource
-def load_triage_retriever(file_path, bm25_path, faiss_path):
-    return create_triage_retriever(file_path, bm25_path, faiss_path)
+def load_triage_retriever(bundle_root):
+    return create_triage_retriever(bundle_root)
 
 # Funzione per creare il retriever
 @st.cache_resource
-def load_emergency_retriever(file_path, bm25_path, faiss_path):
-    return create_emergency_retriever(file_path, bm25_path, faiss_path)
+def load_emergency_retriever(bundle_root):
+    return create_emergency_retriever(bundle_root)
+
+# Motore a shard sui docstore (triage, emergency, everyday) per le situazioni non gravi
+@st.cache_resource
+def load_docstore_engine(bundle_root):
+    return ShardedSearchEngine(bundle_root)
 
 # Funzione per creare l'triage_agente
 @st.cache_resource
@@ -80,8 +97,13 @@ def load_emergency_agent():
     return create_emergency_agent()
 
 
-ensemble_retriever_triage = load_triage_retriever(file_path_triage, bm25_path="data/bm_25/bm25_triage_index.pkl", faiss_path="data/faiss/faiss_triage_index")
-ensemble_retriever_emergency = load_emergency_retriever(file_path_emergency, bm25_path="data/bm_25/bm25_emergency_index.pkl", faiss_path="data/faiss/faiss_emergency_index")
+try:
+    ensemble_retriever_triage = load_triage_retriever(index_bundle_root)
+    ensemble_retriever_emergency = load_emergency_retriever(index_bundle_root)
+    docstore_engine = load_docstore_engine(index_bundle_root)
+except IndexBundleError as e:
+    st.error(f"Retrieval index bundle not available: {e}")
+    st.stop()
 triage_agent = load_triage_agent()
 emergency_agent = load_emergency_agent()
 
@@ -109,12 +131,10 @@ def main():
     audio_value = st.audio_input("Speak with your assistant (optional)" if language != "it" else "Parla col tuo assistente (opzionale)")
 
     # Default parameters values
-    severity, hospital_name, google_maps_link, video_title, youtube_link = None, None, None, None, None
+    severity, hospital_name, google_maps_link, video_title, youtube_link, medical_class = None, None, None, None, None, None
 
     if (query or (query and image_base64)) or (audio_value or (audio_value and image_base64)):
 
-        translated_query, source_language = translate(llm=llm, llm_model_name=llm_text_model_name, message=query, target_language="English")
-
         trscb_message_template = load_template("src/templates/trscb_message_template.jinja")
         trscb_message = trscb_message_template.render()
         
@@ -122,6 +142,9 @@ def main():
             with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio_file:
                 temp_audio_path = save_uploaded_audio(audio_value.getvalue(), temp_audio_file.name)
             query = transcribe_audio(llm, llm_audio_model_name, temp_audio_path, trscb_message, language)
+
+        # Si traduce dopo l'eventuale trascrizione, così anche i messaggi vocali arrivano tradotti
+        translated_query, source_language = translate(llm=llm, llm_model_name=llm_text_model_name, message=query, target_language="English")
             
         if "chat_history" not in st.session_state:
             st.session_state.chat_history = [HumanMessage(content=query)]
@@ -146,17 +169,33 @@ def main():
                 with st.chat_message(role):
                     st.markdown(message.content)
             
+        # Il lavoro del ramo di emergenza parte mentre il triage decide: ospedale subito, il resto dal riassunto
+        prefetch = None
+        if SPECULATIVE_PREFETCH:
+            if "emergency_prefetch" not in st.session_state:
+                st.session_state.emergency_prefetch = EmergencyPrefetch(user_location, GOOGLE_MAPS_API_KEY,
+                                                                        ensemble_retriever_emergency)
+            prefetch = st.session_state.emergency_prefetch
+            prefetch.start_hospital()
+
         with st.spinner("Assessing emergency severity" if language != "it" else "Sto pensando per capire la gravità della situazione..."):
             # Call the LLM with the Jinja prompt and DataFrame context
             with st.chat_message("assistant"):
+                # Il triage riceve solo il nuovo messaggio e il riassunto dei turni precedenti
                 input = {
-                    "messages": st.session_state.chat_history_translated,
+                    "messages": st.session_state.chat_history_translated[-1:],
+                    "summary": st.session_state.get("triage_summary", ""),
+                    "last_question": st.session_state.get("triage_last_question", ""),
                     "ensemble_retriever_triage": ensemble_retriever_triage,
-                    "questions" : []
+                    "questions" : [],
+                    "on_field": prefetch.on_triage_field if prefetch else None
                 }
                 start_time = time.time()
-                output = triage_agent.invoke(input)
+                # I nodi sono asincroni: le chiamate LLM passano dal pool condiviso del processo
+                with tracer.span("triage_agent", "graph"):
+                    output = asyncio.run(triage_agent.ainvoke(input))
                 end_time = time.time()
+                st.session_state.triage_summary = output.get('summary', "")
                 severity = output.get('severity', None)
                 severity = int(severity) if severity is not None else None
                 if severity:
@@ -169,8 +208,14 @@ def main():
                     )
                     response = severity
                     triage_agent_output = output['full_query']
+                    # La domanda del triage ha avuto risposta: il prossimo messaggio non va letto come risposta a essa
+                    st.session_state.triage_last_question = ""
                 else:
                     response = output['questions'][-1].content
+                    st.session_state.triage_last_question = response
+                    if prefetch:
+                        # Il riassunto cambierà al prossimo turno: il lavoro basato su questo non serve più
+                        prefetch.park()
                     response, _ = translate(llm=llm, llm_model_name=llm_text_model_name, message=response, target_language=source_language)
                     st.markdown(response, unsafe_allow_html=True)    
                 st.session_state.chat_history.extend([AIMessage(content=str(response))])
@@ -192,36 +237,72 @@ def main():
                         "retry_count_youtube": 0,
                         "retry_count_web_search": 0, 
                         "user_location" : user_location,
-                        "ensemble_retriever" : ensemble_retriever_emergency,
+                        "ensemble_retriever" : ensemble_retriever_emergency if severity > 2 else docstore_engine.retriever_for_severity(severity),
                         "youtube_api_key": YOUTUBE_API_KEY,
-                        "google_maps_api_key": GOOGLE_MAPS_API_KEY
+                        "google_maps_api_key": GOOGLE_MAPS_API_KEY,
+                        "prefetch": prefetch
                     }
-                    start_time = time.time()
-                    response, google_maps_link, hospital_name, youtube_link, video_title = emergency_agent.invoke(input)['final_result']
-                    end_time = time.time()
+                    # Segnaposto in ordine di visualizzazione: la risposta resta in alto anche se le card arrivano prima
+                    answer_placeholder = st.empty()
+                    hospital_placeholder = st.empty()
+                    video_placeholder = st.empty()
 
-                    # Initialize an empty string to store the full response as it is built
-                    response, _ = translate(llm=llm, llm_model_name=llm_text_model_name, message=response, target_language=source_language)
-                    st.markdown(response.replace("\\n", "\n"), unsafe_allow_html=True)
+                    def show_answer(text):
+                        answer_placeholder.markdown(text.replace("\\n", "\n"), unsafe_allow_html=True)
 
-                    if severity > 2:
+                    def show_hospital(hospital_name, google_maps_link):
+                        # Il ramo dell'ospedale gira con severità alta o con segnali d'allarme dall'analisi
                         # Mostra il link di Google Maps
-                        st.markdown(f"### Nearest hospital: **{hospital_name}**" if language != "it" else f"### Ospedale più vicino: **{hospital_name}**")
-                        st.markdown(f"[Google Maps]({google_maps_link})")
+                        hospital_placeholder.markdown(
+                            (f"### Nearest hospital: **{hospital_name}**" if language != "it" else f"### Ospedale più vicino: **{hospital_name}**")
+                            + f"\n\n[Google Maps]({google_maps_link})"
+                        )
 
-                    if video_title:
+                    def show_video(video_title, youtube_link):
                         # Mostra il video di YouTube
-                        st.markdown(f"## YouTube Video:" if language != "it" else f"## Video YouTube:")
-                        st.markdown(f"### {video_title}:")
-                    st.session_state.chat_history.extend([{"role": "assistant", "content": response}])
-
-                    if 'https' in youtube_link:
                         video_url = youtube_link.replace("watch?v=", "embed/")
                         youtube_embed = f'<iframe width="560" height="315" src="{video_url}" frameborder="0" allow="accelerometer; autoplay; encrypted-media; gyroscope; picture-in-picture" allowfullscreen></iframe>'
-                        st.markdown(f"<br>{youtube_embed}", unsafe_allow_html=True)
+                        video_placeholder.markdown(
+                            (f"## YouTube Video:" if language != "it" else f"## Video YouTube:")
+                            + f"\n### {video_title}:\n<br>{youtube_embed}",
+                            unsafe_allow_html=True
+                        )
+
+                    pending_placeholders = {"hospital": hospital_placeholder, "youtube": video_placeholder}
+
+                    def show_pending(branches):
+                        # Rami oltre il proprio budget: la risposta è completa, il resto arriva se fa in tempo
+                        for branch in branches:
+                            pending_placeholders[branch].caption(
+                                ("Still searching for the nearest hospital..." if language != "it" else "Sto ancora cercando l'ospedale più vicino...")
+                                if branch == "hospital" else
+                                ("Still searching for a video..." if language != "it" else "Sto ancora cercando un video...")
+                            )
+
+                    # La risposta viene tradotta a blocchi di frasi mentre il modello la genera
+                    translate_segment = None if same_language(source_language, "English") else (
+                        lambda text: translate(llm=llm, llm_model_name=llm_text_model_name, message=text, target_language=source_language)[0]
+                    )
+                    start_time = time.time()
+                    with tracer.span("emergency_agent", "graph", severity=severity):
+                        response, final_result, emergency_metrics = asyncio.run(stream_emergency_answer(
+                            emergency_agent, input, translate_fn=translate_segment,
+                            on_answer=show_answer, on_hospital=show_hospital, on_video=show_video,
+                            on_pending=show_pending
+                        ))
+                    end_time = time.time()
+                    # Rami segnalati in attesa e mai arrivati: si toglie il messaggio di attesa
+                    for branch in set(emergency_metrics["pending"]) & set(emergency_metrics["missing"]):
+                        pending_placeholders[branch].empty()
+                    _, google_maps_link, hospital_name, youtube_link, video_title, medical_class = final_result
+                    st.session_state.chat_history.extend([{"role": "assistant", "content": response}])
                 st.session_state.chat_history.extend([AIMessage(content=str(response))])
         
 
+        # Istogrammi di latenza per nodo e chiamata esterna, per il textfile collector di Prometheus
+        if TRACE_PROMETHEUS_PATH:
+            tracer.write_prometheus(TRACE_PROMETHEUS_PATH)
+
         # Save session data either locally or to GCS, if enabled
         if STORE_SESSIONS_DATA_LOCALLY or STORE_SESSIONS_DATA_GCS:
             response_time = end_time - start_time
@@ -233,7 +314,8 @@ def main():
                 session_id=session_id, app_version=app_version,
                 user_location=user_location,
                 country=country, 
-                medical_class=get_medical_class(llm=llm, llm_model_name=llm_text_model_name, chat_history=st.session_state.chat_history), 
+                # Con il grafo di emergenza la specialità arriva dall'analisi della situazione, senza un'altra chiamata
+                medical_class=medical_class if severity else get_medical_class(llm=llm, llm_model_name=llm_text_model_name, chat_history=st.session_state.chat_history, router=model_router), 
                 severity=severity,
                 hospital_details=[hospital_name, google_maps_link],
                 youtube_video_details=[video_title, youtube_link],
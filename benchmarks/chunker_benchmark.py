@@ -0,0 +1,130 @@
+"""
+Benchmark del chunker del manuale di emergenza: versione precedente (riportata qui come riferimento)
+contro chunk_emergency_pages, sulle stesse pagine estratte dal manuale incluso nel repository.
+
+Uso:
+    python -m benchmarks.chunker_benchmark [--repeat 20] [--scale 1]
+
+Con --scale N le pagine vengono replicate N volte, per simulare manuali più lunghi.
+"""
+import argparse
+import re
+import time
+
+from langchain_core.documents import Document
+
+from src.emergency_utils import chunk_emergency_pages
+from src.ingestion import stream_pdf_documents
+
+
+PDF_PATH = "data/doc_emergency/pdf/manuale_primo_soccorso.pdf"
+
+
+def reference_chunk_emergency_pages(pages):
+    # Implementazione precedente di process_pdf_emergency, a partire dalle pagine già estratte
+    full_text = "\n".join([doc.page_content for doc in pages])
+    full_text = full_text.replace("MANUALE PER GLI INCARICATI DI PRIMO SOCCORSO", "")
+    full_text = full_text.replace("LE POSIZIONI DI SICUREZZA", "")
+    full_text = full_text.replace("APPARATO VISIVO", "")
+    full_text = full_text.replace("APPARATO UDITIVO", "")
+    full_text = full_text.replace("SISTEMA NERVOSO - anatomia", "")
+    full_text = full_text.replace("IL SISTEMA NERVOSO\n", "")
+    full_text = full_text.replace("-\n", "")
+    main_title_pattern = r'(?:\n|^)([A-Z\s\’\’]+(?:\n[A-Z\s\’\’]+)*)\n'
+    sub_section_pattern = r'(?:^|\n)([a-z]\))'
+    degree_section_pattern = r'(?:^|\n)([IV]+\s+GRADO)'
+
+    page_number_map = []
+    for page in pages:
+        page_number_map.append({"text": page.page_content, "page_number": page.metadata["page"]})
+
+    matches = list(re.finditer(main_title_pattern, full_text))
+    documents = []
+    current_content = ""
+    current_title = None
+    current_page = None
+
+    for i in range(len(matches)):
+        title_start = matches[i].start()
+        title_end = matches[i].end()
+        title = full_text[title_start:title_end].strip()
+
+        if i + 1 < len(matches):
+            content_start = title_end
+            content_end = matches[i + 1].start()
+            content = full_text[content_start:content_end].strip()
+        else:
+            content = full_text[title_end:].strip()
+
+        if current_page is None:
+            for page in page_number_map:
+                if title in page["text"]:
+                    current_page = page["page_number"]
+                    break
+
+        content_lines = content.split("\n")
+        organized_content = []
+        current_subsection = None
+
+        for line in content_lines:
+            if re.match(sub_section_pattern, line):
+                current_subsection = line
+                organized_content.append(f"\n{line}")
+            elif re.match(degree_section_pattern, line):
+                current_subsection = line
+                organized_content.append(f"\n{line}")
+            elif current_subsection:
+                organized_content[-1] += f" {line.strip()}"
+            else:
+                organized_content.append(line.strip())
+
+        content = "\n".join(organized_content)
+
+        if current_title:
+            documents.append({"title": current_title, "page_content": current_content, "page_nr": current_page})
+
+        current_title = title
+        current_content = content
+        current_page = None
+
+    if current_title:
+        documents.append({"title": current_title, "page_content": current_content, "page_nr": current_page})
+
+    return [
+        Document(page_content=doc["page_content"], metadata={"title": doc["title"], "page_nr": doc["page_nr"]})
+        for doc in documents
+    ]
+
+
+def best_time(fn, pages, repeat):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = fn(pages)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the emergency manual chunker.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--scale", type=int, default=1, help="Replicate the manual pages N times")
+    args = parser.parse_args()
+
+    pages = list(stream_pdf_documents(PDF_PATH, start=40))
+    pages = [
+        Document(page_content=page.page_content, metadata={"page": page.metadata["page"] + copy * len(pages)})
+        for copy in range(args.scale) for page in pages
+    ]
+    reference_time, reference_docs = best_time(reference_chunk_emergency_pages, pages, args.repeat)
+    new_time, new_docs = best_time(chunk_emergency_pages, pages, args.repeat)
+
+    identical = [(d.page_content, d.metadata) for d in reference_docs] == [(d.page_content, d.metadata) for d in new_docs]
+    print(f"pages: {len(pages)}, documents: {len(new_docs)}, identical output: {identical}")
+    print(f"reference chunker: {reference_time * 1000:.2f} ms")
+    print(f"chunk_emergency_pages: {new_time * 1000:.2f} ms")
+    print(f"speed-up: {reference_time / new_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
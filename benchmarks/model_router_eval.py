@@ -0,0 +1,172 @@
+"""
+Valutazione offline del model router sui nodi assegnati al modello piccolo, usando le domande
+di esempio in data/questions_samples.
+
+Uso:
+    python -m benchmarks.model_router_eval [--limit 20] [--titles 6] [--output benchmarks/results/model_router.json]
+
+Ogni nodo viene eseguito in tre varianti: tutto sul livello grande (riferimento), tutto sul livello
+piccolo, e con la configurazione di src/model_routing.json (livello piccolo con escalation).
+Per ogni nodo si riportano l'accordo con il riferimento (Jaccard sulle keyword, uguaglianza esatta
+per il video scelto e la specialità, media dei campi per l'analisi della situazione), gli output non validi, il tasso di escalation e il risparmio di latenza.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.retrieval_benchmark import _git_commit, load_questions
+
+
+# Titoli plausibili dei canali consentiti: per ogni domanda si classificano insieme i primi --titles
+VIDEO_TITLES = [
+    "First Aid for Bee Stings",
+    "How to Treat a Burn - First Aid Training",
+    "Emergency Care for Cuts",
+    "CPR and Choking - Adult",
+    "How to Treat Seasonal Allergies",
+    "First Aid - Heart Attack",
+]
+VARIANTS = ["large", "small", "routed"]
+
+
+def keyword_set(keywords) -> set:
+    if not isinstance(keywords, str):
+        return set()
+    return {word for part in keywords.lower().split(",") for word in part.split() if word}
+
+
+def jaccard(first: set, second: set) -> float:
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+async def _timed(coro):
+    start_time = time.perf_counter()
+    try:
+        result = await coro
+    except Exception as e:
+        return {"error": str(e), "latency_s": time.perf_counter() - start_time}
+    return {"output": result, "latency_s": time.perf_counter() - start_time}
+
+
+async def run_variant(router, questions: list, n_titles: int) -> dict:
+    """Esegue i nodi del livello piccolo con il router indicato; output e latenze per nodo e domanda."""
+    import src.emergency_utils as emergency_utils
+    from src.llm_client import get_sync_client
+    from src.utils import get_medical_class
+
+    # I nodi leggono il router a livello di modulo
+    emergency_utils.model_router = router
+    llm = get_sync_client(router.api_key)
+    outputs = {"analyze_query": [], "extract_keywords_youtube": [], "extract_keywords_web_search": [], "video_ranking": [],
+               "get_medical_class": []}
+    for question in questions:
+        query = question["text"]
+        outputs["analyze_query"].append(await _timed(emergency_utils.analyze_query({"full_query": query})))
+        result = await _timed(emergency_utils.extract_keywords_youtube({"full_query": query, "retry_count_youtube": 0}))
+        result["output"] = result.get("output", {}).get("keywords_youtube")
+        outputs["extract_keywords_youtube"].append(result)
+        result = await _timed(emergency_utils.extract_keywords_web_search({"full_query": query, "retry_count_web_search": 0}))
+        result["output"] = result.get("output", {}).get("web_search_keywords")
+        outputs["extract_keywords_web_search"].append(result)
+        result = await _timed(emergency_utils.rank_videos(query, VIDEO_TITLES[:n_titles]))
+        # Si confronta il video che il nodo sceglierebbe
+        ranking = result.get("output", ([], False))[0]
+        result["output"] = ranking[0] if ranking else None
+        outputs["video_ranking"].append(result)
+        chat_history = [{"role": "user", "content": query}]
+        outputs["get_medical_class"].append(await _timed(asyncio.to_thread(
+            get_medical_class, llm=llm, llm_model_name=router.model_name("get_medical_class"),
+            chat_history=chat_history, router=router,
+        )))
+        print(f"{router.force_tier or 'routed'}: {query[:60]}")
+    return outputs
+
+
+def compare(node: str, reference: list, candidate: list) -> dict:
+    agreement = []
+    for expected, actual in zip(reference, candidate):
+        if "error" in expected or "error" in actual:
+            continue
+        if node.startswith("extract_keywords"):
+            agreement.append(jaccard(keyword_set(expected["output"]), keyword_set(actual["output"])))
+        elif node == "analyze_query":
+            # Media tra i campi: keyword per sovrapposizione, specialità e segnali d'allarme per uguaglianza
+            agreement.append(np.mean([
+                jaccard(keyword_set(expected["output"][field]), keyword_set(actual["output"][field]))
+                for field in ("keywords_youtube", "web_search_keywords")
+            ] + [float(expected["output"][field] == actual["output"][field]) for field in ("medical_class", "red_flag")]))
+        else:
+            agreement.append(float(expected["output"] == actual["output"]))
+    return {
+        "agreement": float(np.mean(agreement)) if agreement else None,
+        "compared": len(agreement),
+        "invalid": sum("error" in result for result in candidate),
+    }
+
+
+def latency_summary(results: list) -> dict:
+    latencies = np.asarray([result["latency_s"] for result in results]) * 1000
+    if not len(latencies):
+        return {"p50": None, "p95": None, "total_s": 0.0}
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return {"p50": float(p50), "p95": float(p95), "total_s": float(latencies.sum() / 1000)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare small, large and routed models on the cheap graph nodes.")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate only the first N sample questions")
+    parser.add_argument("--titles", type=int, default=len(VIDEO_TITLES), help="Candidate video titles ranked per question")
+    parser.add_argument("--output", default=f"benchmarks/results/model_router-{datetime.now():%Y%m%d-%H%M%S}.json")
+    args = parser.parse_args()
+
+    from src.emergency_utils import model_router
+    from src.model_router import ModelRouter
+
+    questions = load_questions()[:args.limit]
+    routers = {
+        "large": ModelRouter(model_router.api_key, routing=model_router.routing, force_tier=model_router.routing["escalation_tier"]),
+        "small": ModelRouter(model_router.api_key, routing=model_router.routing, force_tier="small"),
+        "routed": ModelRouter(model_router.api_key, routing=model_router.routing),
+    }
+    outputs = {variant: asyncio.run(run_variant(routers[variant], questions, args.titles)) for variant in VARIANTS}
+
+    results = {}
+    for node, reference in outputs["large"].items():
+        results[node] = {"large": {"latency_ms": latency_summary(reference),
+                                   "invalid": sum("error" in result for result in reference)}}
+        for variant in ("small", "routed"):
+            summary = compare(node, reference, outputs[variant][node])
+            summary["latency_ms"] = latency_summary(outputs[variant][node])
+            reference_total = results[node]["large"]["latency_ms"]["total_s"]
+            summary["latency_saving"] = (1 - summary["latency_ms"]["total_s"] / reference_total) if reference_total else None
+            results[node][variant] = summary
+        routed_stats = routers["routed"].stats().get(node, {})
+        calls = len(outputs["routed"][node])
+        results[node]["routed"]["escalation_rate"] = routed_stats.get("escalations", 0) / calls if calls else None
+        routed = results[node]["routed"]
+        print(f"{node}: agreement small {results[node]['small']['agreement']}, routed {routed['agreement']}, "
+              f"escalations {routed['escalation_rate']}, latency saving {routed['latency_saving']}")
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "questions": len(questions),
+        "video_titles": VIDEO_TITLES[:args.titles],
+        "tiers": model_router.routing["tiers"],
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Benchmark end-to-end della pipeline triage → emergenza sulle domande di esempio, offline.
+
+Uso:
+    python -m benchmarks.pipeline_benchmark [--limit 10] [--concurrency 4] [--latency-ms 300] [--tokens-per-s 250]
+                                            [--error-rate 0.0] [--no-prefetch] [--translate-to Italian]
+                                            [--output benchmarks/results/pipeline.json]
+                                            [--prometheus benchmarks/results/pipeline.prom]
+
+Se STANDIN_SERVER_URL non è impostata, il server sostitutivo di benchmarks/standin_server.py viene
+avviato in questo processo con la configurazione indicata; altrimenti si usa quello già in esecuzione.
+Ogni sessione ripete il triage finché non si ottiene un punteggio (rispondendo alle domande con
+FOLLOW_UP_ANSWER), poi esegue il grafo di emergenza in streaming come l'app, con il lavoro speculativo
+di src.speculation avviato durante il triage (disattivabile con --no-prefetch). Le sessioni girano
+in parallelo fino a --concurrency. Con --translate-to la risposta viene tradotta nella lingua indicata
+come per un utente che non scrive in inglese (tempo alla prima istruzione tradotta e numero di
+chiamate di traduzione nel report). I segreti vengono letti da .streamlit/secrets.toml come nell'app.
+
+Il report include il riepilogo degli span di src.tracing (nodi, chiamate LLM/HTTP, retrieval); con
+--prometheus gli stessi istogrammi vengono scritti anche in formato testo Prometheus.
+
+Le chiamate LLM rispettano la quota di src/rate_limits.json come in produzione; per simulare un'altra
+quota (o nessuna) si indica con LLM_RATE_LIMITS_PATH un file con i limiti.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import time
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.retrieval_benchmark import _git_commit, load_questions
+from benchmarks.standin_server import add_config_arguments, config_from_args, start_server
+from src.tracing import tracer
+
+
+FOLLOW_UP_ANSWER = "Yes, the person is conscious and breathing normally."
+MAX_TRIAGE_TURNS = 3
+# Posizione fissa per la ricerca dell'ospedale (Roma)
+USER_LOCATION = (41.9028, 12.4964)
+
+
+def load_pipeline(bundle_root: str) -> dict:
+    """Retriever, grafi e prompt come in app.py."""
+    import streamlit as st
+    from src.docstore_engine import ShardedSearchEngine
+    from src.emergency_utils import create_emergency_agent, create_emergency_retriever
+    from src.triage_utils import create_triage_agent, create_triage_retriever
+    from src.utils import load_template
+
+    return {
+        "triage_retriever": create_triage_retriever(bundle_root),
+        "emergency_retriever": create_emergency_retriever(bundle_root),
+        "docstore_engine": ShardedSearchEngine(bundle_root),
+        "triage_agent": create_triage_agent(),
+        "emergency_agent": create_emergency_agent(),
+        "prompt_emergency": load_template("src/templates/emergency_prompt.jinja"),
+        "prompt_everyday": load_template("src/templates/everyday_prompt.jinja"),
+        "youtube_api_key": st.secrets["YOUTUBE"]["YOUTUBE_API_KEY"],
+        "google_maps_api_key": st.secrets["GOOGLE_MAPS"]["GOOGLE_MAPS_API_KEY"],
+    }
+
+
+def translate_fn(target_language: str):
+    """Traduttore dei segmenti della risposta come in app.py."""
+    import streamlit as st
+    from src.utils import init_LLM, translate
+    llm = init_LLM(API_KEY=st.secrets["GROQ"]["GROQ_API_KEY"])
+    return lambda text: translate(llm=llm, llm_model_name="llama3-70b-8192", message=text, target_language=target_language)[0]
+
+
+async def run_session(pipeline: dict, query: str, prefetch_enabled: bool = True, target_language: str = None) -> dict:
+    from langchain_core.messages import HumanMessage
+    from src.speculation import EmergencyPrefetch
+    from src.streaming import stream_emergency_answer
+
+    start_time = time.perf_counter()
+    metrics = {"triage_turns": 0}
+    summary, last_question, message, severity = "", "", query, None
+    prefetch = EmergencyPrefetch(USER_LOCATION, pipeline["google_maps_api_key"], pipeline["emergency_retriever"]) \
+        if prefetch_enabled else None
+    try:
+        if prefetch:
+            prefetch.start_hospital()
+        while severity is None and metrics["triage_turns"] < MAX_TRIAGE_TURNS:
+            metrics["triage_turns"] += 1
+            output = await pipeline["triage_agent"].ainvoke({
+                "messages": [HumanMessage(content=message)],
+                "summary": summary,
+                "last_question": last_question,
+                "ensemble_retriever_triage": pipeline["triage_retriever"],
+                "questions": [],
+                "on_field": prefetch.on_triage_field if prefetch else None,
+            })
+            summary = output.get("summary", "")
+            if output.get("severity") is not None:
+                severity = int(output["severity"])
+            else:
+                last_question, message = output["questions"][-1].content, FOLLOW_UP_ANSWER
+                if prefetch:
+                    prefetch.park()
+        metrics["triage_s"] = time.perf_counter() - start_time
+        metrics["severity"] = severity
+        if severity is None:
+            raise ValueError(f"No severity after {MAX_TRIAGE_TURNS} triage turns")
+
+        emergency_input = {
+            "full_query": summary,
+            "prompt": pipeline["prompt_emergency"] if severity > 2 else pipeline["prompt_everyday"],
+            "severity": severity,
+            "history": [],
+            "retry_count_youtube": 0,
+            "retry_count_web_search": 0,
+            "user_location": USER_LOCATION,
+            "ensemble_retriever": pipeline["emergency_retriever"] if severity > 2
+                                  else pipeline["docstore_engine"].retriever_for_severity(severity),
+            "youtube_api_key": pipeline["youtube_api_key"],
+            "google_maps_api_key": pipeline["google_maps_api_key"],
+            "prefetch": prefetch,
+        }
+        _, final_result, emergency_metrics = await stream_emergency_answer(
+            pipeline["emergency_agent"], emergency_input,
+            translate_fn=translate_fn(target_language) if target_language else None)
+        metrics.update({f"emergency_{key}": value for key, value in emergency_metrics.items()})
+        metrics["has_video"] = bool(final_result and final_result[3] and "https" in final_result[3])
+    except Exception as e:
+        metrics["error"] = f"{type(e).__name__}: {e}"
+    if prefetch:
+        metrics["prefetch"] = dict(prefetch.stats)
+    metrics["total_s"] = time.perf_counter() - start_time
+    return metrics
+
+
+async def run_sessions(pipeline: dict, questions: list, concurrency: int, prefetch_enabled: bool = True,
+                       target_language: str = None) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(question):
+        async with semaphore:
+            return await run_session(pipeline, question["text"], prefetch_enabled, target_language)
+
+    start_time = time.perf_counter()
+    sessions = await asyncio.gather(*(limited(question) for question in questions))
+    return sessions, time.perf_counter() - start_time
+
+
+def llm_client_stats() -> dict:
+    import streamlit as st
+    from src.llm_client import get_llm_pool
+    return get_llm_pool(st.secrets["GROQ"]["GROQ_API_KEY"]).stats()
+
+
+def summarize(values: list) -> dict:
+    values = np.asarray([value for value in values if value is not None], dtype=float)
+    if not len(values):
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(values.max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the triage and emergency pipeline end to end offline.")
+    parser.add_argument("--limit", type=int, default=None, help="Run only the first N sample questions")
+    parser.add_argument("--concurrency", type=int, default=1, help="Sessions running at the same time")
+    parser.add_argument("--bundle-root", default="data/index_bundle")
+    parser.add_argument("--prometheus", default=None, help="Also write the span histograms in Prometheus text format")
+    parser.add_argument("--no-prefetch", action="store_true",
+                        help="Do not start emergency-branch work while triage is running")
+    parser.add_argument("--translate-to", default=None,
+                        help="Translate the emergency answer into this language, as for a non-English user")
+    parser.add_argument("--output", default=f"benchmarks/results/pipeline-{datetime.now():%Y%m%d-%H%M%S}.json")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    if not os.environ.get("STANDIN_SERVER_URL"):
+        server, url = start_server(config_from_args(args))
+        os.environ["STANDIN_SERVER_URL"] = url
+        print(f"Stand-in server started on {url}")
+    # La ricerca web legge la chiave dall'ambiente; il server sostitutivo non la controlla
+    os.environ.setdefault("SERPER_API_KEY", "standin")
+
+    questions = load_questions()[:args.limit]
+    load_start = time.perf_counter()
+    pipeline = load_pipeline(args.bundle_root)
+    load_s = time.perf_counter() - load_start
+    sessions, wall_s = asyncio.run(run_sessions(pipeline, questions, args.concurrency, not args.no_prefetch,
+                                                args.translate_to))
+
+    completed = [session for session in sessions if "error" not in session]
+    for session in sessions:
+        if "error" in session:
+            print(f"Session failed: {session['error']}")
+    results = {
+        "sessions": len(sessions),
+        "errors": len(sessions) - len(completed),
+        "load_s": load_s,
+        "wall_s": wall_s,
+        "sessions_per_s": len(completed) / wall_s if wall_s else None,
+        "latency_s": {
+            key: summarize([session.get(key) for session in completed])
+            for key in ("triage_s", "emergency_time_to_first_token", "emergency_time_to_first_instruction",
+                        "emergency_time_to_combined", "emergency_total", "total_s")
+        },
+        "triage_turns": summarize([session["triage_turns"] for session in completed]),
+        "translation_calls": summarize([session.get("emergency_translation_calls") for session in completed]),
+        "video_rate": float(np.mean([session["has_video"] for session in completed])) if completed else None,
+        # Rami in ritardo rispetto alla risposta e annullati alla scadenza complessiva, per tarare src/deadlines.json
+        "branch_deadlines": {
+            key: {branch: sum(branch in session.get(f"emergency_{key}", []) for session in completed)
+                  for branch in ("hospital", "youtube")}
+            for key in ("pending", "timeouts")
+        },
+        # Risultati speculativi avviati, adottati dal grafo di emergenza e annullati dopo una domanda del triage
+        "prefetch": {key: sum(session["prefetch"][key] for session in completed if "prefetch" in session)
+                     for key in ("started", "adopted", "missed", "cancelled")} if not args.no_prefetch else None,
+        # Coda e retry del rate limiter LLM
+        "llm_client": llm_client_stats(),
+        # Latenze per nodo e chiamata esterna, retry e token
+        "tracing": tracer.snapshot(),
+    }
+    total = results["latency_s"]["total_s"]
+    print(f"{len(completed)}/{len(sessions)} sessions in {wall_s:.2f}s "
+          f"(concurrency {args.concurrency}, load {load_s:.2f}s)"
+          + (f", total p50/p95 {total['p50']:.2f}/{total['p95']:.2f}s" if total else ""))
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "standin_server_url": os.environ["STANDIN_SERVER_URL"],
+        "standin": vars(config_from_args(args)) if server else None,
+        "questions": len(questions),
+        "concurrency": args.concurrency,
+        "prefetch": not args.no_prefetch,
+        "translate_to": args.translate_to,
+        "results": results,
+        "sessions": sessions,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+    if args.prometheus:
+        tracer.write_prometheus(args.prometheus)
+        print(f"Span histograms written to {args.prometheus}")
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
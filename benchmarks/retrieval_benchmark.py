@@ -0,0 +1,224 @@
+"""
+Benchmark dei retriever (BM25, FAISS, ibrido) sui bundle di indici, usando le domande di esempio
+in data/questions_samples e le etichette di rilevanza in benchmarks/retrieval_labels.json.
+
+Uso:
+    python -m benchmarks.retrieval_benchmark [--corpus triage emergency] [--retriever bm25 faiss hybrid]
+                                             [--k 1 3 5] [--repeat 3] [--output benchmarks/results/retrieval.json]
+
+Ogni retriever viene caricato in un processo separato, così tempo di caricamento a freddo e memoria
+residente non dipendono dagli indici già caricati. Il risultato è un file JSON confrontabile tra run.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+
+QUESTION_FILES = {
+    "Domande_Primo_Soccorso.xlsx": "Domanda",
+    "Domande_Primo_Soccorso_Extra.xlsx": "Domande",
+}
+QUESTIONS_DIR = "data/questions_samples"
+LABELS_PATH = "benchmarks/retrieval_labels.json"
+RETRIEVERS = ["bm25", "faiss", "hybrid"]
+# Stessi parametri dei create_*_retriever
+BM25_K = 3
+FAISS_K = 4
+HYBRID_WEIGHTS = [0.3, 0.7]
+
+
+def load_questions(questions_dir: str = QUESTIONS_DIR) -> list:
+    import pandas as pd
+    questions = []
+    for file_name, column in QUESTION_FILES.items():
+        frame = pd.read_excel(os.path.join(questions_dir, file_name))
+        for row, text in enumerate(frame[column]):
+            questions.append({"file": file_name, "row": row, "text": str(text).strip()})
+    return questions
+
+
+def normalize_label(value) -> str:
+    # I titoli estratti dal PDF hanno a capo e spazi spuri ("DELL ’ENCEFALO")
+    return " ".join(str(value).split()).replace(" ’", "’")
+
+
+def current_rss_mb() -> float:
+    """Memoria residente attuale del processo, in MB (picco di getrusage dove /proc non esiste)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _load_retriever(corpus: str, name: str, bundle_root: str):
+    from src.bm25_index import MmapBM25Retriever
+    from src.embeddings import get_embeddings
+    from src.index_bundle import load_index_bundle
+    from src.retrieval import HybridRetriever
+    from src.vector_index import load_faiss_store
+
+    manifest, bm25_path, faiss_path = load_index_bundle(corpus, bundle_root)
+    retrievers = []
+    if name in ("bm25", "hybrid"):
+        retrievers.append(MmapBM25Retriever.load(bm25_path, k=BM25_K))
+    if name in ("faiss", "hybrid"):
+        embedding = get_embeddings(manifest["inputs"]["embedding_model"])
+        vectorstore = load_faiss_store(faiss_path, embedding, manifest["inputs"].get("vector_index"))
+        retrievers.append(vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": FAISS_K}))
+    if name == "hybrid":
+        # Senza corpus/bundle_version: la query_cache falserebbe le latenze
+        return manifest, HybridRetriever(retrievers=retrievers, weights=HYBRID_WEIGHTS)
+    return manifest, retrievers[0]
+
+
+def _percentiles_ms(timings: list) -> dict:
+    if not timings:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    values = np.asarray(timings) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(values.mean())}
+
+
+def run_retriever(corpus: str, name: str, bundle_root: str, questions: list, labels: dict,
+                  ks: list, repeat: int) -> dict:
+    """
+    Carica un retriever, esegue tutte le domande e calcola latenza, recall@k, tempo di caricamento e memoria.
+
+    Returns:
+        dict: Le metriche del retriever; in caso di errore contiene solo "error".
+    """
+    rss_before = current_rss_mb()
+    start_time = time.perf_counter()
+    try:
+        manifest, retriever = _load_retriever(corpus, name, bundle_root)
+    except Exception as e:
+        return {"error": f"load failed: {e!r}"}
+    cold_load_s = time.perf_counter() - start_time
+    rss_loaded = current_rss_mb()
+
+    # Prima query fuori dalle misure: verifica ogni componente (l'ibrido nasconderebbe un FAISS che
+    # fallisce dietro la sola lista BM25) e misura separatamente il costo della prima query
+    start_time = time.perf_counter()
+    try:
+        for component in getattr(retriever, "retrievers", [retriever]):
+            component.invoke(questions[0]["text"])
+    except Exception as e:
+        return {"error": f"query failed: {e!r}", "bundle_version": manifest["bundle_version"]}
+    first_query_s = time.perf_counter() - start_time
+
+    corpus_labels = labels.get(corpus, {})
+    field = corpus_labels.get("field")
+    labelled = corpus_labels.get("questions", {})
+
+    timings = []
+    recalls = {k: [] for k in ks}
+    hits = {k: [] for k in ks}
+    try:
+        for question in questions:
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                docs = retriever.invoke(question["text"])
+                timings.append(time.perf_counter() - start_time)
+            relevant = labelled.get(question["file"], {}).get(str(question["row"]))
+            if not relevant:
+                continue
+            relevant = {normalize_label(value) for value in relevant}
+            retrieved = [normalize_label(doc.metadata.get(field)) for doc in docs]
+            for k in ks:
+                found = len(relevant & set(retrieved[:k]))
+                recalls[k].append(found / len(relevant))
+                hits[k].append(float(found > 0))
+    except Exception as e:
+        return {"error": f"query failed: {e!r}", "bundle_version": manifest["bundle_version"]}
+
+    return {
+        "bundle_version": manifest["bundle_version"],
+        "embedding_model": manifest["inputs"]["embedding_model"],
+        "cold_load_s": cold_load_s,
+        "first_query_s": first_query_s,
+        "rss_mb": {"before_load": rss_before, "after_load": rss_loaded, "after_queries": current_rss_mb()},
+        "latency_ms": _percentiles_ms(timings),
+        "queries": len(timings),
+        "labelled_questions": len(recalls[ks[0]]) if ks else 0,
+        "recall_at_k": {str(k): float(np.mean(values)) if values else None for k, values in recalls.items()},
+        # Almeno una sezione pertinente tra i primi k
+        "hit_rate_at_k": {str(k): float(np.mean(values)) if values else None for k, values in hits.items()},
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BM25, FAISS and hybrid retrieval on the sample questions.")
+    parser.add_argument("--corpus", nargs="+", choices=["triage", "emergency"], default=["triage", "emergency"])
+    parser.add_argument("--retriever", nargs="+", choices=RETRIEVERS, default=RETRIEVERS)
+    parser.add_argument("--bundle-root", default="data/index_bundle")
+    parser.add_argument("--labels", default=LABELS_PATH)
+    parser.add_argument("--k", nargs="+", type=int, default=[1, 3, 5])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per question for the latency percentiles")
+    parser.add_argument("--no-isolate", action="store_true", help="Load every retriever in this process")
+    parser.add_argument("--output", default=f"benchmarks/results/retrieval-{datetime.now():%Y%m%d-%H%M%S}.json")
+    args = parser.parse_args()
+
+    questions = load_questions()
+    with open(args.labels, "r") as f:
+        labels = json.load(f)
+
+    results = {}
+    # "spawn": ogni retriever parte da un interprete pulito, senza indici ereditati dal padre
+    context = multiprocessing.get_context("spawn")
+    for corpus in args.corpus:
+        results[corpus] = {}
+        for name in args.retriever:
+            task = (corpus, name, args.bundle_root, questions, labels, args.k, args.repeat)
+            if args.no_isolate:
+                result = run_retriever(*task)
+            else:
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_retriever, task)
+            results[corpus][name] = result
+            if "error" in result:
+                print(f"{corpus}/{name}: {result['error']}")
+            else:
+                latency = result["latency_ms"]
+                recall = ", ".join(f"R@{k}={v:.2f}" for k, v in result["recall_at_k"].items() if v is not None)
+                print(f"{corpus}/{name}: load {result['cold_load_s']:.2f}s, "
+                      f"rss {result['rss_mb']['after_load']:.0f} MB, "
+                      f"p50/p95/p99 {latency['p50']:.1f}/{latency['p95']:.1f}/{latency['p99']:.1f} ms"
+                      + (f", {recall}" if recall else ""))
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "questions": len(questions),
+        "repeat": args.repeat,
+        "k": args.k,
+        "isolated": not args.no_isolate,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
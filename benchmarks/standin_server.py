@@ -0,0 +1,399 @@
+"""
+Server sostitutivo locale dei servizi esterni, per test di carico e latenza senza rete né chiavi reali.
+
+Espone gli stessi percorsi delle API usate dall'app:
+  - Groq:    POST /openai/v1/chat/completions (anche in streaming), POST /openai/v1/audio/transcriptions
+  - OpenAI:  POST /v1/embeddings (vettori deterministici per testo, dimensione del modello richiesto)
+  - Serper:  POST /search, con link a pagine servite da GET /pages/<sito>/<pagina>
+  - YouTube: GET /youtube/v3/search
+  - Places:  GET /maps/api/place/nearbysearch/json
+
+Le risposte delle chat seguono regole (espressione regolare sul prompt → risposta) che rispettano
+i contratti JSON dei nodi: {"Summary": ..., "Score": ...}, {"keywords": ...}, {"translated_query": ...},
+{"ranking": ...}, {"medical_class": ...}. Un file --script aggiunge regole prima di quelle predefinite.
+Le risposte sono template string.Template: $nome viene sostituito dal gruppo (?P<nome>...) della regola.
+
+Uso:
+    python -m benchmarks.standin_server [--port 8765] [--latency-ms 300] [--jitter-ms 50] [--tokens-per-s 250]
+                                        [--error-rate 0.05] [--error-status 429] [--script rules.json]
+    STANDIN_SERVER_URL=http://127.0.0.1:8765 streamlit run app.py
+
+Formato di --script: {"rules": [{"name": "...", "match": "regex", "response": "testo" | ["testo", ...]}]};
+con una lista le risposte vengono usate a turno. GET /stats restituisce i contatori per endpoint.
+"""
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+
+EMBEDDING_DIMENSIONS = {"text-embedding-ada-002": 1536, "text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+DEFAULT_EMBEDDING_DIMENSION = 1536
+DEFAULT_TRANSCRIPT = "My friend cut his hand with a kitchen knife and it is bleeding a lot. What should I do?"
+
+FIRST_AID_ANSWER = (
+    "1. **Stay calm and make sure the area is safe** before approaching the person.\n"
+    "2. **Call the emergency number (112 or 911)** if the person is seriously hurt, unconscious or not breathing normally.\n"
+    "3. **Apply firm, direct pressure** to any bleeding with a clean cloth or bandage. Do not remove the cloth if it soaks through: add more layers on top.\n"
+    "4. **Keep the person lying down and warm**, and raise the injured limb if there is no suspected fracture.\n"
+    "5. **Monitor breathing and consciousness** until help arrives. If breathing stops, start CPR with 30 chest compressions and 2 rescue breaths.\n"
+    "6. **Do not give food or drink**, and do not move the person unless they are in immediate danger."
+)
+PAGE_TEXT = (
+    "First aid basics. Check the scene for danger, then check the person. Call emergency services for severe "
+    "bleeding, chest pain, difficulty breathing, loss of consciousness or a suspected fracture. Control bleeding "
+    "with firm pressure, cool burns under running water for at least 20 minutes, and keep the person warm and still."
+)
+
+# Regole predefinite, nell'ordine in cui vengono provate; vince la prima che corrisponde al prompt
+DEFAULT_RULES = [
+    {"name": "translate",
+     "match": r"(?s)- Message: (?P<message>.*?)\n\s*- Target Language: (?P<target>[^\n]*)",
+     "response": '{"translated_query": "$message", "source_language": "English"}'},
+    # Primo turno di triage: una domanda di approfondimento, poi il punteggio
+    {"name": "triage_question",
+     "match": r"(?s)specializing in Triage.*### Your Last Question:\s*None\s",
+     "response": '{"Summary": "The user reports a first aid emergency and is describing the symptoms.", '
+                 '"Reasoning": "More details are needed to assess the severity.", '
+                 '"Question": "Is the person conscious and breathing normally?"}'},
+    {"name": "triage_score",
+     "match": r"specializing in Triage",
+     "response": '{"Summary": "The user reports a first aid emergency; the person is conscious and breathing.", '
+                 '"Reasoning": "The situation needs prompt care but is not immediately life-threatening.", '
+                 '"Score": "4"}'},
+    {"name": "query_analysis", "match": r'"youtube_keywords"',
+     "response": '{"youtube_keywords": "first aid, emergency care", "web_keywords": "first aid, emergency care", '
+                 '"medical_class": "internal medicine", "red_flag": false}'},
+    {"name": "keywords", "match": r'"keywords"', "response": '{"keywords": "first aid, emergency care"}'},
+    {"name": "video_ranking", "match": r'"ranking"', "response": '{"ranking": [1], "confident": true}'},
+    {"name": "medical_class", "match": r'"medical_class"', "response": '{"medical_class": "internal medicine"}'},
+    {"name": "answer", "match": r"", "response": FIRST_AID_ANSWER},
+]
+
+
+def _json_escape(value: str) -> str:
+    return json.dumps(value)[1:-1]
+
+
+class StandinConfig:
+    """Latenze in millisecondi, velocità di generazione, errori iniettati e regole aggiuntive."""
+
+    def __init__(self, latency_ms: float = 300.0, jitter_ms: float = 50.0, tokens_per_s: float = 250.0,
+                 api_latency_ms: float = 50.0, error_rate: float = 0.0, error_status: int = 429,
+                 transcript: str = DEFAULT_TRANSCRIPT, rules: list = None, seed: int = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_s = tokens_per_s
+        self.api_latency_ms = api_latency_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.transcript = transcript
+        self.rules = rules or []
+        self.seed = seed
+
+
+class StandinState:
+    """Regole compilate, generatore casuale e contatori condivisi tra i thread del server."""
+
+    def __init__(self, config: StandinConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.rules = []
+        for rule in config.rules + DEFAULT_RULES:
+            responses = rule["response"] if isinstance(rule["response"], list) else [rule["response"]]
+            self.rules.append((rule.get("name", rule["match"]), re.compile(rule["match"]), itertools.cycle(responses)))
+        self._lock = threading.Lock()
+        self.counters = {}
+
+    def count(self, endpoint: str, key: str = "requests", amount: int = 1):
+        with self._lock:
+            counters = self.counters.setdefault(endpoint, {"requests": 0, "errors": 0, "tokens": 0, "cancelled": 0})
+            counters[key] += amount
+
+    def chat_response(self, prompt: str) -> tuple:
+        """(nome della regola, testo della risposta) per un prompt."""
+        for name, pattern, responses in self.rules:
+            match = pattern.search(prompt)
+            if match:
+                with self._lock:
+                    template = next(responses)
+                values = {key: _json_escape(value or "") for key, value in match.groupdict().items()}
+                return name, Template(template).safe_substitute(values)
+
+    def delay(self, base_ms: float) -> float:
+        jitter = self.random.uniform(-self.config.jitter_ms, self.config.jitter_ms) if self.config.jitter_ms else 0.0
+        return max(0.0, base_ms + jitter) / 1000
+
+    def should_fail(self) -> bool:
+        return self.config.error_rate > 0 and self.random.random() < self.config.error_rate
+
+
+def tokenize(text: str) -> list:
+    # Approssimazione: un token per parola, con gli spazi che la seguono
+    return re.findall(r"\s*\S+\s*", text) or [text]
+
+
+def embedding_vector(text, dimension: int) -> np.ndarray:
+    """Vettore unitario deterministico: stesso testo (o stessi token), stesso vettore."""
+    seed = int(hashlib.sha256(json.dumps(text).encode("utf-8")).hexdigest()[:16], 16)
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StandinState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # ---- risposta ----
+
+    def _send_json(self, payload, status: int = 200, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, text: str, content_type: str = "text/plain"):
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, endpoint: str):
+        self.state.count(endpoint, "errors")
+        status = self.state.config.error_status
+        headers = {"Retry-After": "1"} if status == 429 else {}
+        self._send_json({"error": {"message": "Injected stand-in error", "type": "standin_error", "code": status}},
+                        status=status, headers=headers)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    # ---- instradamento ----
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/stats":
+            with self.state._lock:
+                return self._send_json(self.state.counters)
+        time.sleep(self.state.delay(self.state.config.api_latency_ms))
+        if url.path == "/youtube/v3/search":
+            return self._youtube_search(query)
+        if url.path == "/maps/api/place/nearbysearch/json":
+            return self._places_nearby(query)
+        if url.path.startswith("/pages/"):
+            self.state.count("pages")
+            return self._send_text(f"<html><body><main><h1>{url.path.rsplit('/', 1)[-1]}</h1>"
+                                   f"<p>{PAGE_TEXT}</p></main></body></html>", "text/html")
+        self._send_json({"error": {"message": f"Unknown path {url.path}"}}, status=404)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self._read_body()
+        if path in ("/openai/v1/chat/completions", "/v1/chat/completions"):
+            return self._chat_completions(json.loads(body or b"{}"))
+        if path in ("/openai/v1/audio/transcriptions", "/v1/audio/transcriptions"):
+            return self._transcription(body)
+        if path in ("/v1/embeddings", "/openai/v1/embeddings"):
+            return self._embeddings(json.loads(body or b"{}"))
+        if path == "/search":
+            return self._serper_search(urlsplit(self.path).query)
+        self._send_json({"error": {"message": f"Unknown path {path}"}}, status=404)
+
+    # ---- endpoint ----
+
+    def _chat_completions(self, request: dict):
+        self.state.count("chat")
+        if self.state.should_fail():
+            return self._send_error("chat")
+        prompt = "\n".join(
+            message["content"] if isinstance(message.get("content"), str)
+            else " ".join(part.get("text", "") for part in message.get("content") or [])
+            for message in request.get("messages", [])
+        )
+        rule, content = self.state.chat_response(prompt)
+        self.state.count(f"chat:{rule}")
+        tokens = tokenize(content)
+        token_delay = 1 / self.state.config.tokens_per_s if self.state.config.tokens_per_s else 0.0
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = request.get("model", "standin")
+        usage = {"prompt_tokens": len(tokenize(prompt)), "completion_tokens": len(tokens),
+                 "total_tokens": len(tokenize(prompt)) + len(tokens)}
+        time.sleep(self.state.delay(self.state.config.latency_ms))
+        if not request.get("stream"):
+            self.state.count("chat", "tokens", len(tokens))
+            time.sleep(token_delay * len(tokens))
+            return self._send_json({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta: dict, finish_reason=None, **extra):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        sent = 0
+        try:
+            event({"role": "assistant", "content": ""})
+            for token in tokens:
+                event({"content": token})
+                sent += 1
+                time.sleep(token_delay)
+            event({}, "stop", x_groq={"id": completion_id, "usage": usage})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # Il client ha chiuso lo stream (es. output strutturato già completo): la generazione si ferma
+            self.state.count("chat", "cancelled")
+            self.close_connection = True
+        finally:
+            # Solo i token effettivamente generati
+            self.state.count("chat", "tokens", sent)
+
+    def _transcription(self, body: bytes):
+        self.state.count("transcription")
+        if self.state.should_fail():
+            return self._send_error("transcription")
+        time.sleep(self.state.delay(self.state.config.latency_ms))
+        # Multipart non interpretato: basta sapere se è richiesto il testo semplice
+        if re.search(rb'name="response_format"\r\n\r\ntext\r\n', body):
+            return self._send_text(self.state.config.transcript)
+        self._send_json({"text": self.state.config.transcript})
+
+    def _embeddings(self, request: dict):
+        self.state.count("embeddings")
+        if self.state.should_fail():
+            return self._send_error("embeddings")
+        time.sleep(self.state.delay(self.state.config.api_latency_ms))
+        inputs = request.get("input", [])
+        # Una stringa, una lista di stringhe, una lista di token o una lista di liste di token
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        model = request.get("model", "")
+        dimension = request.get("dimensions") or EMBEDDING_DIMENSIONS.get(model, DEFAULT_EMBEDDING_DIMENSION)
+        data = []
+        for index, text in enumerate(inputs):
+            vector = embedding_vector(text, dimension)
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        self._send_json({"object": "list", "data": data, "model": model,
+                         "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}})
+
+    def _serper_search(self, query_string: str):
+        self.state.count("serper")
+        time.sleep(self.state.delay(self.state.config.api_latency_ms))
+        query = parse_qs(query_string).get("q", ["first aid"])[0]
+        slug = re.sub(r"[^a-z0-9]+", "-", query.lower()).strip("-") or "first-aid"
+        host = f"http://{self.headers.get('Host')}"
+        self._send_json({"searchParameters": {"q": query}, "organic": [
+            {"title": f"{query} - Mayo Clinic", "link": f"{host}/pages/mayoclinic/{slug}", "position": 1},
+            {"title": f"{query} - WebMD", "link": f"{host}/pages/webmd/{slug}", "position": 2},
+        ]})
+
+    def _youtube_search(self, query: dict):
+        self.state.count("youtube")
+        keywords = query.get("q", "first aid")
+        channel = query.get("channelId", "standin")
+        items = [{"id": {"kind": "youtube#video",
+                         "videoId": hashlib.sha1(f"{channel}:{keywords}:{i}".encode("utf-8")).hexdigest()[:11]},
+                  "snippet": {"title": f"First Aid: {keywords} ({i + 1})", "channelId": channel}}
+                 for i in range(int(query.get("maxResults", 3)))]
+        self._send_json({"kind": "youtube#searchListResponse", "items": items})
+
+    def _places_nearby(self, query: dict):
+        self.state.count("places")
+        try:
+            lat, lng = (float(value) for value in query.get("location", "").split(","))
+        except ValueError:
+            lat, lng = 41.9028, 12.4964
+        self._send_json({"status": "OK", "results": [
+            {"name": "Stand-in General Hospital", "geometry": {"location": {"lat": lat + 0.01, "lng": lng + 0.01}}},
+        ]})
+
+
+def start_server(config: StandinConfig, host: str = "127.0.0.1", port: int = 0):
+    """
+    Avvia il server in un thread di background.
+
+    Returns:
+        tuple: (server, URL base da usare come STANDIN_SERVER_URL)
+    """
+    handler = type("ConfiguredStandinHandler", (StandinHandler,), {"state": StandinState(config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="standin-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Time to first token of LLM calls")
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--tokens-per-s", type=float, default=250.0, help="Generation rate, 0 for instant")
+    parser.add_argument("--api-latency-ms", type=float, default=50.0,
+                        help="Latency of embeddings, search, YouTube and Places")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of LLM/embedding calls that fail")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--script", default=None, help="JSON file with extra response rules")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args) -> StandinConfig:
+    rules = []
+    if args.script:
+        with open(args.script, "r") as f:
+            rules = json.load(f)["rules"]
+    return StandinConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, tokens_per_s=args.tokens_per_s,
+                         api_latency_ms=args.api_latency_ms, error_rate=args.error_rate,
+                         error_status=args.error_status, rules=rules, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Groq, OpenAI, Serper, YouTube and Places APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server, url = start_server(config_from_args(args), args.host, args.port)
+    print(f"Stand-in server listening on {url} (set STANDIN_SERVER_URL={url})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Benchmark dell'avvio a freddo: tempo di import dei moduli dell'app e tempo fino alla prima richiesta servita.
+
+Uso:
+    python -m benchmarks.startup_benchmark [--repeat 5] [--max-import-s 3.0] [--max-first-request-s 30.0]
+                                           [--output benchmarks/results/startup.json]
+
+Ogni misura gira in un interprete nuovo: l'import di ciascun modulo di STARTUP_MODULES (ripetuto --repeat
+volte, si riporta la mediana), e un processo che importa i moduli dell'app, carica retriever e grafi come
+app.py e serve una sessione completa (triage ed emergenza) contro il server sostitutivo di
+benchmarks/standin_server.py, avviato qui se STANDIN_SERVER_URL non è impostata.
+
+Per ogni modulo si controlla anche che le dipendenze pesanti di LAZY_MODULES non vengano caricate
+all'import. Con --max-import-s / --max-first-request-s, o se una dipendenza pesante viene caricata
+all'import, il comando termina con errore (per la CI).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+
+# Moduli importati all'avvio dell'app
+STARTUP_MODULES = ["src.utils", "src.llm_client", "src.triage_utils", "src.emergency_utils", "src.streaming", "src.speculation"]
+# Dipendenze che si caricano solo al primo uso
+LAZY_MODULES = ["langchain_groq", "google.cloud.storage", "gtts", "PIL.Image", "bs4", "geocoder", "streamlit_js_eval"]
+
+_IMPORT_PROBE = """
+import json, sys, time
+start_time = time.perf_counter()
+import {module}
+import_s = time.perf_counter() - start_time
+print(json.dumps({{"import_s": import_s, "eager": [name for name in {lazy!r} if name in sys.modules]}}))
+"""
+
+
+def _run_child(args: list, env: dict = None) -> dict:
+    # Il risultato è l'ultima riga dell'output del processo figlio
+    start_time = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-W", "ignore", *args], capture_output=True, text=True, env=env)
+    process_s = time.perf_counter() - start_time
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f"exit {completed.returncode}"}
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["process_s"] = process_s
+    return result
+
+
+def measure_import(module: str, repeat: int) -> dict:
+    runs = [_run_child(["-c", _IMPORT_PROBE.format(module=module, lazy=LAZY_MODULES)]) for _ in range(repeat)]
+    errors = [run["error"] for run in runs if "error" in run]
+    if errors:
+        return {"error": errors[0]}
+    return {
+        "import_s": statistics.median(run["import_s"] for run in runs),
+        "process_s": statistics.median(run["process_s"] for run in runs),
+        "eager": runs[0]["eager"],
+    }
+
+
+def first_request(bundle_root: str) -> dict:
+    """Eseguito nel processo figlio: import, caricamento come app.py e prima sessione servita."""
+    import asyncio
+    import importlib
+    start_time = time.perf_counter()
+    for module in STARTUP_MODULES:
+        importlib.import_module(module)
+    import_s = time.perf_counter() - start_time
+
+    from benchmarks.pipeline_benchmark import load_pipeline, run_session
+    from benchmarks.retrieval_benchmark import load_questions
+    load_start = time.perf_counter()
+    pipeline = load_pipeline(bundle_root)
+    load_s = time.perf_counter() - load_start
+
+    query = load_questions()[0]["text"]
+    request_start = time.perf_counter()
+    session = asyncio.run(run_session(pipeline, query))
+    return {
+        "import_s": import_s,
+        "load_s": load_s,
+        "request_s": time.perf_counter() - request_start,
+        "time_to_first_request_s": time.perf_counter() - start_time,
+        "session_error": session.get("error"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold import time and time to first served request.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per module import")
+    parser.add_argument("--bundle-root", default="data/index_bundle")
+    parser.add_argument("--max-import-s", type=float, default=None,
+                        help="Fail if any startup module takes longer to import (median)")
+    parser.add_argument("--max-first-request-s", type=float, default=None,
+                        help="Fail if the first request is served later than this")
+    parser.add_argument("--first-request", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--output", default=f"benchmarks/results/startup-{datetime.now():%Y%m%d-%H%M%S}.json")
+    args = parser.parse_args()
+
+    if args.first_request:
+        print(json.dumps(first_request(args.bundle_root)))
+        return
+
+    from benchmarks.retrieval_benchmark import _git_commit
+    from benchmarks.standin_server import StandinConfig, start_server
+
+    server = None
+    env = dict(os.environ)
+    if not env.get("STANDIN_SERVER_URL"):
+        server, env["STANDIN_SERVER_URL"] = start_server(StandinConfig())
+        print(f"Stand-in server started on {env['STANDIN_SERVER_URL']}")
+    env.setdefault("SERPER_API_KEY", "standin")
+
+    imports = {}
+    for module in STARTUP_MODULES:
+        imports[module] = measure_import(module, args.repeat)
+        print(f"{module}: {imports[module]}")
+    first = _run_child(["-m", "benchmarks.startup_benchmark", "--first-request", "--bundle-root", args.bundle_root], env)
+    print(f"First request: {first}")
+
+    failures = [f"{module} failed to import: {result['error']}" for module, result in imports.items() if "error" in result]
+    failures += [f"{module} imports {', '.join(result['eager'])} eagerly"
+                 for module, result in imports.items() if result.get("eager")]
+    if args.max_import_s is not None:
+        failures += [f"{module} imports in {result['import_s']:.2f}s (max {args.max_import_s}s)"
+                     for module, result in imports.items() if result.get("import_s", 0) > args.max_import_s]
+    if "error" in first or first.get("session_error"):
+        failures.append(f"First request failed: {first.get('error') or first.get('session_error')}")
+    elif args.max_first_request_s is not None and first["time_to_first_request_s"] > args.max_first_request_s:
+        failures.append(f"First request served after {first['time_to_first_request_s']:.2f}s (max {args.max_first_request_s}s)")
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "imports": imports,
+        "first_request": first,
+        "failures": failures,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+    if server:
+        server.shutdown()
+    if failures:
+        raise SystemExit("Startup benchmark failed:\n" + "\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Report recall/latenza/memoria delle modalità dell'indice vettoriale (src.vector_index) sui vettori
+dei bundle. Non richiede chiavi API: i vettori vengono ricostruiti dagli indici FAISS salvati e le
+query sono vettori del corpus perturbati; la verità di riferimento è la ricerca esatta (flat).
+
+Uso:
+    python -m benchmarks.vector_index_benchmark [--scale 50] [--queries 200] [--k 4]
+                                                [--output benchmarks/results/vector_index.json]
+
+Con --scale N il corpus viene replicato N volte con rumore, per simulare molti più manuali.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from src.index_bundle import BUNDLE_ROOT, FAISS_DIR, bundle_path, validate_bundle
+from src.vector_index import apply_search_params, build_faiss_index, reconstruct_vectors
+
+
+# Parametro di ricerca variato per ogni modalità: la curva recall-latenza
+SWEEPS = {
+    "flat": (None, [None]),
+    "hnsw": ("ef_search", [16, 32, 64, 128]),
+    "hnsw-sq8": ("ef_search", [16, 32, 64, 128]),
+    "ivf-sq8": ("nprobe", [1, 4, 8, 16]),
+    "ivf-pq": ("nprobe", [1, 4, 8, 16]),
+}
+
+
+def load_bundle_vectors(corpora: list, bundle_root: str = BUNDLE_ROOT) -> np.ndarray:
+    import faiss
+    vectors = []
+    for corpus in corpora:
+        bundle_dir = bundle_path(corpus, bundle_root)
+        validate_bundle(bundle_dir)
+        vectors.append(reconstruct_vectors(faiss.read_index(os.path.join(bundle_dir, FAISS_DIR, "index.faiss"))))
+    return np.vstack(vectors).astype(np.float32)
+
+
+def synthetic_corpus(vectors: np.ndarray, scale: int, noise: float, rng: np.random.Generator) -> np.ndarray:
+    if scale <= 1:
+        return vectors
+    copies = [vectors] + [vectors + rng.normal(0, noise, vectors.shape).astype(np.float32) for _ in range(scale - 1)]
+    return np.vstack(copies)
+
+
+def index_size_mb(index) -> float:
+    import faiss
+    return faiss.serialize_index(index).nbytes / 2**20
+
+
+def measure(index, queries: np.ndarray, truth: np.ndarray, k: int) -> dict:
+    timings = []
+    found = []
+    for query, expected in zip(queries, truth):
+        start_time = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        timings.append(time.perf_counter() - start_time)
+        found.append(len(set(ids[0]) & set(expected)) / k)
+    values = np.asarray(timings) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"recall_at_k": float(np.mean(found)), "latency_ms": {"p50": float(p50), "p95": float(p95), "p99": float(p99)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency report for the FAISS vector index modes.")
+    parser.add_argument("--corpus", nargs="+", choices=["triage", "emergency"], default=["triage", "emergency"])
+    parser.add_argument("--bundle-root", default=BUNDLE_ROOT)
+    parser.add_argument("--mode", nargs="+", choices=list(SWEEPS), default=list(SWEEPS))
+    parser.add_argument("--scale", type=int, default=1, help="Replicate the corpus N times with noise")
+    parser.add_argument("--noise", type=float, default=0.01, help="Std of the noise added to copies and queries")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=f"benchmarks/results/vector_index-{datetime.now():%Y%m%d-%H%M%S}.json")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = synthetic_corpus(load_bundle_vectors(args.corpus, args.bundle_root), args.scale, args.noise, rng)
+    sample = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+    queries = vectors[sample] + rng.normal(0, args.noise, (len(sample), vectors.shape[1])).astype(np.float32)
+
+    exact = build_faiss_index(vectors, "flat")
+    _, truth = exact.search(queries, args.k)
+    print(f"{len(vectors)} vectors, dim {vectors.shape[1]}, {len(queries)} queries, k={args.k}")
+
+    results = []
+    for mode in args.mode:
+        param_name, values = SWEEPS[mode]
+        start_time = time.perf_counter()
+        index = build_faiss_index(vectors, mode)
+        build_s = time.perf_counter() - start_time
+        size_mb = index_size_mb(index)
+        for value in values:
+            if value is not None:
+                apply_search_params(index, {param_name: value})
+            result = {"mode": mode, "search_param": param_name, "value": value, "build_s": build_s, "index_mb": size_mb,
+                      **measure(index, queries, truth, args.k)}
+            results.append(result)
+            latency = result["latency_ms"]
+            label = f"{mode}" + (f" {param_name}={value}" if value is not None else "")
+            print(f"{label:<24} recall@{args.k} {result['recall_at_k']:.3f}  "
+                  f"p50 {latency['p50']:.3f} ms  p95 {latency['p95']:.3f} ms  "
+                  f"size {size_mb:.1f} MB  build {build_s:.2f}s")
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "corpora": args.corpus,
+        "vectors": int(len(vectors)),
+        "dim": int(vectors.shape[1]),
+        "scale": args.scale,
+        "noise": args.noise,
+        "queries": int(len(queries)),
+        "k": args.k,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+from collections import Counter
+from typing import Any, List
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.documents import Document
+from pydantic import ConfigDict
+
+
+BM25_FORMAT_VERSION = 1
+
+# File che compongono un indice BM25 su disco
+META_FILE = "meta.json"
+TERMS_FILE = "terms.bin"                  # termini ordinati, utf-8 concatenati
+TERM_OFFSETS_FILE = "term_offsets.npy"    # int64[V+1], offset di ogni termine in terms.bin
+IDF_FILE = "idf.npy"                      # float32[V]
+POSTING_OFFSETS_FILE = "posting_offsets.npy"  # int64[V+1], blocco di posting per termine
+POSTING_DOCS_FILE = "posting_docs.npy"    # int32[P], doc-id delle posting
+POSTING_TF_FILE = "posting_tf.npy"        # float32[P], term frequency delle posting
+DOC_LEN_FILE = "doc_len.npy"              # float32[N]
+DOCS_FILE = "docs.bin"                    # documenti serializzati in JSON, concatenati
+DOC_OFFSETS_FILE = "doc_offsets.npy"      # int64[N+1], offset di ogni documento in docs.bin
+
+
+def default_preprocessing_func(text: str) -> List[str]:
+    # Stessa tokenizzazione di default del BM25Retriever di LangChain
+    return text.split()
+
+
+def _compute_idf(doc_freqs: np.ndarray, corpus_size: int, epsilon: float) -> np.ndarray:
+    # Stessa formula di rank_bm25.BM25Okapi: idf negativi sostituiti da epsilon * idf medio
+    idf = np.log(corpus_size - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+    eps = epsilon * idf.mean() if len(idf) else 0.0
+    idf[idf < 0] = eps
+    return idf
+
+
+def _write_index(index_path: str, terms: List[str], idf: np.ndarray, postings: List[tuple],
+                 doc_len: np.ndarray, documents: List[Document], params: dict):
+    """
+    Scrive l'indice in una cartella temporanea e la sostituisce atomicamente a quella finale.
+    """
+    tmp_path = f"{index_path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    encoded_terms = [term.encode("utf-8") for term in terms]
+    with open(os.path.join(tmp_path, TERMS_FILE), "wb") as f:
+        f.write(b"".join(encoded_terms))
+    np.save(os.path.join(tmp_path, TERM_OFFSETS_FILE),
+            np.concatenate([[0], np.cumsum([len(t) for t in encoded_terms], dtype=np.int64)]).astype(np.int64))
+    np.save(os.path.join(tmp_path, IDF_FILE), idf.astype(np.float32))
+
+    posting_sizes = [len(doc_ids) for doc_ids, _ in postings]
+    np.save(os.path.join(tmp_path, POSTING_OFFSETS_FILE),
+            np.concatenate([[0], np.cumsum(posting_sizes, dtype=np.int64)]).astype(np.int64))
+    np.save(os.path.join(tmp_path, POSTING_DOCS_FILE),
+            np.concatenate([doc_ids for doc_ids, _ in postings] or [[]]).astype(np.int32))
+    np.save(os.path.join(tmp_path, POSTING_TF_FILE),
+            np.concatenate([tfs for _, tfs in postings] or [[]]).astype(np.float32))
+    np.save(os.path.join(tmp_path, DOC_LEN_FILE), doc_len.astype(np.float32))
+
+    encoded_docs = [
+        json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False).encode("utf-8")
+        for doc in documents
+    ]
+    with open(os.path.join(tmp_path, DOCS_FILE), "wb") as f:
+        f.write(b"".join(encoded_docs))
+    np.save(os.path.join(tmp_path, DOC_OFFSETS_FILE),
+            np.concatenate([[0], np.cumsum([len(d) for d in encoded_docs], dtype=np.int64)]).astype(np.int64))
+
+    meta = {
+        "format_version": BM25_FORMAT_VERSION,
+        "n_docs": len(documents),
+        "n_terms": len(terms),
+        "avgdl": float(doc_len.mean()) if len(doc_len) else 0.0,
+        **params,
+    }
+    with open(os.path.join(tmp_path, META_FILE), "w") as f:
+        json.dump(meta, f, indent=4)
+
+    if os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    os.replace(tmp_path, index_path)
+
+
+def build_bm25_index(documents: List[Document], index_path: str, k1: float = 1.5, b: float = 0.75,
+                     epsilon: float = 0.25):
+    """
+    Costruisce un indice BM25 invertito su disco a partire da una lista di documenti.
+
+    Args:
+        documents (list): Lista di documenti da indicizzare.
+        index_path (str): Cartella in cui salvare l'indice.
+        k1, b, epsilon (float): Parametri BM25Okapi.
+    """
+    tokenized = [Counter(default_preprocessing_func(doc.page_content)) for doc in documents]
+    doc_len = np.array([sum(freqs.values()) for freqs in tokenized], dtype=np.float64)
+
+    inverted = {}
+    for doc_id, freqs in enumerate(tokenized):
+        for term, tf in freqs.items():
+            inverted.setdefault(term, []).append((doc_id, tf))
+
+    terms = sorted(inverted, key=lambda t: t.encode("utf-8"))
+    postings = []
+    for term in terms:
+        entries = inverted[term]
+        postings.append((np.array([d for d, _ in entries]), np.array([tf for _, tf in entries])))
+    doc_freqs = np.array([len(inverted[term]) for term in terms], dtype=np.float64)
+    idf = _compute_idf(doc_freqs, len(documents), epsilon)
+
+    _write_index(index_path, terms, idf, postings, doc_len, documents, {"k1": k1, "b": b, "epsilon": epsilon})
+
+
+def convert_bm25_pickle(pickle_path: str, index_path: str):
+    """
+    Converte un BM25Retriever serializzato con pickle (formato precedente) nel nuovo formato su disco.
+
+    Args:
+        pickle_path (str): Percorso del file .pkl esistente.
+        index_path (str): Cartella in cui salvare l'indice.
+    """
+    import pickle
+    with open(pickle_path, "rb") as f:
+        retriever = pickle.load(f)
+    vectorizer = retriever.vectorizer
+    build_bm25_index(retriever.docs, index_path, k1=vectorizer.k1, b=vectorizer.b, epsilon=vectorizer.epsilon)
+
+
+class MmapBM25Index:
+    """
+    Indice BM25 aperto tramite mmap: le posting restano su disco (page cache condivisa tra i processi)
+    e solo i documenti restituiti vengono deserializzati.
+    """
+
+    def __init__(self, index_path: str):
+        with open(os.path.join(index_path, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("format_version") != BM25_FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index format in {index_path}: {self.meta.get('format_version')}")
+
+        def load(name):
+            return np.load(os.path.join(index_path, name), mmap_mode="r")
+
+        self.index_path = index_path
+        self.k1 = self.meta["k1"]
+        self.b = self.meta["b"]
+        self.avgdl = self.meta["avgdl"]
+        self.n_docs = self.meta["n_docs"]
+        self._terms = np.memmap(os.path.join(index_path, TERMS_FILE), dtype=np.uint8, mode="r") \
+            if os.path.getsize(os.path.join(index_path, TERMS_FILE)) else np.zeros(0, dtype=np.uint8)
+        self._term_offsets = load(TERM_OFFSETS_FILE)
+        self._idf = load(IDF_FILE)
+        self._posting_offsets = load(POSTING_OFFSETS_FILE)
+        self._posting_docs = load(POSTING_DOCS_FILE)
+        self._posting_tf = load(POSTING_TF_FILE)
+        self._doc_len = load(DOC_LEN_FILE)
+        self._docs = np.memmap(os.path.join(index_path, DOCS_FILE), dtype=np.uint8, mode="r") \
+            if os.path.getsize(os.path.join(index_path, DOCS_FILE)) else np.zeros(0, dtype=np.uint8)
+        self._doc_offsets = load(DOC_OFFSETS_FILE)
+
+    def _term(self, term_id: int) -> bytes:
+        return self._terms[self._term_offsets[term_id]:self._term_offsets[term_id + 1]].tobytes()
+
+    def term_id(self, term: str):
+        # Ricerca binaria sui termini ordinati, senza caricare il vocabolario in memoria
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self._term_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._term_offsets) - 1 and self._term(lo) == key:
+            return lo
+        return None
+
+    def get_scores(self, query_tokens: List[str]) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float64)
+        for token in query_tokens:
+            term_id = self.term_id(token)
+            if term_id is None:
+                continue
+            start, end = self._posting_offsets[term_id], self._posting_offsets[term_id + 1]
+            doc_ids = self._posting_docs[start:end]
+            tf = self._posting_tf[start:end].astype(np.float64)
+            norm = self.k1 * (1 - self.b + self.b * self._doc_len[doc_ids] / self.avgdl)
+            scores[doc_ids] += float(self._idf[term_id]) * (tf * (self.k1 + 1) / (tf + norm))
+        return scores
+
+    def get_document(self, doc_id: int) -> Document:
+        raw = self._docs[self._doc_offsets[doc_id]:self._doc_offsets[doc_id + 1]].tobytes()
+        data = json.loads(raw.decode("utf-8"))
+        return Document(page_content=data["page_content"], metadata=data["metadata"])
+
+    def top_n(self, query: str, n: int) -> List[Document]:
+        scores = self.get_scores(default_preprocessing_func(query))
+        # Stesso ordinamento di rank_bm25.get_top_n
+        top_ids = np.argsort(scores)[::-1][:n]
+        return [self.get_document(int(doc_id)) for doc_id in top_ids]
+
+
+class MmapBM25Retriever(BaseRetriever):
+    """Retriever BM25 basato su MmapBM25Index, utilizzabile come retriever in un HybridRetriever o EnsembleRetriever."""
+
+    index: Any = None
+    k: int = 4
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @classmethod
+    def load(cls, index_path: str, k: int = 4) -> "MmapBM25Retriever":
+        return cls(index=MmapBM25Index(index_path), k=k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.index.top_n(query, self.k)
@@ -0,0 +1,47 @@
+"""
+Scadenze dei rami del grafo di emergenza, da src/deadlines.json (o dal file indicato da EMERGENCY_DEADLINES_PATH).
+
+Ogni ramo (youtube, hospital, web_search) ha un budget in secondi dall'avvio del grafo: i nodi non avviano
+nuovi tentativi oltre il budget del proprio ramo, e src.streaming, con la risposta pronta, segna come
+in attesa i rami che lo hanno superato. overall_s è il limite oltre il quale i rami ancora in corso
+vengono annullati.
+"""
+import json
+import math
+import os
+import time
+
+
+EMERGENCY_DEADLINES_PATH = os.environ.get("EMERGENCY_DEADLINES_PATH", "src/deadlines.json")
+
+_deadlines = None
+
+
+def load_deadlines(path: str = EMERGENCY_DEADLINES_PATH) -> dict:
+    with open(path, "r") as f:
+        deadlines = json.load(f)
+    if any(budget > deadlines["overall_s"] for budget in deadlines["branches"].values()):
+        raise ValueError(f"Branch deadlines in {path} exceed overall_s ({deadlines['overall_s']})")
+    return deadlines
+
+
+def get_deadlines() -> dict:
+    """La configurazione del processo, letta alla prima richiesta."""
+    global _deadlines
+    if _deadlines is None:
+        _deadlines = load_deadlines()
+    return _deadlines
+
+
+def branch_deadline(branch: str) -> float:
+    """Budget del ramo in secondi dall'avvio del grafo; overall_s per i rami non configurati."""
+    deadlines = get_deadlines()
+    return deadlines["branches"].get(branch, deadlines["overall_s"])
+
+
+def time_left(state: dict, branch: str) -> float:
+    """Secondi rimasti al ramo; infiniti se il grafo è stato avviato senza started_at (es. valutazione offline)."""
+    started_at = state.get("started_at")
+    if started_at is None:
+        return math.inf
+    return started_at + branch_deadline(branch) - time.monotonic()
@@ -0,0 +1,169 @@
+"""
+Motore di ricerca a shard costruito dai docstore llama-index in data/doc_*/vector_db.
+
+Uso:
+    python -m src.docstore_engine build [--force]
+    python -m src.docstore_engine search "query" --severity 2
+"""
+import argparse
+import os
+import re
+import shutil
+from typing import Iterator, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from src.bm25_index import MmapBM25Index, build_bm25_index
+from src.index_bundle import (BUNDLE_ROOT, MANIFEST_FILE, IndexBundleError, chunker_version, file_sha256,
+                              validate_bundle, write_manifest)
+
+
+DOCSTORE_BUNDLE = "docstore"
+SHARDS_DIR = "shards"
+# Uno shard per corpus
+DOCSTORE_PATHS = {
+    "triage": "data/doc_triage/vector_db/docstore.json",
+    "emergency": "data/doc_emergency/vector_db/docstore.json",
+    "everyday": "data/doc_everyday/vector_db/docstore.json",
+}
+
+# Artefatti di estrazione del PDF everyday ("\t\r \xa0" al posto degli spazi)
+_whitespace_pattern = re.compile(r"[\t\r\xa0 ]+")
+
+
+def shard_for_severity(severity: int) -> str:
+    # Stessa soglia di should_find_hospital: oltre 2 è un'emergenza
+    return "emergency" if severity > 2 else "everyday"
+
+
+def iter_docstore_documents(docstore_path: str, shard: str) -> Iterator[Document]:
+    """
+    Legge un docstore.json di llama-index in streaming (ijson), un nodo alla volta,
+    senza caricare l'intero file in memoria.
+
+    Args:
+        docstore_path (str): Percorso del docstore.json.
+        shard (str): Nome dello shard, salvato nei metadati.
+
+    Yields:
+        Document: Un documento per ogni TextNode non vuoto.
+    """
+    import ijson
+    with open(docstore_path, "rb") as f:
+        for node_id, node in ijson.kvitems(f, "docstore/data", use_float=True):
+            data = node.get("__data__", {})
+            if data.get("class_name") != "TextNode":
+                continue
+            text = _whitespace_pattern.sub(" ", data.get("text") or "").strip()
+            if not text:
+                continue
+            metadata = data.get("metadata", {})
+            yield Document(
+                page_content=text,
+                metadata={
+                    "shard": shard,
+                    "node_id": node_id,
+                    "file_name": metadata.get("file_name"),
+                    "page_label": metadata.get("page_label"),
+                },
+            )
+
+
+def _compute_inputs() -> dict:
+    return {
+        "docstore_sha256": {shard: file_sha256(path) for shard, path in DOCSTORE_PATHS.items()},
+        "loader_version": chunker_version("src/docstore_engine.py", ["iter_docstore_documents"]),
+    }
+
+
+def build_docstore_bundle(bundle_root: str = BUNDLE_ROOT, force: bool = False) -> dict:
+    """
+    Costruisce un indice BM25 (mmap) per ogni shard in un bundle con manifest, solo se un input è cambiato.
+    """
+    bundle_dir = os.path.join(bundle_root, DOCSTORE_BUNDLE)
+    inputs = _compute_inputs()
+    if os.path.exists(os.path.join(bundle_dir, MANIFEST_FILE)) and not force:
+        try:
+            manifest = validate_bundle(bundle_dir)
+            if manifest["inputs"] == inputs:
+                print(f"docstore: bundle {manifest['bundle_version']} is up to date")
+                return manifest
+        except IndexBundleError as e:
+            print(f"docstore: existing bundle is invalid ({e}), rebuilding")
+
+    tmp_dir = f"{bundle_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    for shard, docstore_path in DOCSTORE_PATHS.items():
+        documents = list(iter_docstore_documents(docstore_path, shard))
+        build_bm25_index(documents, os.path.join(tmp_dir, SHARDS_DIR, shard))
+        print(f"docstore: shard {shard} indexed ({len(documents)} documents)")
+
+    manifest = write_manifest(tmp_dir, DOCSTORE_BUNDLE, inputs)
+    if os.path.exists(bundle_dir):
+        shutil.rmtree(bundle_dir)
+    os.replace(tmp_dir, bundle_dir)
+    print(f"docstore: built bundle {manifest['bundle_version']}")
+    return manifest
+
+
+class ShardedSearchEngine:
+    """Un indice BM25 per corpus, con instradamento delle query sugli shard in base alla severità."""
+
+    def __init__(self, bundle_root: str = BUNDLE_ROOT):
+        bundle_dir = os.path.join(bundle_root, DOCSTORE_BUNDLE)
+        self.manifest = validate_bundle(bundle_dir)
+        self.bundle_version = self.manifest["bundle_version"]
+        self.shards = {
+            shard: MmapBM25Index(os.path.join(bundle_dir, SHARDS_DIR, shard))
+            for shard in DOCSTORE_PATHS
+        }
+
+    def search(self, query: str, shard: str, k: int = 4) -> List[Document]:
+        return self.shards[shard].top_n(query, k)
+
+    def search_by_severity(self, query: str, severity: int, k: int = 4) -> List[Document]:
+        return self.search(query, shard_for_severity(severity), k)
+
+    def retriever_for_severity(self, severity: int, k: int = 4) -> "ShardRetriever":
+        return ShardRetriever(engine=self, shard=shard_for_severity(severity), k=k)
+
+
+class ShardRetriever(BaseRetriever):
+    """Retriever LangChain su un singolo shard del ShardedSearchEngine."""
+
+    engine: ShardedSearchEngine
+    shard: str
+    k: int = 4
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.engine.search(query, self.shard, self.k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the sharded docstore search engine.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--force", action="store_true", help="Rebuild even if no input changed")
+    search_parser = subparsers.add_parser("search")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--severity", type=int, default=1)
+    search_parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--bundle-root", default=BUNDLE_ROOT)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_docstore_bundle(args.bundle_root, force=args.force)
+    else:
+        engine = ShardedSearchEngine(args.bundle_root)
+        for doc in engine.search_by_severity(args.query, args.severity, args.k):
+            print(f"[{doc.metadata['shard']} p.{doc.metadata['page_label']}] {doc.page_content[:200]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Callable, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+EMBEDDING_CACHE_PATH = "data/embedding_cache/embeddings.sqlite"
+LOCAL_EMBEDDING_MODEL = "local:sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+LOCAL_BATCH_SIZE = 256
+
+
+class LocalSentenceEmbeddings(Embeddings):
+    """
+    Embedding locale su CPU tramite sentence-transformers, calcolato in grandi batch NumPy.
+    Non richiede chiavi API né rete (una volta scaricato il modello). sentence-transformers (e torch)
+    è una dipendenza opzionale: pip install -r requirements-local-embeddings.txt
+    """
+
+    def __init__(self, model_name: str, batch_size: int = LOCAL_BATCH_SIZE):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                f"The local embedding backend ({model_name}) needs sentence-transformers, which is not installed. "
+                "Run: pip install -r requirements-local-embeddings.txt"
+            ) from e
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(
+            texts, batch_size=self.batch_size, convert_to_numpy=True,
+            normalize_embeddings=True, show_progress_bar=False
+        ).astype(np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()
+
+
+class EmbeddingCache:
+    """
+    Cache su disco content-addressed: chiave (modello, sha256 del testo), valore vettore float32.
+    """
+
+    def __init__(self, cache_path: str = EMBEDDING_CACHE_PATH):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, hashes: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            # Query a blocchi per restare sotto il limite di parametri di SQLite
+            for i in range(0, len(hashes), 500):
+                block = hashes[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({','.join('?' * len(block))})",
+                    [model, *block],
+                ).fetchall()
+                found.update({text_hash: np.frombuffer(vector, dtype=np.float32) for text_hash, vector in rows})
+        return found
+
+    def put_many(self, model: str, items: dict):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model, text_hash, np.asarray(vector, dtype=np.float32).tobytes()) for text_hash, vector in items.items()],
+            )
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Provider di embedding con backend costruito al primo utilizzo e cache opzionale su disco.
+    Con la cache, solo i testi mai visti (per quel modello) vengono ricalcolati.
+    """
+
+    def __init__(self, embedding_model: str, backend_factory: Callable[[], Embeddings],
+                 cache: EmbeddingCache = None):
+        self.embedding_model = embedding_model
+        self._backend_factory = backend_factory
+        self._backend = None
+        self.cache = cache
+
+    @property
+    def backend(self) -> Embeddings:
+        if self._backend is None:
+            self._backend = self._backend_factory()
+        return self._backend
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        if isinstance(self.backend, LocalSentenceEmbeddings):
+            return self.backend.embed_array(texts)
+        return np.asarray(self.backend.embed_documents(texts), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._embed(texts).tolist()
+
+        hashes = [EmbeddingCache.text_hash(text) for text in texts]
+        cached = self.cache.get_many(self.embedding_model, list(set(hashes)))
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in cached:
+                missing.setdefault(text_hash, text)
+        if missing:
+            print(f"Embedding {len(missing)}/{len(texts)} texts not in cache with {self.embedding_model}")
+            vectors = self._embed(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.embedding_model, computed)
+            cached.update(computed)
+        return [cached[text_hash].tolist() for text_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.backend.embed_query(text)
+
+
+def _openai_backend(model_name: str) -> Embeddings:
+    from langchain_openai import OpenAIEmbeddings
+    import streamlit as st
+    from src.endpoints import OPENAI_API_URL, service_url, standin_server_url
+    if standin_server_url():
+        # Offline tiktoken non può scaricare il tokenizer: al server sostitutivo si manda il testo così com'è
+        return OpenAIEmbeddings(model=model_name, api_key=st.secrets["OPENAI"]["OPENAI_API_KEY"],
+                                base_url=service_url(OPENAI_API_URL), check_embedding_ctx_length=False)
+    return OpenAIEmbeddings(model=model_name, api_key=st.secrets["OPENAI"]["OPENAI_API_KEY"])
+
+
+def get_embeddings(embedding_model: str, cache_path: str = None) -> CachedEmbeddings:
+    """
+    Restituisce il provider di embedding indicato da una stringa "<backend>:<modello>".
+
+    Args:
+        embedding_model (str): Ad esempio "openai:text-embedding-ada-002" o
+            "local:sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2".
+        cache_path (str): Database della cache su disco; None per disabilitarla.
+
+    Returns:
+        CachedEmbeddings: Provider compatibile con le Embeddings di LangChain.
+    """
+    backend, _, model_name = embedding_model.partition(":")
+    if backend == "openai":
+        factory = lambda: _openai_backend(model_name)
+    elif backend == "local":
+        factory = lambda: LocalSentenceEmbeddings(model_name)
+    else:
+        raise ValueError(f"Unknown embedding backend: {embedding_model}")
+    cache = EmbeddingCache(cache_path) if cache_path else None
+    return CachedEmbeddings(embedding_model, factory, cache)
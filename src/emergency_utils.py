@@ -1,34 +1,36 @@
-from langchain_groq import ChatGroq
 from langgraph.graph import StateGraph
-import pickle
-from typing import TypedDict, Annotated, List
+from typing import Any, TypedDict, Annotated, List
 from langgraph.graph.message import add_messages
-import geocoder
 from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage
-from langchain_community.utilities import GoogleSerperAPIWrapper
 import requests
-from bs4 import BeautifulSoup
 import re
 import json
+import bisect
 from dotenv import load_dotenv
 load_dotenv()
 import os
 import requests
-import streamlit as st
 import re
 from jinja2 import Template
-from PIL import Image
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_openai import OpenAIEmbeddings
-from langchain.vectorstores import FAISS
 #from langchain.embeddings import OpenAIEmbeddings
-from langchain.retrievers import BM25Retriever, EnsembleRetriever
-from langchain.schema import Document
-import io
-
-
-llm_70b = ChatGroq(model="llama-3.3-70b-versatile", api_key=st.secrets["GROQ"]["GROQ_API_KEY"])
-llm_8b = ChatGroq(model="llama-3.1-8b-instant", api_key=st.secrets["GROQ"]["GROQ_API_KEY"])
+from src.bm25_index import MmapBM25Retriever
+from src.ingestion import stream_pdf_documents
+from src.index_bundle import BUNDLE_ROOT, load_index_bundle
+from src.embeddings import get_embeddings
+from src.retrieval import HybridRetriever
+from src.vector_index import load_faiss_store
+from src.model_router import get_model_router
+from src.tracing import traced_node, tracer
+from src.deadlines import time_left
+from src.endpoints import PLACES_NEARBY_URL, SERPER_SEARCH_URL, YOUTUBE_SEARCH_URL, service_url
+from src.semantic_cache import get_answer_cache, retriever_scope
+from src.utils import MEDICAL_SPECIALTIES
+from langchain_core.documents import Document
+import asyncio
+
+
+# Livello di modello per nodo in src/model_routing.json: i nodi semplici usano il modello piccolo
+model_router = get_model_router()
 
 
 def get_user_location():
@@ -38,170 +40,150 @@ def get_user_location():
     Returns:
         tuple: Latitudine e longitudine dell'utente o None se non disponibile.
     """
+    import geocoder
     location = geocoder.ip('me')
     return location.latlng if location.latlng else (None, None)
 
 
-def process_pdf_emergency(file_path):
+# Intestazioni e artefatti da rimuovere dal testo del manuale, in un'unica passata
+_emergency_noise_pattern = re.compile("|".join(re.escape(noise) for noise in [
+    "MANUALE PER GLI INCARICATI DI PRIMO SOCCORSO",
+    "LE POSIZIONI DI SICUREZZA",
+    "APPARATO VISIVO",
+    "APPARATO UDITIVO",
+    "SISTEMA NERVOSO - anatomia",
+    "IL SISTEMA NERVOSO\n",
+    "-\n",
+]))
+# Espressione regolare per identificare titoli in maiuscolo (che terminano con \n)
+# (forma equivalente al pattern precedente, senza quantificatori annidati)
+_main_title_pattern = re.compile(r'(?:\n|^)([A-Z\s’]+)\n')
+# Per riconoscere sottosezioni come "a)" o "b)" e sezioni come "I GRADO", "II GRADO" a inizio riga
+_section_pattern = re.compile(r'[a-z]\)|[IV]+\s+GRADO')
+
+
+class _PageOffsetIndex:
     """
-    Carica e processa un file PDF per estrarre il contenuto delle pagine desiderate.
+    Testo grezzo delle pagine concatenato, con l'offset cumulativo di inizio di ogni pagina:
+    la pagina di un offset si risolve con bisect invece di scorrere tutte le pagine.
+    """
+
+    def __init__(self, pages):
+        self.text = "\n".join(page.page_content for page in pages)
+        self.page_numbers = [page.metadata["page"] for page in pages]
+        self.starts = []
+        self.ends = []
+        offset = 0
+        for page in pages:
+            self.starts.append(offset)
+            offset += len(page.page_content)
+            self.ends.append(offset)
+            offset += 1
+        self._cache = {}
+
+    def first_page_containing(self, title):
+        # Prima pagina il cui testo contiene il titolo per intero (le occorrenze a cavallo di due pagine non contano)
+        if title not in self._cache:
+            page_nr = None
+            position = self.text.find(title)
+            while position != -1:
+                i = bisect.bisect_right(self.starts, position) - 1
+                if position + len(title) <= self.ends[i]:
+                    page_nr = self.page_numbers[i]
+                    break
+                position = self.text.find(title, self.starts[i + 1]) if i + 1 < len(self.starts) else -1
+            self._cache[title] = page_nr
+        return self._cache[title]
+
+
+def _organize_sections(content):
+    # Accorpa sottosezioni (es: "a)", "b)", "I GRADO", "II GRADO") al contenuto principale
+    organized_content = []
+    current_subsection = None
+    for line in content.split("\n"):
+        if _section_pattern.match(line):
+            current_subsection = line
+            organized_content.append(f"\n{line}")
+        elif current_subsection:
+            # Accorpa le righe successive alla sottosezione corrente
+            organized_content[-1] += f" {line.strip()}"
+        else:
+            # Accorpa al contenuto principale
+            organized_content.append(line.strip())
+    return "\n".join(organized_content)
+
+
+def chunk_emergency_pages(pages):
+    """
+    Divide le pagine del manuale in un documento per titolo principale, con una sola passata di
+    normalizzazione e pattern precompilati. I numeri di pagina si risolvono tramite _PageOffsetIndex.
 
     Args:
-        file_path (str): Percorso al file PDF.
+        pages (list): Pagine del PDF (Document con metadata["page"]).
 
     Returns:
-        str: Testo processato e unificato delle pagine selezionate.
+        list: Documenti LangChain con metadata "title" e "page_nr".
     """
-    print('process_pdf_emergency')
-    loader = PyPDFLoader(file_path)
-    pages = loader.load()[40:]
-    full_text = "\n".join([doc.page_content for doc in pages])
-    full_text = full_text.replace("MANUALE PER GLI INCARICATI DI PRIMO SOCCORSO", "")
-    full_text = full_text.replace("LE POSIZIONI DI SICUREZZA", "")
-    full_text = full_text.replace("APPARATO VISIVO", "")
-    full_text = full_text.replace("APPARATO UDITIVO", "")
-    full_text = full_text.replace("SISTEMA NERVOSO - anatomia", "")
-    full_text = full_text.replace("IL SISTEMA NERVOSO\n", "")
-    full_text = full_text.replace("-\n", "")
-    # Espressione regolare per identificare titoli in maiuscolo (che terminano con \n)
-    main_title_pattern = r'(?:\n|^)([A-Z\s\’\’]+(?:\n[A-Z\s\’\’]+)*)\n'
-    sub_section_pattern = r'(?:^|\n)([a-z]\))'  # Per riconoscere sottosezioni come "a)" o "b)"
-    degree_section_pattern = r'(?:^|\n)([IV]+\s+GRADO)'
-
-    # Mappa dei numeri di pagina
-    page_number_map = []
-    for page in pages:
-        page_number_map.append({"text": page.page_content, "page_number": page.metadata["page"]})
-
-    # Trova tutti i titoli principali
-    matches = list(re.finditer(main_title_pattern, full_text))
-    documents = []
-    current_content = ""
-    current_title = None
-    current_page = None
-
-    for i in range(len(matches)):
-        # Ottieni il titolo corrente
-        title_start = matches[i].start()
-        title_end = matches[i].end()
-        title = full_text[title_start:title_end].strip()
-
-        # Determina il contenuto fino al prossimo titolo principale o alla fine del testo
-        if i + 1 < len(matches):
-            content_start = title_end
-            content_end = matches[i + 1].start()
-            content = full_text[content_start:content_end].strip()
-        else:
-            content = full_text[title_end:].strip()
+    page_index = _PageOffsetIndex(pages)
+    full_text = _emergency_noise_pattern.sub("", page_index.text)
+    matches = list(_main_title_pattern.finditer(full_text))
+    titles = [full_text[match.start():match.end()].strip() for match in matches]
 
-        # Trova il numero di pagina del titolo corrente
-        if current_page is None:
-            for page in page_number_map:
-                if title in page["text"]:
-                    current_page = page["page_number"]
-                    break
-
-        # Accorpa sottosezioni (es: "a)", "b)", "I GRADO", "II GRADO") al contenuto principale
-        content_lines = content.split("\n")
-        organized_content = []
-        current_subsection = None
-
-        for line in content_lines:
-            # Riconosci sottosezioni come "a)", "b)"
-            if re.match(sub_section_pattern, line):
-                current_subsection = line
-                organized_content.append(f"\n{line}")
-            # Riconosci sezioni come "I GRADO", "II GRADO"
-            elif re.match(degree_section_pattern, line):
-                current_subsection = line
-                organized_content.append(f"\n{line}")
-            elif current_subsection:
-                # Accorpa le righe successive alla sottosezione corrente
-                organized_content[-1] += f" {line.strip()}"
-            else:
-                # Accorpa al contenuto principale
-                organized_content.append(line.strip())
-
-        content = "\n".join(organized_content)
-
-        # Salva il documento precedente
-        if current_title:
-            documents.append({"title": current_title, "page_content": current_content, "page_nr": current_page})
-
-        # Inizia un nuovo documento
-        current_title = title
-        current_content = content
-        current_page = None  # Reset del numero di pagina
-
-    # Salva l'ultimo documento
-    if current_title:
-        documents.append({"title": current_title, "page_content": current_content, "page_nr": current_page})
-
-    # Converti in oggetti Document compatibili con LangChain
-    documents = [
-        Document(
-            page_content=doc["page_content"],
-            metadata={"title": doc["title"], "page_nr": doc["page_nr"]}
-        )
-        for doc in documents
-    ]
+    documents = []
+    for i, match in enumerate(matches):
+        # I titoli vuoti (solo spazi) delimitano il contenuto ma non generano documenti
+        if not titles[i]:
+            continue
+        content_end = matches[i + 1].start() if i + 1 < len(matches) else len(full_text)
+        content = _organize_sections(full_text[match.end():content_end].strip())
+        # Come nella versione precedente, ogni documento riporta la pagina del titolo successivo
+        # (l'ultimo resta senza pagina)
+        page_nr = page_index.first_page_containing(titles[i + 1]) if i + 1 < len(matches) else None
+        documents.append(Document(page_content=content, metadata={"title": titles[i], "page_nr": page_nr}))
     return documents
 
 
-def create_bm25_retriever_emergency(pdf_file_path, bm25_index_path):
+def process_pdf_emergency(file_path):
     """
-    Crea o carica un retriever BM25.
+    Carica e processa un file PDF per estrarre il contenuto delle pagine desiderate.
 
     Args:
-        documents (list): Lista di documenti da indicizzare.
-        bm25_index_path (str): Percorso per salvare o caricare l'indice BM25.
+        file_path (str): Percorso al file PDF.
 
     Returns:
-        BM25Retriever: Un retriever BM25.
+        list: Documenti LangChain, uno per titolo principale del manuale.
     """
-    # Se esiste un file salvato, carica il retriever
-    if os.path.exists(bm25_index_path):
-        #print("Caricamento retriever BM25 esistente.")
-        with open(bm25_index_path, "rb") as f:
-            bm25_retriever = pickle.load(f)
-            bm25_retriever.k = 3
-            documents = []
-    else:
-        #print("Creazione di un nuovo retriever BM25.")
-        # Creazione del retriever BM25
-        documents = process_pdf_emergency(pdf_file_path)
-        bm25_retriever = BM25Retriever.from_documents(documents)
-        bm25_retriever.k = 3
-        # Salva il retriever
-        with open(bm25_index_path, "wb") as f:
-            pickle.dump(bm25_retriever, f)
-    
-    return bm25_retriever, documents
+    print('process_pdf_emergency')
+    # Estrae in streaming solo le pagine dalla 40 in poi, su un pool di processi
+    pages = list(stream_pdf_documents(file_path, start=40))
+    return chunk_emergency_pages(pages)
 
 
-def create_emergency_retriever(pdf_file_path,  bm25_index_path, faiss_path):
-    # Step 1: Configura l'indice BM25 per i titoli
-    bm25_retriever, documents = create_bm25_retriever_emergency(pdf_file_path, bm25_index_path)
-    # Step 2: Configura FAISS per i contenuti
-    embedding = OpenAIEmbeddings(api_key=st.secrets["OPENAI"]["OPENAI_API_KEY"])
-    if os.path.exists(faiss_path):
-        vectorstore = FAISS.load_local(faiss_path, embeddings=embedding, allow_dangerous_deserialization=True)
-        print('load emergency retriever')
-    else:
-        if documents:
-            vectorstore = FAISS.from_documents(documents, embedding=embedding)
-            vectorstore.save_local(faiss_path)
-        else:
-            documents = process_pdf_emergency(pdf_file_path)
-            vectorstore = FAISS.from_documents(documents, embedding=embedding)
-            vectorstore.save_local(faiss_path)
+def create_emergency_retriever(bundle_root:str=BUNDLE_ROOT):
+    """
+    Carica il retriever ibrido (BM25 + FAISS) dal bundle di indici validato tramite manifest.
+    Il bundle si costruisce offline con `python -m src.index_bundle build`: qui non si processano mai PDF.
+
+    Args:
+        bundle_root (str): Cartella radice dei bundle di indici.
+
+    Returns:
+        HybridRetriever: Il retriever ibrido del corpus emergency.
+    """
+    manifest, bm25_index_path, faiss_path = load_index_bundle("emergency", bundle_root)
+    # Step 1: Apre l'indice BM25 tramite mmap
+    bm25_retriever = MmapBM25Retriever.load(bm25_index_path, k=3)
+    # Step 2: Carica FAISS per i contenuti, in memory-map e nella modalità di indice registrata nel manifest
+    # Il modello di embedding delle query è quello usato per costruire il bundle
+    embedding = get_embeddings(manifest["inputs"]["embedding_model"])
+    vectorstore = load_faiss_store(faiss_path, embedding, manifest["inputs"].get("vector_index"))
     similarity_retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 4})
 
-    # Step 3: Configura un MultiRetriever
-    ensemble_retriever = EnsembleRetriever(retrievers=[
+    # Step 3: Configura il retriever ibrido (BM25 e FAISS in parallelo, fusione RRF)
+    ensemble_retriever = HybridRetriever(retrievers=[
         bm25_retriever,
         similarity_retriever
-    ], weights=[0.3, 0.7])
+    ], weights=[0.3, 0.7], corpus="emergency", bundle_version=manifest["bundle_version"])
     return ensemble_retriever
 
 
@@ -213,7 +195,7 @@ class AgentState(TypedDict):
     prompt: Template
 
     rag_answer : str
-    ensemble_retriever : EnsembleRetriever
+    ensemble_retriever : HybridRetriever
 
     keywords_youtube: str
     search_results: str
@@ -229,25 +211,78 @@ class AgentState(TypedDict):
     
     web_search_keywords : str
     retry_count_web_search : int
+    # Testo delle pagine trovate da web_search (lista di str), o "NO Info" se la ricerca non ha dato risultati
+    web_info : Any
     web_answer : str
 
+    # Analisi unica della situazione (analyze_query)
+    medical_class : str
+    red_flag : bool
+
     final_result: List[str]
+    # time.monotonic() all'avvio, per i budget dei rami (src.deadlines); impostato da src.streaming
+    started_at: float
+    # src.speculation.EmergencyPrefetch con i risultati anticipati durante il triage (opzionale)
+    prefetch: Any
 
 
-def answer_from_rag(state:AgentState):
-    log_state("answer_from_rag", state)
+async def answer_from_rag(state:AgentState):
     full_query = state['full_query']
     ensemble_retriever = state['ensemble_retriever']
-    #retrieved_docs = ensemble_retriever.invoke(full_query)
-    #retrieved_info = [doc.page_content for doc in retrieved_docs[:2]]
-    prompt = state['prompt'].render(full_query=full_query, retrieved_info=None)
-    response = llm_70b.invoke([HumanMessage(content=prompt)]).content.strip()
+
+    # Cache semantica: situazioni equivalenti con stessa fascia di severità, template e bundle riusano la risposta
+    answer_cache = get_answer_cache()
+    corpus, bundle_version = retriever_scope(ensemble_retriever)
+    template = getattr(state['prompt'], 'name', None) or str(id(state['prompt']))
+    cache_scope = (state.get('severity'), template, corpus, bundle_version)
+    prefetch = state.get('prefetch')
+    query_vector = await prefetch.get("query_vector", full_query) if prefetch else None
+    if query_vector is None:
+        query_vector = await asyncio.to_thread(answer_cache.embed, full_query)
+    cached_answer = answer_cache.lookup(query_vector, *cache_scope)
+    if cached_answer is not None:
+        return {"rag_answer" : cached_answer, "full_query" : full_query}
+
+    retrieved_docs = await prefetch.get("retrieved_docs", (full_query, id(ensemble_retriever))) if prefetch else None
+    if retrieved_docs is None:
+        with tracer.span("emergency_retriever", "retrieval", corpus=getattr(ensemble_retriever, "corpus", None)):
+            retrieved_docs = await ensemble_retriever.ainvoke(full_query)
+    retrieved_info = [doc.page_content for doc in retrieved_docs[:2]]
+    prompt = state['prompt'].render(full_query=full_query, retrieved_info=retrieved_info or None)
+    response, _ = await model_router.ainvoke("answer_from_rag", [HumanMessage(content=prompt)])
     print(f"response: {response}")
+    # Le risposte 'NO INFO AVAILABLE' non si salvano: devono continuare a passare dalla ricerca web
+    if "no info available" not in response.lower():
+        answer_cache.store(query_vector, response, *cache_scope)
     return {"rag_answer" : response, "full_query" : full_query}
 
 
-def log_state(node_name, state:AgentState):
-    print(f"Node '{node_name}' State: {state}")
+def parse_keywords(response: str) -> str:
+    """Le keyword dal JSON restituito dal modello; solleva un'eccezione se l'output non è valido."""
+    keywords = json.loads(response)["keywords"]
+    if not isinstance(keywords, str) or not keywords.strip():
+        raise ValueError(f"Empty or invalid keywords: {keywords!r}")
+    return keywords
+
+
+def parse_yes_no(response: str) -> bool:
+    answer = response.strip().strip(".\"'").lower()
+    if answer not in ("yes", "no"):
+        raise ValueError(f"Expected YES or NO, got: {response!r}")
+    return answer == "yes"
+
+
+def _serper_search(query: str) -> dict:
+    # Stessa richiesta di GoogleSerperAPIWrapper.results, ma verso l'indirizzo configurabile
+    with tracer.span("serper_search", "http") as span:
+        response = requests.post(
+            service_url(SERPER_SEARCH_URL),
+            headers={"X-API-KEY": os.environ["SERPER_API_KEY"], "Content-Type": "application/json"},
+            params={"q": query, "gl": "us", "hl": "en", "num": 10},
+        )
+        span.set(status_code=response.status_code)
+        response.raise_for_status()
+        return response.json()
 
 
 def web_search(state: AgentState) -> str:
@@ -262,14 +297,13 @@ def web_search(state: AgentState) -> str:
              If no pertinent information is found, it returns a message indicating the absence of results.
     """
     # Fase 1: Ricerca su Internet
-    log_state("web_search", state)
-    query = state['web_search_keywords']
+    # Le keyword vengono dall'analisi; se non sono valide il retry le rigenera con extract_keywords_web_search
+    query = state.get('web_search_keywords')
     if not isinstance(query, str):
-        return "Nessun contenuto pertinente trovato su Internet"
+        return {"web_info" : "NO Info"}
     compliant_links = ['webmd', 'mayoclinic']
-    serper = GoogleSerperAPIWrapper(api_key=os.environ["SERPER_API_KEY"])
     try:
-        search_results = serper.results(query)['organic']
+        search_results = _serper_search(query)['organic']
         # Filtra e seleziona un link per ciascun dominio compliant
         selected_links = []
         for domain in compliant_links:
@@ -283,10 +317,13 @@ def web_search(state: AgentState) -> str:
         for url in selected_links:
             try:
                 # Effettua una richiesta al sito
-                response = requests.get(url)
+                with tracer.span("web_page", "http") as span:
+                    response = requests.get(url)
+                    span.set(status_code=response.status_code)
                 response.raise_for_status()  # Controlla se la richiesta è andata a buon fine
                 
                 # Analizza il contenuto della pagina con BeautifulSoup
+                from bs4 import BeautifulSoup
                 soup = BeautifulSoup(response.text, 'html.parser')
                 
                 # Estrai il contenuto principale della pagina (potresti dover adattare il selettore)
@@ -301,8 +338,91 @@ def web_search(state: AgentState) -> str:
         return {"web_info" : "NO Info"}
     
 
-def extract_keywords_web_search(state:AgentState):
-   log_state("extract_keywords_web_search", state)
+QUERY_ANALYSIS_FIELDS = ["youtube_keywords", "web_keywords", "medical_class", "red_flag"]
+
+ANALYZE_QUERY_PROMPT = """You are a highly skilled virtual assistant with expertise in first aid. Analyze the user's medical situation and return, in a single JSON object:
+    - "youtube_keywords": the most relevant keywords to optimize the search for a first aid video on YouTube.
+    - "web_keywords": the essential medical keywords to search for first aid guidance on medical websites: the type of injury or symptom and its cause, if specified. Omit who it happened to and any other irrelevant detail.
+    - "medical_class": the medical specialty most relevant to the situation, one of: {specialties}. Use "None" if it cannot be inferred.
+    - "red_flag": true if the situation shows any sign that needs immediate emergency care (e.g. loss of consciousness, difficulty breathing, chest pain, severe bleeding, signs of stroke or anaphylaxis), otherwise false.
+
+    Here are examples of situations and the corresponding output:
+    1. Situation: "I am feeling anxious, I think I am having a panic attack. What should I do?"
+       Output: {{"youtube_keywords": "panic attack, first aid", "web_keywords": "panic attack, first aid", "medical_class": "psychiatry", "red_flag": false}}
+    2. Situation: "What should I do if I get stung by a bee?"
+       Output: {{"youtube_keywords": "bee sting treatment, first aid", "web_keywords": "bee sting, first aid", "medical_class": "dermatology", "red_flag": false}}
+    3. Situation: "How to treat a deep cut made with a knife? It keeps bleeding heavily."
+       Output: {{"youtube_keywords": "knife deep cut treatment, first aid", "web_keywords": "deep cut knife, severe bleeding, first aid", "medical_class": "trauma surgery", "red_flag": true}}
+    4. Situation: "My lips are swelling after eating peanuts and I struggle to breathe."
+       Output: {{"youtube_keywords": "allergic reaction help, first aid", "web_keywords": "anaphylaxis, peanut allergy, first aid", "medical_class": "internal medicine", "red_flag": true}}
+
+    ### Situation:
+    '{query}'
+
+    Return strictly the JSON object, with no other text.
+    """
+
+
+def parse_query_analysis(response: str) -> dict:
+    """
+    I campi dell'analisi dal JSON del modello. Un JSON non valido solleva un'eccezione (escalation dell'intera
+    chiamata); un singolo campo non valido vale None e viene rigenerato dal suo nodo dedicato.
+    """
+    result = json.loads(response)
+    if not isinstance(result, dict):
+        raise ValueError(f"Invalid query analysis: {response!r}")
+    analysis = {}
+    for field in ("youtube_keywords", "web_keywords"):
+        value = result.get(field)
+        analysis[field] = value.strip() if isinstance(value, str) and value.strip() else None
+    analysis["medical_class"] = result.get("medical_class") if result.get("medical_class") in MEDICAL_SPECIALTIES else None
+    analysis["red_flag"] = result.get("red_flag") if isinstance(result.get("red_flag"), bool) else None
+    return analysis
+
+
+async def analyze_query(state:AgentState):
+    """
+    Una sola chiamata strutturata per keyword YouTube, keyword web, specialità medica e segnali d'allarme.
+    I nodi a valle leggono i campi dallo stato; extract_keywords_youtube ed extract_keywords_web_search
+    rigenerano solo le keyword non valide o senza risultati (tramite i retry dei rispettivi rami).
+    """
+    full_query = state['full_query']
+    # Analisi già avviata durante il triage sullo stesso riassunto
+    if state.get('prefetch'):
+        prefetched = await state['prefetch'].get("analysis", full_query)
+        if prefetched is not None:
+            return prefetched
+
+    prompt = ANALYZE_QUERY_PROMPT.format(specialties=", ".join(MEDICAL_SPECIALTIES), query=full_query)
+    try:
+        _, analysis = await model_router.ainvoke("analyze_query", [HumanMessage(content=prompt)],
+                                                 validate=parse_query_analysis, fields=[QUERY_ANALYSIS_FIELDS])
+    except ValueError as e:
+        # Anche dopo l'escalation: le keyword vengono rigenerate dai nodi dedicati
+        print(f"Invalid query analysis: {e}")
+        analysis = dict.fromkeys(QUERY_ANALYSIS_FIELDS)
+    print(f"Query analysis: {analysis}")
+    # Una keyword valida conta come primo tentativo di ricerca
+    return {
+        "keywords_youtube": analysis["youtube_keywords"],
+        "web_search_keywords": analysis["web_keywords"],
+        "retry_count_youtube": state.get("retry_count_youtube", 0) + (analysis["youtube_keywords"] is not None),
+        "retry_count_web_search": state.get("retry_count_web_search", 0) + (analysis["web_keywords"] is not None),
+        "medical_class": analysis["medical_class"],
+        "red_flag": bool(analysis["red_flag"]),
+    }
+
+
+def route_analysis(state:AgentState):
+    # Keyword YouTube non valide: le rigenera il nodo dedicato. Segnali d'allarme con severità bassa: si cerca comunque
+    # l'ospedale, se l'utente ha condiviso la posizione
+    destinations = ["search_youtube_videos" if state.get('keywords_youtube') else "extract_keywords_youtube"]
+    if state.get('red_flag') and state.get('severity') <= 2 and all(state.get('user_location') or [None]):
+        destinations.append("get_google_maps_url")
+    return destinations
+
+
+async def extract_keywords_web_search(state:AgentState):
    query = state['full_query']
    previous_keywords = state.get('web_search_keywords', '')
     # Costruisci il prompt
@@ -341,23 +461,26 @@ def extract_keywords_web_search(state:AgentState):
    Query: '{query}'
 
     Return the data strictly as a JSON object, with the following structure:
-    {
+    {{
         "keywords": "allergic reaction help, first aid"
-    }
+    }}
     """
         
    # Chiamata al modello LLM
-   response = llm_70b.invoke([HumanMessage(content=prompt)])
-   return {"web_search_keywords": json.loads(response.content)["keywords"], "retry_count_web_search" : state["retry_count_web_search"]+1}
+   _, keywords = await model_router.ainvoke("extract_keywords_web_search", [HumanMessage(content=prompt)],
+                                            validate=parse_keywords, fields=[["keywords"]])
+   return {"web_search_keywords": keywords, "retry_count_web_search" : state["retry_count_web_search"]+1}
 
 
 # Funzione per controllare se continuare
 def should_continue_web_search(state:AgentState):
-    web_search_results = state.get('web_answer', '')
-    #log_state("should_continue_web_search", state)
+    # La risposta finale non esiste ancora: si controlla il contenuto trovato da web_search
+    web_search_results = state.get('web_info', '')
     #print(state['retry_count_web_search'])
     retry_count_web_search = state.get('retry_count_web_search', 0)
-    if (not web_search_results or web_search_results == "NO Info") and retry_count_web_search <2:
+    # Oltre il budget del ramo si risponde con quello che c'è invece di ritentare
+    if (not web_search_results or web_search_results == "NO Info") and retry_count_web_search <2 \
+            and time_left(state, "web_search") > 0:
         # Incrementa il contatore dei retry
         return "retry"
     return "end"
@@ -371,8 +494,7 @@ def should_web_search(state:AgentState):
     return "end"
 
 
-def extract_keywords_youtube(state:AgentState):
-   log_state("extract_keywords_youtube", state)
+async def extract_keywords_youtube(state:AgentState):
    query = state['full_query']
    previous_keywords = state.get('keywords_youtube', '')
     # Costruisci il prompt
@@ -403,15 +525,17 @@ def extract_keywords_youtube(state:AgentState):
         prompt += f" Previous search with keywords '{previous_keywords}' returned no results. Try a different search query."
    
     # Chiamata al modello LLM
-   response = llm_70b.invoke([HumanMessage(content=prompt)])
-   return {"keywords_youtube": json.loads(response.content)["keywords"], "retry_count_youtube" : state["retry_count_youtube"]+1}
+   _, keywords = await model_router.ainvoke("extract_keywords_youtube", [HumanMessage(content=prompt)],
+                                            validate=parse_keywords, fields=[["keywords"]])
+   return {"keywords_youtube": keywords, "retry_count_youtube" : state["retry_count_youtube"]+1}
 
 
 # Funzione per controllare se continuare
 def should_continue_youtube(state:AgentState):
     search_results = state.get('search_results', '')
     retry_count_youtube = state.get('retry_count_youtube', 0)
-    if (not search_results or "No videos found" in search_results) and retry_count_youtube <2:
+    if (not search_results or "No videos found" in search_results) and retry_count_youtube <2 \
+            and time_left(state, "youtube") > 0:
         return "retry"
     return "end"
 
@@ -424,96 +548,169 @@ def should_find_hospital(state:AgentState):
     return "low_severity"
 
 
-def create_response_from_web_search(state:AgentState):
+async def create_response_from_web_search(state:AgentState):
     web_info = state.get('web_info', '')
     query = state.get('full_query', '')
     prompt = f"""Using the following context: {web_info}, provide a detailed and comprehensive response to the user query: "{query}". Focus on offering practical and actionable support for someone already facing the issue. Avoid mentioning precautions unless explicitly relevant to resolving the problem. Ensure your answer is clear, accurate, and concise, and limit it in a range of 400-1000 words."""
-    response = llm_70b.invoke([HumanMessage(content=prompt)])
-    return {"web_answer" : response.content}
+    response, _ = await model_router.ainvoke("create_response_from_web_search", [HumanMessage(content=prompt)])
+    return {"web_answer" : response}
 
 
-def search_youtube_videos(state:AgentState) -> str:
-    """
-    Cerca video su YouTube da una lista certificata di canali affidabili.
+# In ordine di preferenza: a parità di pertinenza vince il video del canale precedente
+ALLOWED_CHANNELS = ['UCwywRelPfy7U8jAI312J_Xw', #First Aid,
+                    'UCQK834Q3xqlo85LJqrEd7fw' #ChatterDocs
+                    ]  #'UCTVZkcCKSqFD0TTJ8BjYLDQ' Croce Rossa, 
+YOUTUBE_MAX_RESULTS = 3
+YOUTUBE_TIMEOUT_S = 10
 
-    Args:
-        query (str): Una versione semplificata e in inglese, adatta per una ricerca su youtube, della query di ricerca fornita dall'utente.
-
-    Returns:
-        str: Un di link utile rispetto alla query, o un messaggio che indica che non sono stati trovati video.
-    """
-    #log_state("search_youtube_videos", state)
-    keywords = state['keywords_youtube']
-    print(f"keywords: {keywords}")
-    if not isinstance(keywords, str):
-        return "Nessun video pertinente trovato per la query specificata nei canali consentiti."
-    YOUTUBE_SEARCH_URL = "https://www.googleapis.com/youtube/v3/search"
-    allowed_channels=['UCwywRelPfy7U8jAI312J_Xw', #First Aid,
-                      'UCQK834Q3xqlo85LJqrEd7fw' #ChatterDocs
-                      ]  #'UCTVZkcCKSqFD0TTJ8BjYLDQ' Croce Rossa, 
-    max_results = 3
-    prompt = """
-    You are tasked with determining if a YouTube video is relevant to a described medical situation. The situation provides details about a **medical problem affecting a person**. Analyze the situation and the video title, and decide if the video could be useful. Respond strictly with "YES" or "NO". Do not provide explanations or additional information.
+VIDEO_RANKING_PROMPT = """
+    You are tasked with determining which YouTube videos are relevant to a described medical situation. The situation provides details about a **medical problem affecting a person**. Analyze the situation and the numbered video titles, and decide which videos could be useful.
 
     ### Guidelines:
     1. Assume the described situation pertains to a medical issue involving a person unless explicitly stated otherwise.
-    2. Focus only on the **relevance** of the video to the medical situation described.
-    3. Base your decision solely on the details provided in the medical situation and the video title.
-    4. Respond with **"YES"** or **"NO"** only. Do not provide any explanations.
-
-    ### Input Format:
-    - Medical Situation: [Description of the patient's medical situation]
-    - Video Title: [Title of the YouTube video]
+    2. Focus only on the **relevance** of each video to the medical situation described.
+    3. Base your decision solely on the details provided in the medical situation and the video titles.
+    4. Rank only the relevant videos, most useful first. Leave out every video that is not relevant.
+    5. Set "confident" to true only if the first video in the ranking clearly addresses the situation.
 
     ### Output Format:
-    - "YES" or "NO"
+    Return strictly a JSON object, without any other text:
+    {{"ranking": [numbers of the relevant videos, most useful first], "confident": true or false}}
 
     ### Examples:
-    - Medical Situation: "The patient was stung by a bee and has never had allergic reactions or symptoms such as swelling, itching, or difficulty breathing after being stung by an insect in the past."
-      Video Title: "First Aid for Bee Stings"
-      Output: "YES"
-
     - Medical Situation: "The patient was stung by a bee, but suffers from severe seasonal allergies."
-      Video Title: "How to Treat Seasonal Allergies"
-      Output: "NO"
+      Videos:
+      1. How to Treat Seasonal Allergies
+      2. First Aid for Bee Stings
+      Output: {{"ranking": [2], "confident": true}}
 
     - Medical Situation: "The patient accidentally cut their hand with a knife and is experiencing minor bleeding."
-      Video Title: "Emergency Care for Cuts"
-      Output: "YES"
-
-    - Medical Situation: "A person is having a heart attack."
-      Video Title: "First Aid - Heart Attack"
-      Output: "YES"
+      Videos:
+      1. First Aid - Heart Attack
+      2. How to Treat Seasonal Allergies
+      Output: {{"ranking": [], "confident": false}}
 
     ### Now process the following input:
-    Medical Situation: {query}  
-    Video Title: {video_title}
+    Medical Situation: {query}
+    Videos:
+    {videos}
     """
-    try:
-        for channel_id in allowed_channels:
-            params = {
-                "part": "snippet",
-                "q": keywords,
-                "channelId": channel_id,
-                "maxResults": max_results,
-                "type": "video",
-                "key": state['youtube_api_key'],
-            }
 
-            response = requests.get(YOUTUBE_SEARCH_URL, params=params)
-            data = response.json()
-
-            # Controlla se ci sono risultati
-            if "items" in data and len(data["items"]) > 0:
-                for item in data["items"]:
-                    video_id = item["id"]["videoId"]
-                    video_title = item["snippet"]["title"]
-                    response = llm_70b.invoke([HumanMessage(content=prompt.format(query=state['full_query'], video_title=video_title))]).content
-                    if response.strip().lower() == 'yes':
-                        return {"search_results": f"https://www.youtube.com/watch?v={video_id}",
-                                "video_title": video_title}
-    except requests.exceptions.RequestException as e:
-        return {"search_results": f"Error during YouTube search: {str(e)}", "video_title": None}
+
+def parse_video_ranking(response: str, n_videos: int) -> tuple:
+    """
+    Returns:
+        tuple: (indici 0-based dei video pertinenti in ordine di pertinenza, confident)
+    """
+    result = json.loads(response)
+    ranking = result.get("ranking") if isinstance(result, dict) else None
+    if not isinstance(ranking, list) or not all(isinstance(i, int) and 1 <= i <= n_videos for i in ranking):
+        raise ValueError(f"Invalid video ranking: {ranking!r}")
+    return list(dict.fromkeys(i - 1 for i in ranking)), bool(result.get("confident")) and bool(ranking)
+
+
+async def rank_videos(query: str, video_titles: list) -> tuple:
+    """
+    Valuta tutti i titoli candidati con un'unica chiamata al modello del nodo "video_ranking".
+
+    Returns:
+        tuple: (indici dei video pertinenti, il più utile per primo; True se il primo è una corrispondenza sicura)
+    """
+    videos = "\n    ".join(f"{i}. {title}" for i, title in enumerate(video_titles, start=1))
+    prompt = VIDEO_RANKING_PROMPT.format(query=query, videos=videos)
+    _, (ranking, confident) = await model_router.ainvoke(
+        "video_ranking", [HumanMessage(content=prompt)], validate=lambda response: parse_video_ranking(response, len(video_titles)),
+        fields=[["ranking", "confident"]]
+    )
+    return ranking, confident
+
+
+def _search_channel(channel_id: str, keywords: str, api_key: str) -> list:
+    params = {
+        "part": "snippet",
+        "q": keywords,
+        "channelId": channel_id,
+        "maxResults": YOUTUBE_MAX_RESULTS,
+        "type": "video",
+        "key": api_key,
+    }
+    with tracer.span("youtube_search", "http") as span:
+        response = requests.get(service_url(YOUTUBE_SEARCH_URL), params=params, timeout=YOUTUBE_TIMEOUT_S)
+        span.set(status_code=response.status_code)
+    data = response.json()
+    return [(item["id"]["videoId"], item["snippet"]["title"]) for item in data.get("items", [])]
+
+
+def _ordered_candidates(videos_by_channel: dict) -> list:
+    # Candidati in ordine di preferenza del canale, senza duplicati
+    candidates, seen = [], set()
+    for channel_id in ALLOWED_CHANNELS:
+        for video_id, title in videos_by_channel.get(channel_id, []):
+            if video_id not in seen:
+                seen.add(video_id)
+                candidates.append((video_id, title))
+    return candidates
+
+
+async def search_youtube_videos(state:AgentState) -> str:
+    """
+    Cerca video su YouTube da una lista certificata di canali affidabili.
+
+    Le ricerche sui canali partono in parallelo; i titoli trovati vengono valutati insieme con una sola
+    chiamata al modello. Se i risultati del primo canale contengono già una corrispondenza sicura, le
+    ricerche ancora in corso vengono abbandonate.
+
+    Args:
+        query (str): Una versione semplificata e in inglese, adatta per una ricerca su youtube, della query di ricerca fornita dall'utente.
+
+    Returns:
+        str: Un di link utile rispetto alla query, o un messaggio che indica che non sono stati trovati video.
+    """
+    keywords = state['keywords_youtube']
+    print(f"keywords: {keywords}")
+    if not isinstance(keywords, str):
+        return {"search_results": "Nessun video pertinente trovato per la query specificata nei canali consentiti.", "video_title": None}
+
+    async def search(channel_id):
+        # La richiesta HTTP bloccante gira fuori dall'event loop del grafo, una per canale
+        return channel_id, await asyncio.to_thread(_search_channel, channel_id, keywords, state['youtube_api_key'])
+
+    searches = [asyncio.create_task(search(channel_id)) for channel_id in ALLOWED_CHANNELS]
+    videos_by_channel = {}
+    errors = []
+    ranked_candidates = None
+    ranking = []
+    try:
+        for completed, next_search in enumerate(asyncio.as_completed(searches), start=1):
+            try:
+                channel_id, videos = await next_search
+                videos_by_channel[channel_id] = videos
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                errors.append(e)
+            candidates = _ordered_candidates(videos_by_channel)
+            if not candidates or candidates == ranked_candidates:
+                continue
+            ranked_candidates = candidates
+            try:
+                ranking, confident = await rank_videos(state['full_query'], [title for _, title in candidates])
+            except ValueError as e:
+                # Classifica non valida anche dopo l'escalation: nessun video scelto su questi candidati
+                print(f"Invalid video ranking: {e}")
+                ranking, confident = [], False
+            print(f"Video ranking over {len(candidates)} candidates: {ranking} (confident: {confident})")
+            pending = len(searches) - completed
+            if confident and pending:
+                print(f"Confident video match, skipping {pending} pending channel searches")
+                break
+    finally:
+        for task in searches:
+            task.cancel()
+
+    if ranking:
+        video_id, video_title = ranked_candidates[ranking[0]]
+        return {"search_results": f"https://www.youtube.com/watch?v={video_id}", "video_title": video_title}
+    if errors and len(errors) == len(ALLOWED_CHANNELS):
+        return {"search_results": f"Error during YouTube search: {str(errors[0])}", "video_title": None}
     return {"search_results": "No relevant videos found for the given query on the allowed channels.", "video_title": None}
 
 
@@ -529,8 +726,14 @@ def get_google_maps_url(state:AgentState):
     Returns:
         dict: Informazioni sull'ospedale più vicino o un messaggio di errore.
     """
+    # Ricerca già avviata durante il triage per la stessa posizione
+    if state.get('prefetch'):
+        hospital = state['prefetch'].result("hospital", tuple(state['user_location']))
+        if hospital is not None:
+            return hospital
+
     # URL dell'API di Google Places
-    places_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+    places_url = service_url(PLACES_NEARBY_URL)
 
     lat, lng = state['user_location']
     google_maps_api_key = state['google_maps_api_key']
@@ -544,7 +747,9 @@ def get_google_maps_url(state:AgentState):
 
     try:
         # Invia la richiesta
-        response = requests.get(places_url, params=params)
+        with tracer.span("places_nearby", "http") as span:
+            response = requests.get(places_url, params=params)
+            span.set(status_code=response.status_code)
         data = response.json()
 
         # Controlla se ci sono risultati
@@ -577,7 +782,7 @@ def combine_results(state:AgentState):
     else:
         doc_answer = state.get("rag_answer", "")
     
-    return {"final_result": [doc_answer, google_maps_url, hospital_name, video_result, video_title]}
+    return {"final_result": [doc_answer, google_maps_url, hospital_name, video_result, video_title, state.get("medical_class")]}
 
 
 def create_emergency_agent():
@@ -585,17 +790,18 @@ def create_emergency_agent():
     graph = StateGraph(AgentState)
 
     # Nodo iniziale per avviare i flussi paralleli
-    graph.add_node("start_emergency_bot", start_emergency_bot)
+    graph.add_node("start_emergency_bot", traced_node("start_emergency_bot", start_emergency_bot))
 
     # Setta "start_emergency_bot" come entry point
     graph.set_entry_point("start_emergency_bot")
 
     # Aggiunta dei nodi
-    graph.add_node("extract_keywords_youtube", extract_keywords_youtube)
-    graph.add_node("search_youtube_videos", search_youtube_videos)
-    graph.add_node("answer_from_rag", answer_from_rag)
-    graph.add_node("web_search", web_search)
-    graph.add_node("create_response_from_web_search", create_response_from_web_search)
+    graph.add_node("analyze_query", traced_node("analyze_query", analyze_query))
+    graph.add_node("extract_keywords_youtube", traced_node("extract_keywords_youtube", extract_keywords_youtube))
+    graph.add_node("search_youtube_videos", traced_node("search_youtube_videos", search_youtube_videos))
+    graph.add_node("answer_from_rag", traced_node("answer_from_rag", answer_from_rag))
+    graph.add_node("web_search", traced_node("web_search", web_search))
+    graph.add_node("create_response_from_web_search", traced_node("create_response_from_web_search", create_response_from_web_search))
 
 
     graph.add_edge("extract_keywords_youtube", "search_youtube_videos")
@@ -609,10 +815,10 @@ def create_emergency_agent():
     )
 
     # Secondo agente (Location)
-    graph.add_node("get_google_maps_url", get_google_maps_url)
+    graph.add_node("get_google_maps_url", traced_node("get_google_maps_url", get_google_maps_url))
 
     # Terzo agente (Combinazione risultati)
-    graph.add_node("combine_results", combine_results)
+    graph.add_node("combine_results", traced_node("combine_results", combine_results))
 
     # Integrazione flussi paralleli
     graph.add_edge("get_google_maps_url", "combine_results")
@@ -620,12 +826,12 @@ def create_emergency_agent():
         "answer_from_rag",
         should_web_search,
         {
-            "web_search": "extract_keywords_web_search",
+            "web_search": "web_search",
             "end": "combine_results",
         }
     )
 
-    graph.add_node("extract_keywords_web_search", extract_keywords_web_search)
+    graph.add_node("extract_keywords_web_search", traced_node("extract_keywords_web_search", extract_keywords_web_search))
     graph.add_edge("extract_keywords_web_search", "web_search")
     graph.add_conditional_edges(
         "web_search",
@@ -638,7 +844,12 @@ def create_emergency_agent():
     graph.add_edge("create_response_from_web_search", "combine_results")
 
     # Collegamenti ai flussi paralleli
-    graph.add_edge("start_emergency_bot", "extract_keywords_youtube")
+    graph.add_edge("start_emergency_bot", "analyze_query")
+    graph.add_conditional_edges(
+        "analyze_query",
+        route_analysis,
+        ["search_youtube_videos", "extract_keywords_youtube", "get_google_maps_url"]
+    )
     graph.add_conditional_edges(
         "start_emergency_bot",
         should_find_hospital,
@@ -651,12 +862,7 @@ def create_emergency_agent():
 
     graph.set_finish_point("combine_results")
 
-    # Compilazione del grafo
+    # Compilazione del grafo (le immagini si generano a parte: python -m src.render_graphs)
     app = graph.compile()
-    
-    # Store the image in memory using BytesIO
-    img_bytes = app.get_graph().draw_mermaid_png()
-    with open('presentation/agents/specialized.png', 'wb') as f:
-        f.write(img_bytes)
 
     return app
\ No newline at end of file
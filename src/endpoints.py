@@ -0,0 +1,28 @@
+"""
+Indirizzi dei servizi esterni usati dall'app (Groq, OpenAI, Serper, YouTube, Google Places).
+
+Con la variabile d'ambiente STANDIN_SERVER_URL (es. http://127.0.0.1:8765) tutte le richieste vanno al
+server sostitutivo locale di benchmarks/standin_server.py, mantenendo il percorso dell'endpoint originale:
+così la pipeline completa triage → emergenza gira offline, senza chiavi reali.
+"""
+import os
+from typing import Optional
+from urllib.parse import urlsplit
+
+
+GROQ_API_URL = "https://api.groq.com"
+OPENAI_API_URL = "https://api.openai.com/v1"
+SERPER_SEARCH_URL = "https://google.serper.dev/search"
+YOUTUBE_SEARCH_URL = "https://www.googleapis.com/youtube/v3/search"
+PLACES_NEARBY_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+
+
+def standin_server_url() -> Optional[str]:
+    """L'indirizzo del server sostitutivo, o None se si usano i servizi reali. Letto a ogni chiamata."""
+    return os.environ.get("STANDIN_SERVER_URL", "").rstrip("/") or None
+
+
+def service_url(url: str) -> str:
+    """L'URL da chiamare per un endpoint esterno: quello reale, o lo stesso percorso sul server sostitutivo."""
+    standin = standin_server_url()
+    return standin + urlsplit(url).path if standin else url
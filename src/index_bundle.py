@@ -0,0 +1,357 @@
+"""
+Build offline e validazione dei bundle di retrieval (BM25 + FAISS) per i corpora triage ed emergency.
+
+Uso:
+    python -m src.index_bundle build [--corpus triage emergency] [--embedding-model MODEL] [--force]
+                                     [--vector-index flat|hnsw|hnsw-sq8|ivf-sq8|ivf-pq] [--ef-search N] [--nprobe N]
+    python -m src.index_bundle verify [--corpus triage emergency]
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+
+
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_ROOT = "data/index_bundle"
+MANIFEST_FILE = "manifest.json"
+BM25_DIR = "bm25"
+FAISS_DIR = "faiss"
+DEFAULT_EMBEDDING_MODEL = "openai:text-embedding-ada-002"
+
+# Sorgenti e funzioni di chunking di ciascun corpus: il loro hash fa parte del manifest.
+# chunker_dependencies sono moduli usati dal chunking e inclusi per intero (lettura del PDF).
+CORPORA = {
+    "triage": {
+        "pdf_path": "data/doc_triage/pdf/Manuale-Triage.pdf",
+        "chunker_module": "src/triage_utils.py",
+        "chunker_functions": ["process_pdf_triage", "process_pages"],
+        "chunker_dependencies": ["src/ingestion.py"],
+    },
+    "emergency": {
+        "pdf_path": "data/doc_emergency/pdf/manuale_primo_soccorso.pdf",
+        "chunker_module": "src/emergency_utils.py",
+        "chunker_functions": ["process_pdf_emergency", "chunk_emergency_pages", "_organize_sections"],
+        "chunker_dependencies": ["src/ingestion.py"],
+    },
+}
+
+
+class IndexBundleError(Exception):
+    """Bundle mancante, incompleto o non coerente con il proprio manifest."""
+
+
+def file_sha256(file_path: str) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _top_level_definitions(tree: ast.Module) -> dict:
+    # Funzioni, classi e assegnazioni a livello di modulo (es. pattern precompilati), per nome
+    definitions = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            definitions[node.name] = node
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        definitions[name.id] = node
+    return definitions
+
+
+def chunker_version(module_path: str, function_names: list, dependencies: list = ()) -> str:
+    """
+    Hash del codice sorgente delle funzioni di chunking, letto via AST senza importare il modulo.
+
+    Oltre alle funzioni indicate include le definizioni del modulo che usano, anche indirettamente
+    (pattern precompilati, classi e funzioni di supporto), e il sorgente completo dei moduli in dependencies.
+    """
+    with open(module_path, "r") as f:
+        source = f.read()
+    definitions = _top_level_definitions(ast.parse(source))
+    missing = [name for name in function_names if not isinstance(definitions.get(name), ast.FunctionDef)]
+    if missing:
+        raise IndexBundleError(f"Chunker functions not found in {module_path}: {sorted(missing)}")
+    # Chiusura delle definizioni raggiungibili dalle funzioni di chunking, in ordine di visita
+    used, queue = [], [definitions[name] for name in function_names]
+    while queue:
+        node = queue.pop(0)
+        if node in used:
+            continue
+        used.append(node)
+        queue += [definitions[name.id] for name in ast.walk(node)
+                  if isinstance(name, ast.Name) and name.id in definitions]
+    sha = hashlib.sha256()
+    for node in used:
+        sha.update(ast.get_source_segment(source, node).encode("utf-8"))
+    for dependency in dependencies:
+        with open(dependency, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def compute_inputs(corpus: str, embedding_model: str = DEFAULT_EMBEDDING_MODEL, vector_index: dict = None) -> dict:
+    config = CORPORA[corpus]
+    pdf_path = config["pdf_path"]
+    inputs = {
+        "source_pdf_sha256": file_sha256(pdf_path) if os.path.exists(pdf_path) else None,
+        "chunker_version": chunker_version(config["chunker_module"], config["chunker_functions"],
+                                           config.get("chunker_dependencies", [])),
+        "embedding_model": embedding_model,
+    }
+    # L'indice flat non compare negli input: i bundle costruiti prima delle modalità ANN restano validi
+    if vector_index is not None:
+        inputs["vector_index"] = vector_index
+    return inputs
+
+
+def _changed_inputs(previous: dict, inputs: dict) -> list:
+    keys = list(inputs) + [key for key in previous if key not in inputs]
+    return [
+        key for key in keys
+        if previous.get(key) != inputs.get(key) and not (key == "source_pdf_sha256" and inputs.get(key) is None)
+    ]
+
+
+def bundle_path(corpus: str, bundle_root: str = BUNDLE_ROOT) -> str:
+    return os.path.join(bundle_root, corpus)
+
+
+def _bundle_files(bundle_dir: str) -> dict:
+    files = {}
+    for root, _, names in os.walk(bundle_dir):
+        for name in sorted(names):
+            rel_path = os.path.relpath(os.path.join(root, name), bundle_dir)
+            if rel_path != MANIFEST_FILE:
+                files[rel_path] = file_sha256(os.path.join(root, name))
+    return dict(sorted(files.items()))
+
+
+def write_manifest(bundle_dir: str, corpus: str, inputs: dict) -> dict:
+    # La versione del bundle dipende solo dagli input: stesso input, stessa versione
+    bundle_version = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    manifest = {
+        "bundle_format": BUNDLE_FORMAT_VERSION,
+        "corpus": corpus,
+        "bundle_version": bundle_version,
+        "built_at": datetime.now().isoformat(),
+        "inputs": inputs,
+        "files": _bundle_files(bundle_dir),
+    }
+    with open(os.path.join(bundle_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def read_manifest(bundle_dir: str) -> dict:
+    manifest_path = os.path.join(bundle_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise IndexBundleError(f"Missing manifest in {bundle_dir}. Run: python -m src.index_bundle build")
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def validate_bundle(bundle_dir: str) -> dict:
+    """
+    Verifica formato e checksum di tutti i file elencati nel manifest.
+
+    Returns:
+        dict: Il manifest del bundle.
+    """
+    manifest = read_manifest(bundle_dir)
+    if manifest.get("bundle_format") != BUNDLE_FORMAT_VERSION:
+        raise IndexBundleError(f"Unsupported bundle format in {bundle_dir}: {manifest.get('bundle_format')}")
+    for rel_path, expected_sha in manifest["files"].items():
+        file_path = os.path.join(bundle_dir, rel_path)
+        if not os.path.exists(file_path):
+            raise IndexBundleError(f"Bundle file missing: {file_path}")
+        if file_sha256(file_path) != expected_sha:
+            raise IndexBundleError(f"Checksum mismatch for {file_path}")
+    return manifest
+
+
+def load_index_bundle(corpus: str, bundle_root: str = BUNDLE_ROOT):
+    """
+    Valida il bundle di un corpus e restituisce i percorsi degli indici, senza mai ricostruirli.
+
+    Returns:
+        tuple: (manifest, percorso indice BM25, percorso indice FAISS)
+    """
+    bundle_dir = bundle_path(corpus, bundle_root)
+    manifest = validate_bundle(bundle_dir)
+    print(f"Loaded {corpus} index bundle {manifest['bundle_version']}")
+    return manifest, os.path.join(bundle_dir, BM25_DIR), os.path.join(bundle_dir, FAISS_DIR)
+
+
+def _load_documents(corpus: str, pdf_path: str):
+    # Import ritardati: servono solo in fase di build
+    if corpus == "triage":
+        from src.triage_utils import process_pdf_triage
+        return process_pdf_triage(pdf_path)
+    from src.emergency_utils import process_pdf_emergency
+    return process_pdf_emergency(pdf_path)
+
+
+def _reindex_bundle(corpus: str, bundle_dir: str, manifest: dict, vector_index: dict) -> dict:
+    """
+    Ricostruisce solo l'indice FAISS di un bundle esistente nella nuova modalità, riusando i vettori
+    già salvati: non servono né il PDF né il ricalcolo degli embedding.
+    """
+    from src.vector_index import load_faiss_store, reindex_store
+
+    tmp_dir = f"{bundle_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    shutil.copytree(bundle_dir, tmp_dir, ignore=shutil.ignore_patterns(MANIFEST_FILE))
+    vectorstore = load_faiss_store(os.path.join(bundle_dir, FAISS_DIR), None, mmap=False)
+    reindex_store(vectorstore, vector_index)
+    vectorstore.save_local(os.path.join(tmp_dir, FAISS_DIR))
+
+    inputs = {key: value for key, value in manifest["inputs"].items() if key != "vector_index"}
+    if vector_index is not None:
+        inputs["vector_index"] = vector_index
+    new_manifest = write_manifest(tmp_dir, corpus, inputs)
+    shutil.rmtree(bundle_dir)
+    os.replace(tmp_dir, bundle_dir)
+    mode = vector_index["mode"] if vector_index else "flat"
+    print(f"{corpus}: rebuilt {mode} vector index, bundle {new_manifest['bundle_version']}")
+    return new_manifest
+
+
+def _same_documents(bm25_dir: str, documents: list) -> bool:
+    # Confronta i chunk appena calcolati con quelli salvati nell'indice BM25 del bundle
+    from src.bm25_index import MmapBM25Index
+    index = MmapBM25Index(bm25_dir)
+    if index.n_docs != len(documents):
+        return False
+    for doc_id, document in enumerate(documents):
+        stored = index.get_document(doc_id)
+        if stored.page_content != document.page_content or stored.metadata != document.metadata:
+            return False
+    return True
+
+
+def build_bundle(corpus: str, bundle_root: str = BUNDLE_ROOT, embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+                 force: bool = False, vector_index: dict = None) -> dict:
+    """
+    Costruisce BM25 e FAISS di un corpus in un unico bundle, solo se un input è cambiato.
+    Se cambia solo la modalità dell'indice vettoriale, l'indice FAISS viene ricostruito dai vettori salvati.
+
+    Args:
+        corpus (str): "triage" o "emergency".
+        bundle_root (str): Cartella radice dei bundle.
+        embedding_model (str): Provider e modello di embedding, es. "local:<modello sentence-transformers>".
+        force (bool): Ricostruisce anche se gli input non sono cambiati.
+        vector_index (dict): Modalità e parametri dell'indice FAISS (vedi vector_index_config); None per flat.
+
+    Returns:
+        dict: Il manifest del bundle risultante.
+    """
+    from src.bm25_index import build_bm25_index
+    from src.embeddings import EMBEDDING_CACHE_PATH, get_embeddings
+    from src.vector_index import LOSSLESS_MODES, reindex_store
+    from langchain_community.vectorstores import FAISS
+
+    bundle_dir = bundle_path(corpus, bundle_root)
+    inputs = compute_inputs(corpus, embedding_model, vector_index)
+    pdf_path = CORPORA[corpus]["pdf_path"]
+
+    if os.path.exists(os.path.join(bundle_dir, MANIFEST_FILE)) and not force:
+        try:
+            manifest = validate_bundle(bundle_dir)
+        except IndexBundleError as e:
+            print(f"{corpus}: existing bundle is invalid ({e}), rebuilding")
+        else:
+            changed = _changed_inputs(manifest["inputs"], inputs)
+            current_mode = (manifest["inputs"].get("vector_index") or {}).get("mode", "flat")
+            if "vector_index" in changed and current_mode in LOSSLESS_MODES and (
+                    changed == ["vector_index"] or inputs["source_pdf_sha256"] is None):
+                return _reindex_bundle(corpus, bundle_dir, manifest, vector_index)
+            if inputs["source_pdf_sha256"] is None:
+                if "vector_index" in changed:
+                    print(f"{corpus}: the {current_mode} index does not keep the original vectors, "
+                          f"a new vector index needs the source PDF")
+                print(f"{corpus}: source PDF {pdf_path} not found, keeping bundle {manifest['bundle_version']}")
+                return manifest
+            if not changed:
+                print(f"{corpus}: bundle {manifest['bundle_version']} is up to date")
+                return manifest
+            if changed == ["chunker_version"]:
+                # Codice di chunking cambiato: se i chunk sono gli stessi si aggiorna solo il manifest,
+                # senza ricalcolare gli embedding
+                documents = _load_documents(corpus, pdf_path)
+                if _same_documents(os.path.join(bundle_dir, BM25_DIR), documents):
+                    manifest = write_manifest(bundle_dir, corpus, inputs)
+                    print(f"{corpus}: chunker changed but produces the same {len(documents)} documents, "
+                          f"manifest updated to bundle {manifest['bundle_version']}")
+                    return manifest
+            print(f"{corpus}: inputs changed ({', '.join(changed)}), rebuilding")
+
+    if inputs["source_pdf_sha256"] is None:
+        raise IndexBundleError(f"Source PDF not found: {pdf_path}")
+
+    documents = _load_documents(corpus, pdf_path)
+
+    tmp_dir = f"{bundle_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    build_bm25_index(documents, os.path.join(tmp_dir, BM25_DIR))
+    # Gli embedding passano dalla cache su disco: si ricalcolano solo i chunk cambiati
+    embedding = get_embeddings(embedding_model, cache_path=EMBEDDING_CACHE_PATH)
+    vectorstore = FAISS.from_documents(documents, embedding=embedding)
+    if vector_index is not None:
+        reindex_store(vectorstore, vector_index)
+    vectorstore.save_local(os.path.join(tmp_dir, FAISS_DIR))
+
+    manifest = write_manifest(tmp_dir, corpus, inputs)
+    if os.path.exists(bundle_dir):
+        shutil.rmtree(bundle_dir)
+    os.replace(tmp_dir, bundle_dir)
+    print(f"{corpus}: built bundle {manifest['bundle_version']} ({len(documents)} documents)")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or verify the retrieval index bundles.")
+    parser.add_argument("command", choices=["build", "verify"])
+    parser.add_argument("--corpus", nargs="+", choices=list(CORPORA), default=list(CORPORA))
+    parser.add_argument("--bundle-root", default=BUNDLE_ROOT)
+    parser.add_argument("--embedding-model", default=os.environ.get("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL),
+                        help="Embedding provider and model, e.g. openai:text-embedding-ada-002 or local:<model>")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if no input changed")
+    parser.add_argument("--vector-index", default=os.environ.get("VECTOR_INDEX", "flat"),
+                        help="FAISS index mode: flat, hnsw, hnsw-sq8, ivf-sq8 or ivf-pq")
+    parser.add_argument("--hnsw-m", type=int, help="HNSW graph degree")
+    parser.add_argument("--ef-construction", type=int, help="HNSW build-time candidate list size")
+    parser.add_argument("--ef-search", type=int, help="HNSW query-time candidate list size")
+    parser.add_argument("--nlist", type=int, help="IVF clusters (default: 4 * sqrt(n), capped by corpus size)")
+    parser.add_argument("--nprobe", type=int, help="IVF clusters visited per query")
+    parser.add_argument("--pq-m", type=int, help="PQ sub-quantizers (must divide the embedding dimension)")
+    args = parser.parse_args()
+
+    from src.vector_index import vector_index_config
+    vector_index = vector_index_config(
+        args.vector_index, hnsw_m=args.hnsw_m, ef_construction=args.ef_construction, ef_search=args.ef_search,
+        nlist=args.nlist, nprobe=args.nprobe, pq_m=args.pq_m,
+    )
+    for corpus in args.corpus:
+        if args.command == "build":
+            build_bundle(corpus, args.bundle_root, embedding_model=args.embedding_model, force=args.force,
+                         vector_index=vector_index)
+        else:
+            manifest = validate_bundle(bundle_path(corpus, args.bundle_root))
+            print(f"{corpus}: bundle {manifest['bundle_version']} OK ({len(manifest['files'])} files)")
+
+
+if __name__ == "__main__":
+    main()
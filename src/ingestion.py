@@ -0,0 +1,64 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional
+
+from langchain_core.documents import Document
+
+
+PAGES_PER_TASK = 8
+
+
+def _extract_pages(file_path: str, page_numbers: List[int], process_fn: Optional[Callable]) -> List[Document]:
+    """
+    Estrae un gruppo di pagine in un processo worker: ogni worker apre il PDF per conto proprio,
+    così al processo principale non arrivano mai più pagine di quelle in lavorazione.
+    """
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    pages = [
+        Document(page_content=reader.pages[page_number].extract_text(), metadata={"source": file_path, "page": page_number})
+        for page_number in page_numbers
+    ]
+    return process_fn(pages) if process_fn else pages
+
+
+def count_pdf_pages(file_path: str) -> int:
+    from pypdf import PdfReader
+    return len(PdfReader(file_path).pages)
+
+
+def stream_pdf_documents(file_path: str, start: int = 0, end: Optional[int] = None,
+                         process_fn: Optional[Callable[[List[Document]], List[Document]]] = None,
+                         pages_per_task: int = PAGES_PER_TASK, max_workers: Optional[int] = None) -> Iterator[Document]:
+    """
+    Estrae in streaming solo l'intervallo di pagine richiesto di un PDF, su un pool di processi.
+
+    L'estrazione del testo e la funzione di normalizzazione/chunking (process_fn) girano nei worker;
+    i documenti vengono emessi in ordine di pagina e al massimo 2 * max_workers gruppi di pagine
+    sono in memoria contemporaneamente.
+
+    Args:
+        file_path (str): Percorso al file PDF.
+        start (int): Prima pagina (0-based, inclusa).
+        end (int): Ultima pagina (esclusa); None per arrivare alla fine del documento.
+        process_fn (callable): Funzione di modulo (serializzabile) applicata a ogni gruppo di pagine.
+        pages_per_task (int): Numero di pagine per task del pool.
+        max_workers (int): Numero di processi; di default il numero di core.
+
+    Yields:
+        Document: Le pagine (o i chunk restituiti da process_fn), in ordine.
+    """
+    end = count_pdf_pages(file_path) if end is None else end
+    batches = [list(range(i, min(i + pages_per_task, end))) for i in range(start, end, pages_per_task)]
+    max_workers = max_workers or os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(_extract_pages, file_path, batch, process_fn))
+            # Limita i task in volo per non accumulare pagine non ancora consumate
+            if len(pending) >= 2 * max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
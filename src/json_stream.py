@@ -0,0 +1,203 @@
+"""
+Estrazione incrementale di output JSON dai nodi strutturati, con interruzione anticipata della generazione.
+
+Il testo arriva token per token; JSONFieldExtractor riconosce il primo oggetto JSON (ignorando prosa e
+blocchi ``` attorno) e registra i campi di primo livello man mano che i loro valori si chiudono.
+Appena uno dei gruppi di campi richiesti è completo lo stream viene chiuso: il modello smette di
+generare il resto della risposta (spiegazioni, chiusura dell'oggetto, testo dopo il JSON).
+"""
+import json
+from typing import Any, Callable, List, Optional
+
+
+class JSONFieldExtractor:
+    """
+    Parser incrementale dei campi di primo livello di un oggetto JSON immerso in testo libero.
+
+    Args:
+        required (list): Gruppi alternativi di campi, es. [["Summary", "Score"], ["Summary", "Question"]]:
+            l'estrazione è completa quando tutti i campi di almeno un gruppo hanno un valore.
+        on_field (callable): Chiamata con (nome, valore) appena un campo è completo, prima della fine della risposta.
+
+    Se il testo smette di essere JSON valido il parser cerca un nuovo oggetto, ma i campi già notificati a
+    on_field restano in fields (un oggetto successivo può sovrascriverli): il risultato contiene sempre
+    i valori su cui il chiamante può aver già agito.
+    """
+
+    def __init__(self, required: List[List[str]], on_field: Optional[Callable[[str, Any], None]] = None):
+        self.required = [set(group) for group in required]
+        self.on_field = on_field
+        self.text = ""
+        self.fields = {}
+        self._pos = 0
+        self._reset()
+
+    def _reset(self):
+        # Stato del parser: "object" (cerca la "{"), "key", "colon", "value", "scalar", "nested", "after_value", "end"
+        self._expect = "object"
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._value_start = None
+        self._key = None
+
+    @property
+    def complete(self) -> bool:
+        return any(group <= self.fields.keys() for group in self.required)
+
+    def feed(self, text: str) -> bool:
+        """Aggiunge testo e restituisce True se i campi richiesti sono completi."""
+        self.text += text
+        while self._pos < len(self.text) and not self.complete and self._expect != "end":
+            self._step(self.text[self._pos])
+            self._pos += 1
+        return self.complete
+
+    def finish(self) -> bool:
+        """Fine del testo: chiude un eventuale valore scalare rimasto aperto."""
+        if self._expect == "scalar":
+            self._store(self.text[self._value_start:].strip())
+        return self.complete
+
+    def _store(self, raw_value: str):
+        try:
+            # strict=False: i modelli mettono spesso a capo e tabulazioni non escapati dentro le stringhe
+            self.fields[self._key] = json.loads(raw_value, strict=False)
+        except json.JSONDecodeError:
+            self._reset()
+            return
+        self._expect = "after_value"
+        if self.on_field:
+            self.on_field(self._key, self.fields[self._key])
+
+    def _step(self, char: str):
+        position = self._pos
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._expect == "key":
+                    self._key = json.loads(self.text[self._string_start:position + 1], strict=False)
+                    self._expect = "colon"
+                elif self._expect == "value":
+                    self._store(self.text[self._value_start:position + 1])
+            return
+
+        if self._expect == "object":
+            if char == "{":
+                self._expect, self._depth = "key", 1
+        elif self._expect == "nested":
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 1:
+                    self._store(self.text[self._value_start:position + 1])
+        elif char.isspace():
+            if self._expect == "scalar":
+                self._store(self.text[self._value_start:position].strip())
+        elif self._expect == "key":
+            if char == '"':
+                self._in_string, self._string_start = True, position
+            elif char == "}":
+                self._expect = "end"
+            elif char != ",":
+                self._reset()
+        elif self._expect == "colon":
+            if char == ":":
+                self._expect = "value"
+            else:
+                self._reset()
+        elif self._expect == "value":
+            self._value_start = position
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._expect, self._depth = "nested", 2
+            else:
+                self._expect = "scalar"
+        elif self._expect == "scalar":
+            if char in ",}":
+                self._store(self.text[self._value_start:position].strip())
+                if self._expect == "after_value":
+                    self._expect = "key" if char == "," else "end"
+        elif self._expect == "after_value":
+            if char == ",":
+                self._expect = "key"
+            elif char == "}":
+                self._expect = "end"
+            else:
+                self._reset()
+
+    def result(self) -> Optional[str]:
+        """I campi estratti come JSON, se completi; altrimenti None."""
+        return json.dumps(self.fields, ensure_ascii=False) if self.complete else None
+
+
+_ROLES = {"human": "user", "ai": "assistant", "system": "system"}
+
+
+def message_dicts(messages) -> list:
+    """Messaggi nel formato dell'API chat da una stringa, da messaggi LangChain o da dizionari."""
+    if isinstance(messages, str):
+        return [{"role": "user", "content": messages}]
+    return [message if isinstance(message, dict) else {"role": _ROLES.get(message.type, "user"), "content": message.content}
+            for message in messages]
+
+
+def _result(model: str, extractor: JSONFieldExtractor, chunks: int) -> str:
+    if extractor.complete:
+        print(f"Structured output from {model} complete after {chunks} chunks, generation stopped")
+    extractor.finish()
+    return extractor.result() or extractor.text.strip()
+
+
+async def astream_json(client, model: str, messages, required: List[List[str]],
+                       on_field: Optional[Callable[[str, Any], None]] = None, **kwargs) -> str:
+    """
+    Genera in streaming e interrompe appena i campi richiesti sono completi.
+
+    Args:
+        client: Client asincrono con `.chat.completions.create` (src.llm_client.get_async_client).
+        model (str): Il nome del modello.
+        messages: Stringa, messaggi LangChain o dizionari.
+        required (list): Gruppi alternativi di campi richiesti (vedi JSONFieldExtractor).
+        on_field (callable): Riceve ogni campo appena completo (vedi JSONFieldExtractor).
+
+    Returns:
+        str: I campi estratti come JSON se completi, altrimenti il testo integrale (da validare a valle).
+    """
+    extractor = JSONFieldExtractor(required, on_field)
+    stream = await client.chat.completions.create(model=model, messages=message_dicts(messages), stream=True, **kwargs)
+    chunks = 0
+    try:
+        async for chunk in stream:
+            chunks += 1
+            if chunk.choices and chunk.choices[0].delta.content and extractor.feed(chunk.choices[0].delta.content):
+                break
+    finally:
+        # Chiudere la risposta HTTP interrompe la generazione lato server
+        await stream.aclose()
+    return _result(model, extractor, chunks)
+
+
+def stream_json(client, model: str, messages, required: List[List[str]],
+                on_field: Optional[Callable[[str, Any], None]] = None, **kwargs) -> str:
+    """Come astream_json, con il client sincrono (src.llm_client.get_sync_client)."""
+    extractor = JSONFieldExtractor(required, on_field)
+    stream = client.chat.completions.create(model=model, messages=message_dicts(messages), stream=True, **kwargs)
+    chunks = 0
+    try:
+        for chunk in stream:
+            chunks += 1
+            if chunk.choices and chunk.choices[0].delta.content and extractor.feed(chunk.choices[0].delta.content):
+                break
+    finally:
+        stream.close()
+    return _result(model, extractor, chunks)
@@ -0,0 +1,304 @@
+"""
+Livello client asincrono unico per tutte le chiamate Groq (chat, trascrizione audio, nodi LangGraph).
+
+Un solo AsyncGroq per processo, con pool di connessioni httpx condiviso, gira su un event loop
+dedicato in un thread di background; un semaforo limita le richieste in volo per processo e un
+rate limiter (src.rate_limiter) mette in coda le richieste oltre la quota dell'account.
+Sopra questo client ci sono:
+  - un'interfaccia sincrona compatibile con groq.Groq (`.chat.completions.create`, `.audio.transcriptions.create`),
+  - un'interfaccia asincrona equivalente, awaitable da qualunque event loop,
+  - ChatGroq (LangChain) che usa le due interfacce, così i nodi dei grafi possono fare `await llm.ainvoke(...)`.
+"""
+import asyncio
+import math
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from src.endpoints import GROQ_API_URL, service_url, standin_server_url
+from src.rate_limiter import (CHARS_PER_TOKEN, LLM_MAX_RETRIES, RateLimiter, backoff_delay, estimate_prompt_tokens,
+                              estimate_tokens, load_rate_limits, retry_after)
+from src.tracing import tracer
+
+# langchain_groq (con langchain_core) si carica alla prima chat_model: non serve per importare il modulo
+if TYPE_CHECKING:
+    from langchain_groq import ChatGroq
+
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "32"))
+LLM_TIMEOUT_S = float(os.environ.get("LLM_TIMEOUT_S", "60"))
+
+
+class LLMClientPool:
+    """
+    Client Groq asincrono condiviso, con connessioni in pool e limite di concorrenza per processo.
+    Ogni chiamata passa dal rate limiter (quota per modello) e, su 429/5xx/errori di connessione,
+    viene ritentata fino a max_retries volte con l'attesa indicata da retry-after o backoff con jitter.
+    """
+
+    def __init__(self, api_key: str, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 max_connections: int = LLM_MAX_CONNECTIONS, timeout: float = LLM_TIMEOUT_S,
+                 rate_limits: dict = None, max_retries: int = LLM_MAX_RETRIES):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.rate_limiter = RateLimiter(rate_limits or load_rate_limits())
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True)
+        self._thread.start()
+        # Client e semaforo vanno creati sul loop che li userà
+        self.run(self._setup())
+
+    async def _setup(self):
+        import httpx
+        from groq import AsyncGroq
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            timeout=self.timeout,
+        )
+        # Senza server sostitutivo vale l'indirizzo predefinito dell'SDK (o GROQ_BASE_URL)
+        base_url = service_url(GROQ_API_URL) if standin_server_url() else None
+        # I retry li gestisce _call, coordinandoli con il rate limiter
+        self._client = AsyncGroq(api_key=self.api_key, base_url=base_url, http_client=self._http_client,
+                                 timeout=self.timeout, max_retries=0)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def run(self, coro):
+        """Esegue una coroutine sul loop del client e ne attende il risultato (interfaccia sincrona)."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def arun(self, coro):
+        """Esegue una coroutine sul loop del client e la attende dal loop del chiamante (interfaccia asincrona)."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._loop))
+
+    async def _call(self, resource: Callable[[Any], Any], kwargs: dict):
+        # Uno span per chiamata, retry compresi; negli stream misura l'apertura (i token arrivano da _StreamUsage)
+        with tracer.span(resource.__name__.strip("_"), "llm", model=kwargs.get("model", ""),
+                         stream=bool(kwargs.get("stream"))) as span:
+            return await self._call_with_retries(resource, kwargs, span)
+
+    async def _call_with_retries(self, resource: Callable[[Any], Any], kwargs: dict, span):
+        import groq
+        model = kwargs.get("model", "")
+        tokens = estimate_tokens(kwargs)
+        for attempt in range(self.max_retries + 1):
+            span.set(retries=attempt)
+            await self.rate_limiter.acquire(model, tokens)
+            error = None
+            async with self._semaphore:
+                self.in_flight += 1
+                try:
+                    result = await resource(self._client).create(**kwargs)
+                except (groq.RateLimitError, groq.InternalServerError, groq.APIConnectionError) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    error = e
+                finally:
+                    self.in_flight -= 1
+            if error is None:
+                # Si corregge la stima con l'uso reale, quando la risposta lo riporta (negli stream lo fa _StreamUsage)
+                usage = getattr(result, "usage", None)
+                if usage is not None and tokens:
+                    self.rate_limiter.adjust(model, usage.total_tokens - tokens)
+                if usage is not None:
+                    span.set(prompt_tokens=getattr(usage, "prompt_tokens", None),
+                             completion_tokens=getattr(usage, "completion_tokens", None))
+                return result
+
+            response = getattr(error, "response", None)
+            delay = backoff_delay(attempt, retry_after(response.headers if response is not None else None))
+            # La richiesta respinta non ha consumato i token stimati
+            self.rate_limiter.adjust(model, -tokens)
+            self.rate_limiter.record_retry()
+            print(f"LLM call to {model} failed ({type(error).__name__}), retry {attempt + 1} in {delay:.2f}s")
+            if isinstance(error, groq.RateLimitError):
+                # Tutte le richieste in coda per il modello attendono, non solo questa
+                self.rate_limiter.pause(model, delay)
+            else:
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, **self.rate_limiter.stats()}
+
+    def close(self):
+        async def _close():
+            await self._http_client.aclose()
+        self.run(_close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class _StreamUsage:
+    """
+    Uso reale dei token di una richiesta in streaming, per correggere la stima addebitata al rate limiter.
+    Va usato dal loop del pool, come il rate limiter.
+    """
+
+    def __init__(self, pool: LLMClientPool, kwargs: dict):
+        self._rate_limiter = pool.rate_limiter
+        self._model = kwargs.get("model", "")
+        self._estimate = estimate_tokens(kwargs)
+        self._prompt_tokens = estimate_prompt_tokens(kwargs)
+        self._completion_chars = 0
+        self._settled = False
+
+    def observe(self, chunk):
+        # Groq riporta l'uso dei token nell'ultimo chunk (x_groq.usage); gli stream interrotti non lo hanno
+        usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+        if usage is not None:
+            tracer.record_tokens(getattr(chunk, "model", ""), getattr(usage, "prompt_tokens", None),
+                                 getattr(usage, "completion_tokens", None))
+            total = getattr(usage, "total_tokens", None)
+            if total is not None:
+                self._settle(total)
+            return
+        for choice in getattr(chunk, "choices", None) or []:
+            self._completion_chars += len(getattr(choice.delta, "content", None) or "")
+
+    def close(self):
+        """Fine dello stream senza uso riportato (es. interrotto in anticipo): si restituisce la stima non generata."""
+        self._settle(self._prompt_tokens + math.ceil(self._completion_chars / CHARS_PER_TOKEN))
+
+    def _settle(self, tokens: int):
+        if not self._settled and self._estimate:
+            self._rate_limiter.adjust(self._model, tokens - self._estimate)
+        self._settled = True
+
+
+async def _next_chunk(stream, usage: _StreamUsage):
+    # (True, chunk) o (False, None) a fine stream: StopAsyncIteration non attraversa bene i future
+    try:
+        chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        usage.close()
+        return False, None
+    usage.observe(chunk)
+    return True, chunk
+
+
+async def _close_stream(stream, usage: _StreamUsage):
+    await stream.close()
+    usage.close()
+
+
+class _AsyncStream:
+    """Stream di chunk prodotto sul loop del client, iterabile con async for da un altro loop."""
+
+    def __init__(self, pool: LLMClientPool, stream, usage: _StreamUsage):
+        self._pool = pool
+        self._stream = stream
+        self._usage = usage
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        has_chunk, chunk = await self._pool.arun(_next_chunk(self._stream, self._usage))
+        if not has_chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    async def aclose(self):
+        """Chiude la risposta HTTP prima della fine: il server smette di generare."""
+        await self._pool.arun(_close_stream(self._stream, self._usage))
+
+
+def _iter_stream(pool: LLMClientPool, stream, usage: _StreamUsage):
+    try:
+        while True:
+            has_chunk, chunk = pool.run(_next_chunk(stream, usage))
+            if not has_chunk:
+                return
+            yield chunk
+    finally:
+        # Anche quando il chiamante interrompe l'iterazione (close() del generatore)
+        pool.run(_close_stream(stream, usage))
+
+
+class _SyncResource:
+    def __init__(self, pool: LLMClientPool, resource: Callable[[Any], Any]):
+        self._pool = pool
+        self._resource = resource
+
+    def create(self, **kwargs):
+        result = self._pool.run(self._pool._call(self._resource, kwargs))
+        return _iter_stream(self._pool, result, _StreamUsage(self._pool, kwargs)) if kwargs.get("stream") else result
+
+
+class _AsyncResource:
+    def __init__(self, pool: LLMClientPool, resource: Callable[[Any], Any]):
+        self._pool = pool
+        self._resource = resource
+
+    async def create(self, **kwargs):
+        result = await self._pool.arun(self._pool._call(self._resource, kwargs))
+        return _AsyncStream(self._pool, result, _StreamUsage(self._pool, kwargs)) if kwargs.get("stream") else result
+
+
+class _Namespace:
+    def __init__(self, **resources):
+        self.__dict__.update(resources)
+
+
+def _chat_completions(client):
+    return client.chat.completions
+
+
+def _audio_transcriptions(client):
+    return client.audio.transcriptions
+
+
+class GroqFacade:
+    """
+    Stessa forma di groq.Groq / groq.AsyncGroq per le risorse usate dall'app, instradate sul pool condiviso.
+    """
+
+    def __init__(self, pool: LLMClientPool, resource_class):
+        self.pool = pool
+        self.chat = _Namespace(completions=resource_class(pool, _chat_completions))
+        self.audio = _Namespace(transcriptions=resource_class(pool, _audio_transcriptions))
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_llm_pool(api_key: str) -> LLMClientPool:
+    """Il pool del processo per una chiave API: creato alla prima richiesta e poi riusato."""
+    with _pools_lock:
+        if api_key not in _pools:
+            _pools[api_key] = LLMClientPool(api_key)
+        return _pools[api_key]
+
+
+def get_sync_client(api_key: str) -> GroqFacade:
+    return GroqFacade(get_llm_pool(api_key), _SyncResource)
+
+
+def get_async_client(api_key: str) -> GroqFacade:
+    return GroqFacade(get_llm_pool(api_key), _AsyncResource)
+
+
+def chat_model(model: str, api_key: str, **kwargs) -> "ChatGroq":
+    """
+    ChatGroq che condivide il pool del processo sia per invoke che per ainvoke/astream.
+
+    Args:
+        model (str): Nome del modello Groq.
+        api_key (str): Chiave API Groq.
+
+    Returns:
+        ChatGroq: Il modello di chat LangChain.
+    """
+    from langchain_groq import ChatGroq
+    pool = get_llm_pool(api_key)
+    return ChatGroq(
+        model=model,
+        api_key=api_key,
+        client=_SyncResource(pool, _chat_completions),
+        async_client=_AsyncResource(pool, _chat_completions),
+        **kwargs,
+    )
@@ -0,0 +1,184 @@
+"""
+Instradamento dei nodi LLM su livelli di modello (small/large) tramite configurazione.
+
+Ogni nodo ha un livello in src/model_routing.json (o nel file indicato da MODEL_ROUTING_PATH).
+Se l'output del modello piccolo non supera la validazione del nodo, la chiamata viene ripetuta
+sul livello di escalation; latenze ed escalation vengono conteggiate per nodo.
+
+I grafi usano il router del processo (get_model_router): la chiave Groq si legge dai secrets di
+Streamlit alla prima chiamata e i modelli di chat si creano solo quando un nodo li usa.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Optional
+
+
+MODEL_ROUTING_PATH = os.environ.get("MODEL_ROUTING_PATH", "src/model_routing.json")
+
+
+def load_routing(path: str = MODEL_ROUTING_PATH) -> dict:
+    with open(path, "r") as f:
+        routing = json.load(f)
+    unknown = {tier for tier in routing["nodes"].values() if tier not in routing["tiers"]}
+    if unknown or routing["escalation_tier"] not in routing["tiers"]:
+        raise ValueError(f"Unknown model tiers in {path}: {sorted(unknown) or routing['escalation_tier']}")
+    return routing
+
+
+class ModelRouter:
+    """
+    Sceglie il modello di ogni nodo in base alla configurazione ed esegue l'escalation se la validazione fallisce.
+
+    Args:
+        api_key (str): Chiave API Groq; se None si legge da st.secrets alla prima chiamata.
+        routing (dict): Configurazione (tiers, nodes, default_tier, escalation_tier); di default da MODEL_ROUTING_PATH.
+        force_tier (str): Usa questo livello per tutti i nodi (per la valutazione offline).
+    """
+
+    def __init__(self, api_key: Optional[str] = None, routing: Optional[dict] = None, force_tier: Optional[str] = None):
+        self._api_key = api_key
+        self.routing = routing or load_routing()
+        self.force_tier = force_tier
+        self._models = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"calls": 0, "escalations": 0, "failures": 0, "latency_s": defaultdict(float)})
+
+    @property
+    def api_key(self) -> str:
+        if self._api_key is None:
+            import streamlit as st
+            self._api_key = st.secrets["GROQ"]["GROQ_API_KEY"]
+        return self._api_key
+
+    def tier(self, node: str) -> str:
+        return self.force_tier or self.routing["nodes"].get(node, self.routing["default_tier"])
+
+    def model_name(self, node: str, tier: Optional[str] = None) -> str:
+        return self.routing["tiers"][tier or self.tier(node)]
+
+    def chat_model(self, node: str, tier: Optional[str] = None):
+        """Il ChatGroq del livello del nodo, condiviso tra i nodi dello stesso livello."""
+        return self._chat(self.model_name(node, tier))
+
+    def _tiers(self, node: str) -> list:
+        tier = self.tier(node)
+        escalation_tier = self.routing["escalation_tier"]
+        return [tier] if tier == escalation_tier or self.force_tier else [tier, escalation_tier]
+
+    def _record(self, node: str, tier: str, elapsed_s: float, escalated: bool = False, failed: bool = False):
+        with self._lock:
+            stats = self._stats[node]
+            stats["calls"] += 1
+            stats["escalations"] += int(escalated)
+            stats["failures"] += int(failed)
+            stats["latency_s"][tier] += elapsed_s
+
+    def _check(self, node: str, tiers: list, attempt: int, content: str, start_time: float,
+               validate: Optional[Callable[[str], Any]]):
+        # (True, output validato) se accettato, (False, None) se si deve passare al livello successivo
+        tier = tiers[attempt]
+        try:
+            parsed = validate(content) if validate else content
+        except Exception as e:
+            last = attempt == len(tiers) - 1
+            self._record(node, tier, time.perf_counter() - start_time, escalated=not last, failed=last)
+            if last:
+                raise
+            print(f"{node}: {tier} output failed validation ({e}), escalating to {tiers[attempt + 1]}")
+            return False, None
+        self._record(node, tier, time.perf_counter() - start_time)
+        return True, parsed
+
+    def route(self, node: str, call: Callable[[str], str], validate: Optional[Callable[[str], Any]] = None):
+        """
+        Esegue call(model_name) sul livello del nodo, con escalation se validate solleva un'eccezione.
+
+        Args:
+            node (str): Il nome del nodo in model_routing.json.
+            call (callable): Riceve il nome del modello e restituisce il testo della risposta.
+            validate (callable): Riceve il testo e restituisce l'output interpretato, o solleva un'eccezione.
+
+        Returns:
+            tuple: (testo della risposta, output validato; il testo stesso se validate è None)
+        """
+        tiers = self._tiers(node)
+        for attempt, tier in enumerate(tiers):
+            start_time = time.perf_counter()
+            content = call(self.model_name(node, tier))
+            accepted, parsed = self._check(node, tiers, attempt, content, start_time, validate)
+            if accepted:
+                return content, parsed
+
+    async def aroute(self, node: str, call: Callable[[str], Awaitable[str]], validate: Optional[Callable[[str], Any]] = None):
+        """Come route, con call asincrona."""
+        tiers = self._tiers(node)
+        for attempt, tier in enumerate(tiers):
+            start_time = time.perf_counter()
+            content = await call(self.model_name(node, tier))
+            accepted, parsed = self._check(node, tiers, attempt, content, start_time, validate)
+            if accepted:
+                return content, parsed
+
+    def invoke(self, node: str, messages, validate: Optional[Callable[[str], Any]] = None,
+               fields: Optional[list] = None, on_field: Optional[Callable[[str, Any], None]] = None):
+        """
+        Chiamata del nodo con escalation. Con fields (gruppi alternativi di campi JSON richiesti) la risposta
+        viene generata in streaming e interrotta appena i campi sono completi (src.json_stream); on_field
+        riceve ogni campo appena disponibile.
+        """
+        def call(model_name):
+            if fields:
+                from src.json_stream import stream_json
+                from src.llm_client import get_sync_client
+                return stream_json(get_sync_client(self.api_key), model_name, messages, fields, on_field,
+                                   temperature=self._chat(model_name).temperature)
+            return self._chat(model_name).invoke(messages).content.strip()
+        return self.route(node, call, validate)
+
+    async def ainvoke(self, node: str, messages, validate: Optional[Callable[[str], Any]] = None,
+                      fields: Optional[list] = None, on_field: Optional[Callable[[str, Any], None]] = None):
+        """Come invoke, con chiamata asincrona."""
+        async def call(model_name):
+            if fields:
+                from src.json_stream import astream_json
+                from src.llm_client import get_async_client
+                return await astream_json(get_async_client(self.api_key), model_name, messages, fields, on_field,
+                                          temperature=self._chat(model_name).temperature)
+            return (await self._chat(model_name).ainvoke(messages)).content.strip()
+        return await self.aroute(node, call, validate)
+
+    def _chat(self, model_name: str):
+        from src.llm_client import chat_model
+        with self._lock:
+            if model_name not in self._models:
+                self._models[model_name] = chat_model(model_name, api_key=self.api_key)
+            return self._models[model_name]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                node: {
+                    "tier": self.tier(node),
+                    "calls": stats["calls"],
+                    "escalations": stats["escalations"],
+                    "failures": stats["failures"],
+                    "latency_s": dict(stats["latency_s"]),
+                }
+                for node, stats in self._stats.items()
+            }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_model_router() -> ModelRouter:
+    """Il router condiviso dai grafi di triage e di emergenza, creato alla prima richiesta."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
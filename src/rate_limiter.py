@@ -0,0 +1,234 @@
+"""
+Limitazione lato client delle chiamate LLM rispetto alla quota dell'account Groq.
+
+Per ogni modello due token bucket (richieste/minuto e token/minuto, da src/rate_limits.json o dal file
+indicato da LLM_RATE_LIMITS_PATH): una richiesta parte solo quando entrambi hanno capacità sufficiente
+per la sua stima di token, altrimenti attende in coda (FIFO). Un 429 sospende il modello per il tempo
+indicato da retry-after, così le altre richieste in coda non vanno a sbattere sullo stesso limite.
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import numpy as np
+
+
+LLM_RATE_LIMITS_PATH = os.environ.get("LLM_RATE_LIMITS_PATH", "src/rate_limits.json")
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "5"))
+# Token di completamento stimati quando la richiesta non indica max_tokens
+LLM_COMPLETION_TOKEN_ESTIMATE = int(os.environ.get("LLM_COMPLETION_TOKEN_ESTIMATE", "512"))
+RETRY_BASE_DELAY_S = 0.5
+RETRY_MAX_DELAY_S = 30.0
+CHARS_PER_TOKEN = 4
+
+_duration_pattern = re.compile(r"(?P<value>\d+(?:\.\d+)?)(?P<unit>ms|h|m|s)")
+_duration_units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def estimate_prompt_tokens(kwargs: dict) -> int:
+    """Stima dei token dei messaggi di una richiesta chat (~4 caratteri per token)."""
+    chars = 0
+    for message in kwargs.get("messages") or []:
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", "")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        chars += len(content or "")
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+def estimate_tokens(kwargs: dict) -> int:
+    """Stima dei token di una richiesta chat: messaggi più il completamento."""
+    if not kwargs.get("messages"):
+        return 0
+    completion = kwargs.get("max_tokens") or kwargs.get("max_completion_tokens") or LLM_COMPLETION_TOKEN_ESTIMATE
+    return estimate_prompt_tokens(kwargs) + completion
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Secondi da "7.66s", "2m59.56s", "950ms" (formato degli header x-ratelimit-reset-*) o da un numero."""
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _duration_pattern.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _duration_units[unit] for amount, unit in parts)
+
+
+def retry_after(headers) -> Optional[float]:
+    """Attesa suggerita dal server: retry-after (secondi o data HTTP), poi i reset dei limiti Groq."""
+    if headers is None:
+        return None
+    milliseconds = parse_duration(headers.get("retry-after-ms"))
+    if milliseconds is not None:
+        return milliseconds / 1000
+    value = headers.get("retry-after")
+    if value:
+        seconds = parse_duration(value)
+        if seconds is not None:
+            return seconds
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    resets = [parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def backoff_delay(attempt: int, suggested: Optional[float] = None) -> float:
+    """Attesa prima del tentativo successivo: quella suggerita con un po' di jitter, o esponenziale con full jitter."""
+    if suggested is not None:
+        return min(RETRY_MAX_DELAY_S, suggested * random.uniform(1.0, 1.1))
+    return random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Bucket con capacità pari al limite al minuto e ricarica continua; il saldo può andare in negativo
+    ma non superare la capacità, neanche con i rimborsi.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        # Una richiesta più grande dell'intera capacità attende solo il bucket pieno
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float, now: float):
+        if not self.unlimited:
+            self._refill(now)
+            # Un rimborso (amount negativo) non porta il saldo oltre la capacità
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ModelLimiter:
+    """Bucket di richieste e token di un modello, con coda FIFO e sospensione dopo un 429."""
+
+    def __init__(self, requests_per_min: float, tokens_per_min: float):
+        self.requests = TokenBucket(requests_per_min)
+        self.tokens = TokenBucket(tokens_per_min)
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+
+class RateLimiter:
+    """
+    Scheduler delle chiamate LLM del processo: coda per modello, stima dei token, metriche di attesa.
+    Va usato dal solo event loop del pool LLM (src.llm_client).
+
+    Args:
+        limits (dict): {"default": {...}, "models": {modello: {"requests_per_min": ..., "tokens_per_min": ...}}}.
+    """
+
+    def __init__(self, limits: dict, window: int = 1000):
+        self.limits = limits
+        self._models = {}
+        self._stats_lock = threading.Lock()
+        self._waits = deque(maxlen=window)
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retries = 0
+
+    def _limiter(self, model: str) -> ModelLimiter:
+        if model not in self._models:
+            limits = self.limits.get("models", {}).get(model, self.limits["default"])
+            self._models[model] = ModelLimiter(limits.get("requests_per_min", 0), limits.get("tokens_per_min", 0))
+        return self._models[model]
+
+    async def acquire(self, model: str, tokens: int) -> float:
+        """Attende che la richiesta rientri nei limiti del modello e la conteggia; restituisce l'attesa in secondi."""
+        limiter = self._limiter(model)
+        start_time = time.monotonic()
+        with self._stats_lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            async with limiter.lock:
+                while True:
+                    now = time.monotonic()
+                    wait = max(limiter.paused_until - now, limiter.requests.wait_time(1, now),
+                               limiter.tokens.wait_time(tokens, now))
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                limiter.requests.consume(1, now)
+                limiter.tokens.consume(tokens, now)
+        finally:
+            with self._stats_lock:
+                self.queue_depth -= 1
+        waited = time.monotonic() - start_time
+        with self._stats_lock:
+            self._waits.append(waited)
+            if waited > 0.01:
+                self.throttled += 1
+        if waited > 1:
+            print(f"LLM call to {model} queued for {waited:.2f}s by the rate limiter")
+        return waited
+
+    def adjust(self, model: str, tokens: int):
+        """Corregge il conteggio dei token con l'uso reale (positivo) o restituisce quelli non usati (negativo)."""
+        limiter = self._limiter(model)
+        if not limiter.tokens.unlimited:
+            limiter.tokens.consume(tokens, time.monotonic())
+
+    def pause(self, model: str, seconds: float):
+        """Sospende il modello dopo un 429: le richieste in coda ripartono solo allo scadere."""
+        limiter = self._limiter(model)
+        limiter.paused_until = max(limiter.paused_until, time.monotonic() + seconds)
+        with self._stats_lock:
+            self.rate_limited += 1
+
+    def record_retry(self):
+        with self._stats_lock:
+            self.retries += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            waits = np.asarray(self._waits) * 1000
+            summary = {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "throttled": self.throttled,
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+            }
+        if len(waits):
+            p50, p95 = np.percentile(waits, [50, 95])
+            summary["wait_ms"] = {"p50": float(p50), "p95": float(p95), "max": float(waits.max())}
+        return summary
+
+
+def load_rate_limits(path: str = LLM_RATE_LIMITS_PATH) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
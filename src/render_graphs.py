@@ -0,0 +1,67 @@
+"""
+Rendering dei grafi di triage e di emergenza in presentation/agents/, separato dall'avvio dell'app.
+
+Il sorgente Mermaid (.mmd) si genera offline; con --png le immagini vengono prodotte tramite l'API
+mermaid.ink (serve la rete) o, con --draw-method pyppeteer, in un browser locale.
+
+Uso:
+    python -m src.render_graphs [--graph triage specialized] [--output-dir presentation/agents]
+                                [--png] [--draw-method api|pyppeteer]
+"""
+import argparse
+import os
+
+
+OUTPUT_DIR = "presentation/agents"
+
+
+def _graph_factories() -> dict:
+    from src.emergency_utils import create_emergency_agent
+    from src.triage_utils import create_triage_agent
+    return {"triage": create_triage_agent, "specialized": create_emergency_agent}
+
+
+def render_graph(name: str, output_dir: str = OUTPUT_DIR, png: bool = False, draw_method: str = "api") -> list:
+    """
+    Scrive il sorgente Mermaid del grafo e, se richiesto, l'immagine PNG.
+
+    Returns:
+        list: I percorsi dei file scritti.
+    """
+    from langchain_core.runnables.graph import MermaidDrawMethod
+    graph = _graph_factories()[name]().get_graph()
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    mermaid_path = os.path.join(output_dir, f"{name}.mmd")
+    with open(mermaid_path, "w") as f:
+        f.write(graph.draw_mermaid())
+    written.append(mermaid_path)
+    if png:
+        method = MermaidDrawMethod.PYPPETEER if draw_method == "pyppeteer" else MermaidDrawMethod.API
+        png_path = os.path.join(output_dir, f"{name}.png")
+        with open(png_path, "wb") as f:
+            f.write(graph.draw_mermaid_png(draw_method=method))
+        written.append(png_path)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the triage and emergency agent graphs.")
+    parser.add_argument("--graph", nargs="+", choices=["triage", "specialized"], default=["triage", "specialized"])
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--png", action="store_true", help="Also render PNG images (the api method needs network access)")
+    parser.add_argument("--draw-method", choices=["api", "pyppeteer"], default="api")
+    args = parser.parse_args()
+
+    for name in args.graph:
+        try:
+            written = render_graph(name, args.output_dir, args.png, args.draw_method)
+        except ValueError as e:
+            # mermaid.ink non raggiungibile
+            raise SystemExit(f"Graph {name} not rendered: {e}")
+        for path in written:
+            print(f"Graph {name} written to {path}")
+
+
+if __name__ == "__main__":
+    main()
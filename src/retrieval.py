@@ -0,0 +1,120 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from src.cache import LRUTTLCache, normalize_query
+
+
+RETRIEVAL_DEADLINE_S = 1.5
+RRF_C = 60
+QUERY_CACHE_SIZE = 512
+QUERY_CACHE_TTL_S = 6 * 3600
+
+# Pool condiviso da tutti i retriever ibridi del processo: BM25 e FAISS girano in parallelo
+_retrieval_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+
+# Cache dei risultati condivisa nel processo, chiave: (corpus, versione bundle, k, query normalizzata)
+query_cache = LRUTTLCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL_S)
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Document]], weights: List[float], c: int = RRF_C) -> List[Document]:
+    """
+    Fonde più liste ordinate con la Reciprocal Rank Fusion pesata, calcolata in NumPy.
+    I documenti duplicati (stesso page_content) vengono accorpati; a parità di punteggio
+    vale l'ordine di prima apparizione, come nell'EnsembleRetriever di LangChain.
+
+    Args:
+        ranked_lists (list): Una lista di documenti ordinata per ciascun retriever.
+        weights (list): Peso di ciascun retriever.
+        c (int): Costante di smorzamento della RRF.
+
+    Returns:
+        list: Documenti ordinati per punteggio fuso decrescente.
+    """
+    doc_index = {}
+    unique_docs = []
+    doc_ids, contributions = [], []
+    for docs, weight in zip(ranked_lists, weights):
+        if not docs:
+            continue
+        ids = []
+        for doc in docs:
+            key = doc.page_content
+            if key not in doc_index:
+                doc_index[key] = len(unique_docs)
+                unique_docs.append(doc)
+            ids.append(doc_index[key])
+        doc_ids.append(np.asarray(ids, dtype=np.int64))
+        contributions.append(weight / (np.arange(1, len(docs) + 1, dtype=np.float64) + c))
+
+    if not unique_docs:
+        return []
+    scores = np.zeros(len(unique_docs), dtype=np.float64)
+    np.add.at(scores, np.concatenate(doc_ids), np.concatenate(contributions))
+    order = np.argsort(-scores, kind="stable")
+    return [unique_docs[i] for i in order]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Interroga in parallelo i retriever (BM25, FAISS) e fonde i risultati con RRF.
+    Allo scadere della deadline restituisce la fusione delle sole liste già disponibili.
+    Se corpus e bundle_version sono impostati, i risultati completi passano per la query_cache.
+    """
+
+    retrievers: List[Any]
+    weights: List[float]
+    c: int = RRF_C
+    deadline_s: float = RETRIEVAL_DEADLINE_S
+    k: Optional[int] = None
+    corpus: Optional[str] = None
+    bundle_version: Optional[str] = None
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def model_post_init(self, __context: Any):
+        if self.corpus and self.bundle_version:
+            # Un nuovo bundle invalida tutte le voci del corpus costruite su versioni precedenti
+            dropped = query_cache.invalidate(lambda key: key[0] == self.corpus and key[1] != self.bundle_version)
+            if dropped:
+                print(f"Dropped {dropped} cached {self.corpus} queries from older index bundles")
+
+    def _cache_key(self, query: str):
+        return (self.corpus, self.bundle_version, self.k, normalize_query(query))
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        use_cache = bool(self.corpus and self.bundle_version)
+        if use_cache:
+            cached = query_cache.get(self._cache_key(query))
+            if cached is not None:
+                return list(cached)
+
+        start_time = time.time()
+        futures = [_retrieval_executor.submit(retriever.invoke, query) for retriever in self.retrievers]
+        done, not_done = wait(futures, timeout=self.deadline_s)
+
+        ranked_lists = []
+        for future in futures:
+            if future in done and future.exception() is None:
+                ranked_lists.append(future.result())
+            else:
+                ranked_lists.append([])
+                if future in done:
+                    print(f"Retriever failed: {future.exception()}")
+        if not_done:
+            # I thread non si possono interrompere: i risultati tardivi vengono semplicemente scartati
+            print(f"Retrieval deadline of {self.deadline_s}s hit, {len(not_done)} retriever(s) skipped")
+
+        fused = reciprocal_rank_fusion(ranked_lists, self.weights, self.c)
+        fused = fused[:self.k] if self.k else fused
+        print(f"Hybrid retrieval took {time.time() - start_time:.2f} seconds")
+        # Si mettono in cache solo i risultati completi, non quelli troncati dalla deadline
+        if use_cache and not not_done and all(future.exception() is None for future in futures):
+            query_cache.put(self._cache_key(query), tuple(fused))
+        return fused
@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+
+from src.index_bundle import DEFAULT_EMBEDDING_MODEL
+
+
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.environ.get("SEMANTIC_CACHE_EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL)
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_SIZE = 1024
+SEMANTIC_CACHE_TTL_S = 24 * 3600
+
+# Fasce di severità: una risposta si riusa solo per situazioni di gravità comparabile
+SEVERITY_BANDS = {1: "low", 2: "low", 3: "medium", 4: "high", 5: "high"}
+
+
+def severity_band(severity) -> str:
+    try:
+        return SEVERITY_BANDS.get(int(severity), "unknown")
+    except (TypeError, ValueError):
+        return "unknown"
+
+
+class SemanticAnswerCache:
+    """
+    Cache delle risposte finali indicizzata per embedding della query.
+
+    Una voce viene riusata se la similarità coseno con la query supera la soglia e se coincidono
+    fascia di severità, template del prompt, corpus e versione del bundle di indici.
+    Dimensione limitata (evizione LRU), scadenza dopo ttl secondi, contatori per il monitoraggio.
+    """
+
+    def __init__(self, embed_fn: Callable[[str], list], threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 maxsize: int = SEMANTIC_CACHE_SIZE, ttl: float = SEMANTIC_CACHE_TTL_S):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def embed(self, query: str) -> Optional[np.ndarray]:
+        try:
+            vector = np.asarray(self.embed_fn(query), dtype=np.float32)
+        except Exception as e:
+            # Senza embedding si genera la risposta normalmente
+            self.errors += 1
+            print(f"Semantic cache disabled for this query: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _scope(self, severity, template: str, corpus: str, bundle_version: str) -> tuple:
+        return severity_band(severity), template, corpus, bundle_version
+
+    def lookup(self, vector: Optional[np.ndarray], severity, template: str, corpus: str,
+               bundle_version: str) -> Optional[str]:
+        """
+        Returns:
+            str: La risposta della voce più simile sopra soglia, o None.
+        """
+        if vector is None:
+            return None
+        scope = self._scope(severity, template, corpus, bundle_version)
+        now = time.monotonic()
+        with self._lock:
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if entry["expires_at"] <= now]:
+                del self._entries[entry_id]
+            candidates = [(entry_id, entry) for entry_id, entry in self._entries.items() if entry["scope"] == scope]
+            if candidates:
+                similarities = np.stack([entry["vector"] for _, entry in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    print(f"Semantic cache hit (similarity {similarities[best]:.3f})")
+                    return entry["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, vector: Optional[np.ndarray], answer: str, severity, template: str, corpus: str,
+              bundle_version: str):
+        if vector is None or not answer:
+            return
+        scope = self._scope(severity, template, corpus, bundle_version)
+        with self._lock:
+            # Un nuovo bundle dello stesso corpus rende obsolete le risposte costruite sul precedente
+            self._drop_stale(corpus, bundle_version)
+            self._entries[self._next_id] = {
+                "vector": vector, "answer": answer, "scope": scope, "expires_at": time.monotonic() + self.ttl,
+            }
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _drop_stale(self, corpus: str, bundle_version: str) -> int:
+        stale = [entry_id for entry_id, entry in self._entries.items()
+                 if entry["scope"][2] == corpus and entry["scope"][3] != bundle_version]
+        for entry_id in stale:
+            del self._entries[entry_id]
+        return len(stale)
+
+    def invalidate_bundle(self, corpus: str, bundle_version: str) -> int:
+        """Rimuove le voci del corpus costruite su versioni del bundle diverse da quella indicata."""
+        with self._lock:
+            return self._drop_stale(corpus, bundle_version)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> SemanticAnswerCache:
+    """La cache del processo; il modello di embedding viene istanziato solo alla prima query."""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            from src.embeddings import get_embeddings
+            embeddings = get_embeddings(SEMANTIC_CACHE_EMBEDDING_MODEL)
+            _answer_cache = SemanticAnswerCache(embeddings.embed_query)
+        return _answer_cache
+
+
+def retriever_scope(retriever) -> tuple:
+    """(corpus, versione bundle) di un HybridRetriever o di uno ShardRetriever del motore docstore."""
+    engine = getattr(retriever, "engine", None)
+    if engine is not None:
+        return getattr(retriever, "shard", None), engine.bundle_version
+    return getattr(retriever, "corpus", None), getattr(retriever, "bundle_version", None)
@@ -0,0 +1,134 @@
+"""
+Esecuzione speculativa del ramo di emergenza mentre il triage sta ancora decidendo.
+
+La ricerca dell'ospedale dipende solo dalla posizione e parte all'inizio del turno; analisi della situazione
+(keyword, specialità, segnali d'allarme), embedding per la cache semantica e recupero dei documenti partono appena il triage ha prodotto il
+riassunto (che diventerà full_query), mentre il modello sta ancora scrivendo valutazione e punteggio.
+Se il triage fa una domanda il lavoro legato al riassunto viene annullato (l'ospedale resta per il turno
+successivo); se assegna una severità i nodi del grafo di emergenza adottano i risultati già pronti o in corso.
+
+Il lavoro gira su un event loop dedicato in background, così sopravvive tra l'esecuzione del triage e
+quella del grafo di emergenza (e tra i rerun di Streamlit).
+"""
+import asyncio
+import os
+import threading
+from typing import Any, Optional
+
+from src.tracing import tracer
+
+
+SPECULATIVE_PREFETCH = os.environ.get("SPECULATIVE_PREFETCH", "1") == "1"
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="emergency-prefetch", daemon=True).start()
+        return _loop
+
+
+class EmergencyPrefetch:
+    """
+    Risultati anticipati dei nodi del grafo di emergenza, ognuno legato alla chiave con cui è stato calcolato
+    (posizione per l'ospedale, full_query per il resto): un nodo li adotta solo se la chiave coincide.
+
+    Args:
+        user_location (tuple): Latitudine e longitudine dell'utente.
+        google_maps_api_key (str): Chiave per la ricerca dell'ospedale.
+        retriever: Il retriever su cui anticipare il recupero (quello delle emergenze).
+    """
+
+    def __init__(self, user_location, google_maps_api_key: str, retriever=None):
+        self.user_location = user_location
+        self.google_maps_api_key = google_maps_api_key
+        self.retriever = retriever
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "adopted": 0, "missed": 0, "cancelled": 0}
+
+    def _submit(self, name: str, key, coro):
+        async def traced():
+            with tracer.span(name, "prefetch"):
+                return await coro
+        future = asyncio.run_coroutine_threadsafe(traced(), _background_loop())
+        with self._lock:
+            self._tasks[name] = (key, future)
+            self.stats["started"] += 1
+
+    def start_hospital(self):
+        """Ricerca dell'ospedale, se non è già stata avviata per la stessa posizione."""
+        from src.emergency_utils import get_google_maps_url
+        key = tuple(self.user_location)
+        if None in key:
+            return
+        with self._lock:
+            entry = self._tasks.get("hospital")
+            if entry is not None and entry[0] == key:
+                return
+        state = {"user_location": self.user_location, "google_maps_api_key": self.google_maps_api_key}
+        self._submit("hospital", key, asyncio.to_thread(get_google_maps_url, state))
+
+    def start(self, full_query: str):
+        """Avvia il lavoro che dipende dal riassunto del triage; annulla quello di un riassunto precedente."""
+        from src.emergency_utils import analyze_query
+        from src.semantic_cache import get_answer_cache
+        full_query = full_query.strip()
+        self.park()
+        print(f"Speculative prefetch started for: {full_query}")
+        self._submit("analysis", full_query, analyze_query({"full_query": full_query}))
+        self._submit("query_vector", full_query, asyncio.to_thread(get_answer_cache().embed, full_query))
+        if self.retriever is not None:
+            self._submit("retrieved_docs", (full_query, id(self.retriever)), self.retriever.ainvoke(full_query))
+
+    def on_triage_field(self, name: str, value: Any):
+        """Callback per i campi della risposta del triage: il riassunto avvia la speculazione."""
+        if name == "Summary" and isinstance(value, str) and value.strip():
+            self.start(value)
+
+    def park(self):
+        """Il triage ha fatto una domanda: si annulla il lavoro legato al riassunto, l'ospedale resta valido."""
+        with self._lock:
+            for name in [name for name in self._tasks if name != "hospital"]:
+                _, future = self._tasks.pop(name)
+                if future.cancel():
+                    self.stats["cancelled"] += 1
+
+    def _take(self, name: str, key) -> Optional[Any]:
+        with self._lock:
+            entry = self._tasks.get(name)
+            if entry is None or entry[0] != key:
+                self.stats["missed"] += 1
+                return None
+            # I risultati legati alla query si usano una volta sola; l'ospedale resta per i turni successivi
+            if name != "hospital":
+                del self._tasks[name]
+            self.stats["adopted"] += 1
+            return entry[1]
+
+    async def get(self, name: str, key) -> Optional[Any]:
+        """Il risultato anticipato per la chiave, atteso se ancora in corso; None se assente, annullato o fallito."""
+        future = self._take(name, key)
+        if future is None or future.cancelled():
+            return None
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception as e:
+            print(f"Speculative {name} failed, recomputing: {e}")
+            return None
+
+    def result(self, name: str, key) -> Optional[Any]:
+        """Come get, per i nodi sincroni."""
+        future = self._take(name, key)
+        if future is None or future.cancelled():
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Speculative {name} failed, recomputing: {e}")
+            return None
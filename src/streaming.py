@@ -0,0 +1,308 @@
+"""
+Streaming della risposta del grafo di emergenza verso la UI.
+
+I token dei nodi di risposta (answer_from_rag, create_response_from_web_search) arrivano tramite
+`astream(stream_mode=["messages", "updates"])`, vengono tradotti a blocchi di frasi (un paragrafo o
+almeno TRANSLATION_MIN_CHARS caratteri) in parallelo alla generazione e passati alla UI tramite callback; ospedale e video vengono notificati appena i
+rispettivi rami del grafo terminano. I rami accessori hanno scadenze (src.deadlines): la risposta non
+li attende oltre il loro budget e il grafo viene annullato a overall_s.
+"""
+import asyncio
+import re
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from src.deadlines import branch_deadline, get_deadlines
+from src.tracing import tracer
+
+
+ANSWER_NODES = ("answer_from_rag", "create_response_from_web_search")
+# Risposta del prompt quando i documenti non coprono la domanda: in quel caso si passa alla ricerca web
+NO_INFO_ANSWER = "no info available"
+TRANSLATION_POLL_S = 0.05
+# Lunghezza minima di un blocco da tradurre: ogni blocco è una chiamata al modello di traduzione
+TRANSLATION_MIN_CHARS = 400
+
+# Fine di una frase (seguita da spazio) o di una riga Markdown
+_segment_end_pattern = re.compile(r"(?<=[.!?:])[ \t]+|\n+")
+
+
+class SentenceSplitter:
+    """
+    Accumula token e restituisce i segmenti completi (frasi o righe), con i separatori originali.
+
+    Con min_chars le frasi vengono raggruppate: un segmento si chiude a fine paragrafo (riga vuota)
+    o quando raggiunge min_chars caratteri.
+    """
+
+    def __init__(self, min_chars: int = 0):
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> list:
+        self._buffer += text
+        segments = []
+        start = 0
+        for match in _segment_end_pattern.finditer(self._buffer):
+            # Un a capo in fondo al buffer può ancora diventare una riga vuota col prossimo token
+            paragraph_end = "\n\n" in match.group() and match.end() < len(self._buffer)
+            if match.end() - start < self.min_chars and not paragraph_end:
+                continue
+            segments.append(self._buffer[start:match.end()])
+            start = match.end()
+        self._buffer = self._buffer[start:]
+        return segments
+
+    def flush(self) -> list:
+        rest, self._buffer = self._buffer, ""
+        return [rest] if rest else []
+
+
+class IncrementalTranslator:
+    """
+    Traduce i segmenti in ordine ma in parallelo alla generazione: ogni segmento parte appena completo,
+    il testo tradotto viene rilasciato solo quando tutti i segmenti precedenti sono pronti.
+    """
+
+    def __init__(self, translate_fn: Optional[Callable[[str], str]]):
+        self.translate_fn = translate_fn
+        self._pending = deque()
+        self.text = ""
+        # Chiamate al traduttore, per le metriche
+        self.calls = 0
+
+    def _translate_segment(self, segment: str) -> str:
+        content = segment.strip()
+        if not content or self.translate_fn is None:
+            return segment
+        self.calls += 1
+        # Gli spazi e gli a capo attorno al segmento non passano dal traduttore
+        leading = segment[:len(segment) - len(segment.lstrip())]
+        trailing = segment[len(segment.rstrip()):]
+        return leading + self.translate_fn(content) + trailing
+
+    def submit(self, segments: list):
+        for segment in segments:
+            self._pending.append(asyncio.create_task(asyncio.to_thread(self._translate_segment, segment)))
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pending)
+
+    def collect(self) -> bool:
+        """Aggiunge al testo i segmenti tradotti pronti, in ordine; True se il testo è cambiato."""
+        changed = False
+        while self._pending and self._pending[0].done():
+            self.text += self._pending.popleft().result()
+            changed = True
+        return changed
+
+    async def finish(self) -> str:
+        while self._pending:
+            self.text += await self._pending.popleft()
+        return self.text
+
+    def cancel(self):
+        for task in self._pending:
+            task.cancel()
+        self._pending.clear()
+        self.text = ""
+
+
+async def stream_emergency_answer(agent, input: dict, translate_fn: Optional[Callable[[str], str]] = None,
+                                  on_answer: Callable[[str], None] = None,
+                                  on_hospital: Callable[[str, str], None] = None,
+                                  on_video: Callable[[str, str], None] = None,
+                                  on_pending: Callable[[list], None] = None):
+    """
+    Esegue il grafo di emergenza in streaming, con le scadenze dei rami di src.deadlines.
+
+    Quando la risposta è pronta e i rami ancora senza risultato (ospedale, video) hanno superato il proprio
+    budget, on_pending li segnala come in attesa; i loro risultati, se arrivano, vengono comunque passati
+    alla UI fino a overall_s, poi il grafo viene annullato. Senza risposta non c'è limite: è il contenuto essenziale.
+
+    Args:
+        agent: Il grafo compilato da create_emergency_agent.
+        input (dict): Lo stato iniziale del grafo.
+        translate_fn (callable): Traduce un segmento nella lingua dell'utente; None se non serve tradurre.
+        on_answer (callable): Riceve il testo (tradotto) della risposta ogni volta che cresce.
+        on_hospital (callable): Riceve nome dell'ospedale e link Google Maps quando il ramo termina.
+        on_video (callable): Riceve titolo e link del video quando la ricerca YouTube trova un risultato.
+        on_pending (callable): Riceve i rami ("hospital", "youtube") in ritardo rispetto alla risposta.
+
+    Returns:
+        tuple: (risposta tradotta, final_result del grafo, metriche di latenza in secondi e rami in ritardo)
+    """
+    start_time = time.perf_counter()
+    metrics = {"time_to_first_token": None, "time_to_first_instruction": None, "time_to_combined": None,
+               "pending": [], "missing": [], "timeouts": []}
+    # Senza traduzione le frasi passano alla UI una per una
+    min_chars = TRANSLATION_MIN_CHARS if translate_fn else 0
+    splitter = SentenceSplitter(min_chars)
+    translator = IncrementalTranslator(translate_fn)
+    rag_buffer = ""
+    answer_node = None
+    final_result = None
+
+    def publish():
+        if translator.collect() and translator.text.strip():
+            if metrics["time_to_first_instruction"] is None:
+                metrics["time_to_first_instruction"] = time.perf_counter() - start_time
+            if on_answer:
+                on_answer(translator.text)
+
+    # I nodi controllano i budget dei rami rispetto a started_at
+    started_at = time.monotonic()
+    input = {**input, "started_at": started_at}
+    overall_s = get_deadlines()["overall_s"]
+    # Rami accessori attesi oltre alla risposta; l'ospedale si aggiunge se l'analisi segnala un allarme
+    expected = {"youtube"} | ({"hospital"} if (input.get("severity") or 0) > 2 else set())
+    delivered = {}
+
+    def answer_ready() -> bool:
+        # combine_results contiene la risposta definitiva (da documenti o dal web)
+        return bool(final_result and final_result[0] and NO_INFO_ANSWER not in final_result[0].lower())
+
+    def next_timeout() -> Optional[float]:
+        # Con traduzioni in corso ci si risveglia spesso per pubblicarle anche senza nuovi eventi del grafo
+        polling = TRANSLATION_POLL_S if translator.pending else None
+        if not answer_ready():
+            return polling
+        elapsed = time.monotonic() - started_at
+        deadline = overall_s
+        if metrics["time_to_combined"] is None:
+            deadline = min(deadline, max(branch_deadline(branch) for branch in expected - delivered.keys()))
+        return max(0.0, min(deadline - elapsed, polling or deadline))
+
+    def combine_check():
+        waiting = expected - delivered.keys()
+        if metrics["time_to_combined"] is not None or not answer_ready():
+            return
+        elapsed = time.monotonic() - started_at
+        if waiting and elapsed < max(branch_deadline(branch) for branch in waiting):
+            return
+        metrics["time_to_combined"] = time.perf_counter() - start_time
+        metrics["pending"] = sorted(waiting)
+        for branch in metrics["pending"]:
+            tracer.count("branch_pending_total", "Emergency graph branches still running when the answer was ready.", branch=branch)
+        if metrics["pending"] and on_pending:
+            on_pending(metrics["pending"])
+
+    def deliver(branch: str, values: dict):
+        delivered[branch] = values
+        if branch in metrics["pending"]:
+            tracer.count("branch_late_total", "Emergency graph branches delivered after their deadline.", branch=branch)
+
+    events = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for event in agent.astream(input, stream_mode=["messages", "updates"]):
+                await events.put(event)
+        finally:
+            await events.put(None)
+
+    producer = asyncio.create_task(produce())
+    timed_out = False
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(events.get(), next_timeout())
+            except asyncio.TimeoutError:
+                publish()
+                combine_check()
+                if time.monotonic() - started_at >= overall_s:
+                    timed_out = True
+                    break
+                continue
+            if event is None:
+                break
+            mode, payload = event
+            if mode == "messages":
+                chunk, metadata = payload
+                node = metadata.get("langgraph_node")
+                if node not in ANSWER_NODES or not chunk.content:
+                    continue
+                if metrics["time_to_first_token"] is None:
+                    metrics["time_to_first_token"] = time.perf_counter() - start_time
+                if node == "answer_from_rag" and answer_node is None:
+                    # Si trattiene l'inizio della risposta finché non è chiaro che non sia 'NO INFO AVAILABLE'
+                    rag_buffer += chunk.content
+                    head = rag_buffer.strip().strip("'\"").lower()
+                    if NO_INFO_ANSWER.startswith(head[:len(NO_INFO_ANSWER)]):
+                        continue
+                    answer_node, text = node, rag_buffer
+                elif node == "create_response_from_web_search" and answer_node != node:
+                    answer_node, text = node, chunk.content
+                    translator.cancel()
+                    splitter = SentenceSplitter(min_chars)
+                elif node == answer_node:
+                    text = chunk.content
+                else:
+                    continue
+                translator.submit(splitter.feed(text))
+            else:
+                for node, update in payload.items():
+                    update = update or {}
+                    if node == "analyze_query" and update.get("red_flag") and all(input.get("user_location") or [None]):
+                        # Come route_analysis: senza posizione il ramo dell'ospedale non parte
+                        expected.add("hospital")
+                    elif node == "get_google_maps_url":
+                        deliver("hospital", {1: update.get("google_maps_url"), 2: update.get("hospital_name")})
+                        if on_hospital:
+                            on_hospital(update.get("hospital_name"), update.get("google_maps_url"))
+                    elif node == "search_youtube_videos" and "https" in (update.get("search_results") or ""):
+                        deliver("youtube", {3: update["search_results"], 4: update.get("video_title")})
+                        if on_video:
+                            on_video(update.get("video_title"), update["search_results"])
+                    elif node == "combine_results":
+                        final_result = update.get("final_result")
+                        if answer_node is None and answer_ready():
+                            # Risposta senza token (es. dalla cache semantica): si mostra subito, senza attendere gli altri rami
+                            answer_node = node
+                            translator.submit(splitter.feed(final_result[0]))
+            combine_check()
+            publish()
+            # Lascia avanzare le traduzioni in corso tra un evento e l'altro
+            await asyncio.sleep(0)
+    except BaseException:
+        producer.cancel()
+        raise
+    if timed_out:
+        producer.cancel()
+    else:
+        # Eventuali errori del grafo
+        await producer
+
+    if metrics["time_to_combined"] is None:
+        metrics["time_to_combined"] = time.perf_counter() - start_time
+    metrics["missing"] = sorted(expected - delivered.keys())
+    if timed_out:
+        metrics["timeouts"] = metrics["missing"]
+        for branch in metrics["timeouts"]:
+            tracer.count("branch_timeouts_total", "Emergency graph branches cancelled at the overall deadline.", branch=branch)
+        print(f"Emergency graph stopped at the {overall_s}s deadline, cancelled branches: {metrics['timeouts']}")
+    if final_result:
+        # I rami arrivati dopo l'ultimo combine_results (o annullati prima) completano il risultato
+        final_result = list(final_result)
+        for values in delivered.values():
+            for index, value in values.items():
+                if value is not None:
+                    final_result[index] = value
+
+    if answer_node is None and final_result:
+        # Nessun token ricevuto (es. modello senza streaming): si traduce la risposta completa
+        translator.submit(splitter.feed(final_result[0]))
+    translator.submit(splitter.flush())
+    await translator.finish()
+    if on_answer:
+        on_answer(translator.text)
+    if metrics["time_to_first_instruction"] is None:
+        metrics["time_to_first_instruction"] = time.perf_counter() - start_time
+    metrics["total"] = time.perf_counter() - start_time
+    metrics["translation_calls"] = translator.calls
+    print(f"Emergency answer streamed: first token {metrics['time_to_first_token']}, "
+          f"first instruction {metrics['time_to_first_instruction']:.2f}s, combined {metrics['time_to_combined']:.2f}s "
+          f"(pending: {metrics['pending']}), total {metrics['total']:.2f}s")
+    return translator.text, final_result, metrics
@@ -0,0 +1,258 @@
+"""
+Tracing strutturato dei nodi LangGraph e delle chiamate esterne, con istogrammi di latenza in processo.
+
+Ogni nodo dei grafi di triage e di emergenza (traced_node) e ogni chiamata esterna (LLM, HTTP, retrieval)
+produce uno span con nome, tipo, durata, esito ed eventuali retry e token. Gli span vengono aggregati in
+istogrammi per (tipo, nome), esportabili in formato testo Prometheus (prometheus_text / write_prometheus,
+che l'app chiama a ogni turno se TRACE_PROMETHEUS_PATH è impostata), e, se TRACE_JSONL_PATH è impostata,
+scritti uno per riga in un file JSONL locale.
+
+Negli span finiscono solo attributi scelti esplicitamente e passati da redact(): mai lo stato dei grafi,
+chiavi API o oggetti interi.
+"""
+import asyncio
+import functools
+import inspect
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+
+TRACE_JSONL_PATH = os.environ.get("TRACE_JSONL_PATH")
+TRACE_PROMETHEUS_PATH = os.environ.get("TRACE_PROMETHEUS_PATH")
+METRICS_PREFIX = "first_aid"
+# Limiti superiori dei bucket in secondi, come negli istogrammi Prometheus
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+_secret_key_pattern = re.compile(r"api_?key|secret|password|authorization|credential", re.IGNORECASE)
+# Chiavi Groq/OpenAI/Google riconoscibili anche dentro un testo
+_secret_value_pattern = re.compile(r"\b(gsk_[A-Za-z0-9]{8,}|sk-[A-Za-z0-9_-]{8,}|AIza[0-9A-Za-z_-]{20,})")
+MAX_ATTRIBUTE_CHARS = 200
+
+
+def redact(attributes: dict) -> dict:
+    """Attributi serializzabili senza segreti: chiavi sensibili mascherate, oggetti ridotti al nome del tipo."""
+    clean = {}
+    for key, value in attributes.items():
+        if _secret_key_pattern.search(key):
+            clean[key] = "[REDACTED]"
+        elif value is None or isinstance(value, (bool, int, float)):
+            clean[key] = value
+        elif isinstance(value, str):
+            clean[key] = _secret_value_pattern.sub("[REDACTED]", value[:MAX_ATTRIBUTE_CHARS])
+        elif isinstance(value, (list, tuple)) and all(isinstance(item, (str, int, float, bool)) for item in value):
+            clean[key] = [_secret_value_pattern.sub("[REDACTED]", item) if isinstance(item, str) else item
+                          for item in value[:20]]
+        else:
+            clean[key] = type(value).__name__
+    return clean
+
+
+class Span:
+    """Un'operazione misurata; gli attributi si aggiungono con set() mentre è in corso."""
+
+    def __init__(self, name: str, kind: str, attributes: Optional[dict] = None):
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self.duration_s = None
+        self.status = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, status: str = "ok"):
+        self.duration_s = time.perf_counter() - self._start_perf
+        self.status = status
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "kind": self.kind, "start": self.start, "duration_s": self.duration_s,
+                "status": self.status, "attributes": redact(self.attributes)}
+
+
+class Histogram:
+    """Bucket cumulativi per Prometheus più una finestra di durate recenti per i percentili."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window: int = 1000):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Tracer:
+    """Raccoglie gli span del processo e li aggrega; thread-safe (nodi, thread del pool LLM, to_thread)."""
+
+    def __init__(self, jsonl_path: Optional[str] = TRACE_JSONL_PATH):
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._histograms = defaultdict(Histogram)
+        self._errors = defaultdict(int)
+        self._retries = defaultdict(int)
+        self._tokens = defaultdict(int)
+        self._counters = defaultdict(int)
+        self._counter_help = {}
+
+    @contextmanager
+    def span(self, name: str, kind: str, **attributes):
+        """Misura il blocco; un'eccezione chiude lo span con esito "error" e viene rilanciata."""
+        span = Span(name, kind, attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            # Un task annullato (es. ricerca abbandonata, speculazione scartata) non è un errore
+            span.end("cancelled" if isinstance(e, asyncio.CancelledError) else "error")
+            self.record(span)
+            raise
+        span.end()
+        self.record(span)
+
+    def record(self, span: Span):
+        key = (span.kind, span.name)
+        with self._lock:
+            self._histograms[key].observe(span.duration_s)
+            if span.status == "error":
+                self._errors[key] += 1
+            self._retries[key] += int(span.attributes.get("retries") or 0)
+        self.record_tokens(span.attributes.get("model") or span.name, span.attributes.get("prompt_tokens"),
+                           span.attributes.get("completion_tokens"))
+        if self.jsonl_path:
+            line = json.dumps(span.to_dict(), ensure_ascii=False)
+            with self._lock, open(self.jsonl_path, "a") as f:
+                f.write(line + "\n")
+
+    def record_tokens(self, model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+        with self._lock:
+            if prompt_tokens:
+                self._tokens[(model, "prompt")] += prompt_tokens
+            if completion_tokens:
+                self._tokens[(model, "completion")] += completion_tokens
+
+    def count(self, metric: str, help_text: str, **labels):
+        """Incrementa un contatore di eventi (es. rami del grafo scaduti), esportato come {METRICS_PREFIX}_{metric}."""
+        with self._lock:
+            self._counters[(metric, tuple(sorted(labels.items())))] += 1
+            self._counter_help[metric] = help_text
+
+    def snapshot(self) -> dict:
+        """Riepilogo per (tipo, nome): conteggio, errori, retry e percentili delle durate recenti in ms."""
+        with self._lock:
+            spans = {}
+            for (kind, name), histogram in sorted(self._histograms.items()):
+                recent = np.asarray(histogram.recent) * 1000
+                p50, p95 = np.percentile(recent, [50, 95])
+                spans[f"{kind}:{name}"] = {
+                    "count": histogram.count,
+                    "errors": self._errors[(kind, name)],
+                    "retries": self._retries[(kind, name)],
+                    "total_s": histogram.sum,
+                    "p50_ms": float(p50),
+                    "p95_ms": float(p95),
+                }
+            tokens = {f"{model}:{kind}": count for (model, kind), count in sorted(self._tokens.items())}
+            counters = {_counter_name(metric, labels): count for (metric, labels), count in sorted(self._counters.items())}
+        return {"spans": spans, "tokens": tokens, "counters": counters}
+
+    def prometheus_text(self) -> str:
+        """Metriche nel formato di esposizione testuale di Prometheus."""
+        name = f"{METRICS_PREFIX}_span_duration_seconds"
+        lines = [f"# HELP {name} Duration of graph nodes and external calls.", f"# TYPE {name} histogram"]
+        with self._lock:
+            for (kind, span_name), histogram in sorted(self._histograms.items()):
+                labels = f'kind="{kind}",name="{span_name}"'
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    le = "+Inf" if math.isinf(bound) else repr(bound)
+                    lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+            for metric, values, help_text in (
+                ("span_errors_total", self._errors, "Spans that ended with an exception."),
+                ("span_retries_total", self._retries, "Retries performed inside spans."),
+            ):
+                lines += [f"# HELP {METRICS_PREFIX}_{metric} {help_text}", f"# TYPE {METRICS_PREFIX}_{metric} counter"]
+                lines += [f'{METRICS_PREFIX}_{metric}{{kind="{kind}",name="{span_name}"}} {value}'
+                          for (kind, span_name), value in sorted(values.items())]
+            lines += [f"# HELP {METRICS_PREFIX}_llm_tokens_total LLM tokens by model and type.",
+                      f"# TYPE {METRICS_PREFIX}_llm_tokens_total counter"]
+            lines += [f'{METRICS_PREFIX}_llm_tokens_total{{model="{model}",type="{kind}"}} {value}'
+                      for (model, kind), value in sorted(self._tokens.items())]
+            for metric, help_text in sorted(self._counter_help.items()):
+                lines += [f"# HELP {METRICS_PREFIX}_{metric} {help_text}", f"# TYPE {METRICS_PREFIX}_{metric} counter"]
+                lines += [f"{METRICS_PREFIX}_{_counter_name(name, labels)} {value}"
+                          for (name, labels), value in sorted(self._counters.items()) if name == metric]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Scrive le metriche in un file (es. per il textfile collector di node_exporter)."""
+        text = self.prometheus_text()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._errors.clear()
+            self._retries.clear()
+            self._tokens.clear()
+            self._counters.clear()
+            self._counter_help.clear()
+
+
+def _counter_name(metric: str, labels: tuple) -> str:
+    if not labels:
+        return metric
+    return metric + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+tracer = Tracer()
+
+
+def _node_attributes(span: Span, output: Any):
+    # Dell'output si registrano solo i nomi dei campi e i contatori di retry, mai i valori
+    if isinstance(output, dict):
+        span.set(output_keys=sorted(output))
+        retries = [value for key, value in output.items() if key.startswith("retry_count") and isinstance(value, int)]
+        if retries:
+            span.set(retries=max(0, max(retries) - 1))
+
+
+def traced_node(name: str, node: Callable) -> Callable:
+    """Avvolge un nodo (sincrono o asincrono) di un grafo LangGraph in uno span di tipo "node"."""
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def async_wrapper(*args, **kwargs):
+            with tracer.span(name, "node") as span:
+                output = await node(*args, **kwargs)
+                _node_attributes(span, output)
+                return output
+        return async_wrapper
+
+    @functools.wraps(node)
+    def wrapper(*args, **kwargs):
+        with tracer.span(name, "node") as span:
+            output = node(*args, **kwargs)
+            _node_attributes(span, output)
+            return output
+    return wrapper
@@ -0,0 +1,118 @@
+import hashlib
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+import numpy as np
+
+from src.cache import LRUTTLCache
+
+
+TRANSLATION_CACHE_SIZE = 2048
+TRANSLATION_CACHE_TTL_S = 24 * 3600
+# Soglie del riconoscimento: almeno MIN_STOPWORDS parole funzionali e un margine netto sulla seconda lingua
+MIN_STOPWORDS = 2
+MIN_MARGIN = 2.0
+
+LANGUAGE_NAMES = {"en": "English", "it": "Italian", "es": "Spanish", "fr": "French", "de": "German"}
+_LANGUAGE_ALIASES = {
+    "en": "en", "english": "en", "inglese": "en",
+    "it": "it", "italian": "it", "italiano": "it",
+    "es": "es", "spanish": "es", "spagnolo": "es", "español": "es",
+    "fr": "fr", "french": "fr", "francese": "fr", "français": "fr",
+    "de": "de", "german": "de", "tedesco": "de", "deutsch": "de",
+}
+
+# Parole funzionali frequenti e poco ambigue tra le lingue supportate
+_STOPWORDS = {
+    "en": {"the", "and", "is", "are", "was", "of", "to", "in", "it", "my", "he", "she", "his", "her", "with",
+           "what", "should", "do", "does", "have", "has", "not", "can", "i", "you", "this", "that", "on",
+           "for", "from", "how", "if", "or", "be", "been", "at", "they", "him", "who", "after", "while"},
+    "it": {"il", "lo", "la", "gli", "le", "di", "che", "è", "e", "un", "una", "per", "con", "non", "mio",
+           "mia", "cosa", "devo", "fare", "ho", "ha", "sono", "si", "del", "della", "nel", "nella", "al",
+           "alla", "come", "se", "mi", "ma", "ed", "anche", "suo", "sua", "dopo", "mentre", "perché"},
+    "es": {"el", "los", "las", "es", "y", "una", "por", "con", "qué", "hacer", "tengo", "está", "pero",
+           "mi", "su", "del", "como", "cuando", "muy", "para", "debo", "estoy", "después"},
+    "fr": {"le", "les", "des", "est", "et", "une", "pour", "avec", "pas", "que", "je", "il", "elle",
+           "mon", "ma", "dans", "sur", "du", "au", "faire", "quoi", "qui", "après"},
+    "de": {"der", "die", "das", "und", "ist", "ein", "eine", "nicht", "mit", "ich", "sie", "er", "was",
+           "soll", "habe", "hat", "auf", "für", "von", "zu", "den", "dem", "nach"},
+}
+_word_pattern = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+
+def language_code(language: str) -> Optional[str]:
+    """Codice ISO 639-1 di un nome o codice di lingua ("Italian", "italiano", "it"), None se sconosciuto."""
+    return _LANGUAGE_ALIASES.get((language or "").strip().lower())
+
+
+def detect_language(text: str) -> Optional[str]:
+    """
+    Riconoscimento locale e offline della lingua, basato sulle parole funzionali.
+
+    Args:
+        text (str): Il testo da classificare.
+
+    Returns:
+        str: Il nome inglese della lingua (es. "Italian"), o None se il testo è troppo corto o ambiguo.
+    """
+    words = _word_pattern.findall((text or "").lower())
+    if not words:
+        return None
+    scores = {code: sum(word in stopwords for word in words) for code, stopwords in _STOPWORDS.items()}
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, second_score) = ranked[0], ranked[1]
+    if best_score < MIN_STOPWORDS or best_score < MIN_MARGIN * second_score:
+        return None
+    return LANGUAGE_NAMES[best]
+
+
+def same_language(first: str, second: str) -> bool:
+    first_code, second_code = language_code(first), language_code(second)
+    return first_code is not None and first_code == second_code
+
+
+def translation_cache_key(message: str, source_language: Optional[str], target_language: str) -> tuple:
+    text_hash = hashlib.sha256(message.encode("utf-8")).hexdigest()
+    source = language_code(source_language) or "auto"
+    target = language_code(target_language) or target_language.strip().lower()
+    return text_hash, source, target
+
+
+class TranslationStats:
+    """
+    Contatori per percorso di traduzione ("bypass", "cache", "llm"): numero di chiamate e latenze recenti.
+    """
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._counts = defaultdict(int)
+
+    def record(self, path: str, elapsed_s: float):
+        with self._lock:
+            self._counts[path] += 1
+            self._latencies[path].append(elapsed_s)
+
+    def stats(self) -> dict:
+        with self._lock:
+            summary = {}
+            for path, count in self._counts.items():
+                latencies = np.asarray(self._latencies[path]) * 1000
+                p50, p95 = np.percentile(latencies, [50, 95])
+                summary[path] = {"calls": count, "p50_ms": float(p50), "p95_ms": float(p95),
+                                 "max_ms": float(latencies.max())}
+            return summary
+
+
+# Condivisi nel processo: le domande di follow-up predefinite si ripetono tra le sessioni
+translation_cache = LRUTTLCache(maxsize=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL_S)
+translation_stats = TranslationStats()
+
+
+def timed_path(path: str, start_time: float):
+    elapsed = time.perf_counter() - start_time
+    translation_stats.record(path, elapsed)
+    print(f"Translation ({path}) took {elapsed:.2f} seconds")
@@ -1,26 +1,25 @@
-from langchain_groq import ChatGroq
 from langgraph.graph import StateGraph, END
-from typing import TypedDict, List, Annotated
+from typing import Callable, TypedDict, List, Annotated
 from langgraph.graph.message import add_messages
 from langchain_core.messages import HumanMessage, SystemMessage
 import os
-import streamlit as st
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_openai import OpenAIEmbeddings
-from langchain.vectorstores import FAISS
-from langchain.retrievers import BM25Retriever, EnsembleRetriever
-from concurrent.futures import ThreadPoolExecutor
-from langchain.schema import Document
+from langchain_core.documents import Document
 import re
 from jinja2 import Template
 import time
 import json
 #from langgraph.checkpoint.memory import MemorySaver
 #memory = MemorySaver()
-import pickle
+from src.bm25_index import MmapBM25Retriever
+from src.ingestion import stream_pdf_documents
+from src.index_bundle import BUNDLE_ROOT, load_index_bundle
+from src.embeddings import get_embeddings
+from src.retrieval import HybridRetriever
+from src.vector_index import load_faiss_store
+from src.model_router import get_model_router
+from src.tracing import traced_node, tracer
 
-llm_70b = ChatGroq(model="llama-3.3-70b-versatile", api_key=st.secrets["GROQ"]["GROQ_API_KEY"])
-llm_8b = ChatGroq(model="llama-3.1-8b-instant", api_key=st.secrets["GROQ"]["GROQ_API_KEY"])
+model_router = get_model_router()
 
 def process_pages(pages:List[Document]):
     import re
@@ -34,78 +33,35 @@ def process_pages(pages:List[Document]):
 
 def process_pdf_triage(file_path:str):
     print('process_pdf_triage')
-    # Carica le pagine del PDF
-    loader = PyPDFLoader(file_path)
-    pages = loader.load()[11:]
+    # Estrae in streaming solo le pagine dalla 11 in poi; estrazione e pulizia girano su un pool di processi
+    return list(stream_pdf_documents(file_path, start=11, process_fn=process_pages))
 
-    # Dividi le pagine in sottogruppi per ogni core
-    num_cores = os.cpu_count()  # Numero di core disponibili
-    chunk_size = len(pages) // num_cores + (len(pages) % num_cores > 0)
-    chunks = [pages[i:i + chunk_size] for i in range(0, len(pages), chunk_size)]
 
-    # Parallelizza il lavoro con ProcessPoolExecutor
-    with ThreadPoolExecutor() as executor:
-        processed_chunks = list(executor.map(process_pages, chunks))
-
-    # Combina i risultati
-    documents = [page for chunk in processed_chunks for page in chunk]
-    return documents
-
-
-def create_bm25_retriever_triage(pdf_file_path:str, bm25_index_path):
+def create_triage_retriever(bundle_root:str=BUNDLE_ROOT):
     """
-    Crea o carica un retriever BM25.
+    Carica il retriever ibrido (BM25 + FAISS) dal bundle di indici validato tramite manifest.
+    Il bundle si costruisce offline con `python -m src.index_bundle build`: qui non si processano mai PDF.
 
     Args:
-        documents (list): Lista di documenti da indicizzare.
-        bm25_index_path (str): Percorso per salvare o caricare l'indice BM25.
+        bundle_root (str): Cartella radice dei bundle di indici.
 
     Returns:
-        BM25Retriever: Un retriever BM25.
+        HybridRetriever: Il retriever ibrido del corpus triage.
     """
-    # Se esiste un file salvato, carica il retriever
-    if os.path.exists(bm25_index_path):
-        #print("Caricamento retriever BM25 esistente.")
-        with open(bm25_index_path, "rb") as f:
-            bm25_retriever : BM25Retriever = pickle.load(f)
-            bm25_retriever.k = 3
-            documents = []
-    else:
-        #print("Creazione di un nuovo retriever BM25.")
-        # Creazione del retriever BM25
-        documents = process_pdf_triage(pdf_file_path)
-        bm25_retriever = BM25Retriever.from_documents(documents)
-        bm25_retriever.k = 3
-        # Salva il retriever
-        with open(bm25_index_path, "wb") as f:
-            pickle.dump(bm25_retriever, f)
-    
-    return bm25_retriever, documents
-
-
-def create_triage_retriever(pdf_file_path:str, bm25_index_path:str, faiss_path:str):
-    # Step 1: Configura l'indice BM25 per i titoli
-    bm25_retriever, documents = create_bm25_retriever_triage(pdf_file_path, bm25_index_path)
-    # Step 2: Configura FAISS per i contenuti
-    embedding = OpenAIEmbeddings(api_key=st.secrets["OPENAI"]["OPENAI_API_KEY"])
-    if os.path.exists(faiss_path):
-        vectorstore = FAISS.load_local(faiss_path, embeddings=embedding, allow_dangerous_deserialization=True)
-        print('load triage retriever')
-    else:
-        if documents:
-            vectorstore = FAISS.from_documents(documents, embedding=embedding)
-            vectorstore.save_local(faiss_path)
-        else:
-            documents = process_pdf_triage(pdf_file_path)
-            vectorstore = FAISS.from_documents(documents, embedding=embedding)
-            vectorstore.save_local(faiss_path)
+    manifest, bm25_index_path, faiss_path = load_index_bundle("triage", bundle_root)
+    # Step 1: Apre l'indice BM25 tramite mmap
+    bm25_retriever = MmapBM25Retriever.load(bm25_index_path, k=3)
+    # Step 2: Carica FAISS per i contenuti, in memory-map e nella modalità di indice registrata nel manifest
+    # Il modello di embedding delle query è quello usato per costruire il bundle
+    embedding = get_embeddings(manifest["inputs"]["embedding_model"])
+    vectorstore = load_faiss_store(faiss_path, embedding, manifest["inputs"].get("vector_index"))
     similarity_retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 4})
 
-    # Step 3: Configura un MultiRetriever
-    ensemble_retriever = EnsembleRetriever(retrievers=[
+    # Step 3: Configura il retriever ibrido (BM25 e FAISS in parallelo, fusione RRF)
+    ensemble_retriever = HybridRetriever(retrievers=[
         bm25_retriever,
         similarity_retriever
-    ], weights=[0.3, 0.7])
+    ], weights=[0.3, 0.7], corpus="triage", bundle_version=manifest["bundle_version"])
     return ensemble_retriever
 
 
@@ -119,11 +75,16 @@ severity_to_color = {
 
 
 class TriageState(TypedDict):
-    ensemble_retriever_triage : EnsembleRetriever
+    ensemble_retriever_triage : HybridRetriever
     severity : int
     questions : Annotated[list, add_messages]
     messages: Annotated[list, add_messages]
     full_query : str
+    # Riassunto della conversazione aggiornato a ogni turno e ultima domanda posta all'utente
+    summary : str
+    last_question : str
+    # Riceve (campo, valore) della risposta appena disponibili, es. per avviare il lavoro speculativo (opzionale)
+    on_field : Callable
 
 
 def start_emergency_bot(state:TriageState):
@@ -131,10 +92,6 @@ def start_emergency_bot(state:TriageState):
     return state
 
 
-def log_state(node_name, state:TriageState):
-    print(f"Node '{node_name}' State: {state}")
-
-
 def extract_json_from_response(response_text: str) -> dict:
     cleaned_resp = response_text.strip()
     match = re.search(r'\s*(\{.*?\})\s*', cleaned_resp, re.DOTALL)
@@ -146,58 +103,52 @@ def extract_json_from_response(response_text: str) -> dict:
         raise ValueError(f"JSON decoding error: {e}. Response received: {response_text}")
 
 
-def triage_evaluation(state:TriageState):
-    messages = state['messages']
-
-
-    contextualize_q_system_prompt = f"""You are an AI assistant specialized in medical triage. Your task is to analyze the conversation history between the user and the AI, understand the user's current medical concerns, and summarize the key information. Do NOT answer the question, just reformulate it if needed and otherwise return it as is.
+# Campi che chiudono la risposta del triage: la generazione si interrompe appena sono completi
+TRIAGE_FIELDS = [["Summary", "Score"], ["Summary", "Question"]]
 
-    ### Instructions:
-    1. **Triage Context**:
-    - Review the conversation history to understand the user's medical concerns and symptoms.
-
-    2. **Focus on Current Query**:
-    - Pay special attention to the user's latest messages to ensure the summary reflects their current problem or question.
-
-    3. **Be Concise and Relevant**:
-    - Provide a clear and concise summary (1-3 sentences) of the user's current medical concern.
-    - Highlight the symptoms and context provided by the user that are essential for triage.
 
-    ### Input:
-    Conversation History:
-    {messages}
+def parse_triage_response(response_text: str) -> dict:
+    """La risposta JSON del triage; solleva ValueError se manca il riassunto o non c'è né punteggio né domanda."""
+    response = extract_json_from_response(response_text)
+    if not isinstance(response.get('Summary'), str) or not response['Summary'].strip():
+        raise ValueError(f"Missing conversation summary. Response received: {response_text}")
+    if 'Score' in response:
+        if str(response['Score']).strip() not in {"1", "2", "3", "4", "5"}:
+            raise ValueError(f"Invalid severity score. Response received: {response_text}")
+    elif not response.get('Question'):
+        raise ValueError(f"Neither score nor question. Response received: {response_text}")
+    return response
 
-    ### Output:"""
-    full_query = llm_70b.invoke(contextualize_q_system_prompt).content
 
-    print(f"full_query: {full_query}")
-    #ensemble_retriever_triage = state['ensemble_retriever_triage']
-    #retrieved_docs = ensemble_retriever_triage.invoke(full_query)
-    #print(f"len_retrieved_docs: {len(retrieved_docs)}")
-    #retrieved_info = [doc.page_content for doc in retrieved_docs]
-    #full_retrieved_info = " ".join([message for message in retrieved_info[:2]])
-    system_prompt = Template("""
-    You are a highly skilled professional in emergency medicine, specializing in Triage. Your task is to assess the severity of the user's situation by providing a score from 1 to 5, or ask a concise question to obtain further information if necessary.
+TRIAGE_PROMPT = Template("""
+    You are a highly skilled professional in emergency medicine, specializing in Triage. Your task is to keep an up-to-date summary of the user's medical situation and to assess its severity by providing a score from 1 to 5, or ask a concise question to obtain further information if necessary.
 
     ### Instructions:
-    1. **Severity Assessment**:
-        - Analyze the user's situation to determine its severity using the information provided in the documents.
+    1. **Summary Update**:
+        - Fold the user's new message (and the answer it gives to your last question, if any) into the current summary.
+        - Keep every symptom and piece of context that matters for triage, drop everything else.
+        - The summary must be 1-3 sentences, in English. Do NOT answer the question in the summary.
+
+    2. **Severity Assessment**:
+        - Analyze the updated summary to determine the severity of the situation using the information provided in the documents.
         - The score is defined as:
         - `1`: Minimal severity, no immediate danger.
         - `5`: Critical and potentially life-threatening emergency, requires immediate intervention.
 
-    2. **Request for Further Information**:
+    3. **Request for Further Information**:
         - If the available information is not sufficient, ask a direct and specific question to clarify.
 
-    3. **Response Format**:
+    4. **Response Format**:
     - The response must be a JSON with one of the following formats:
      - **If you have enough information**:
        {
+         "Summary": "The updated summary of the user's situation.",
          "Reasoning": "Briefly explain your assessment.",
          "Score": "Score between 1 and 5"
        }
      - **If you need further information**:
        {
+         "Summary": "The updated summary of the user's situation.",
          "Reasoning": "Explain why more information is needed.",
          "Question": "Direct and specific question."
        }
@@ -207,46 +158,72 @@ def triage_evaluation(state:TriageState):
     ### Example Outputs:
     #### Scenario 1:
     You have enough information to assess the severity.
-    Output: {"Reasoning": "Based on the information I have, the cut doesn't seem severe, so the severity of the situation is relatively low.", "Score" : "2"} 
+    Output: {"Summary": "The user cut their finger while cooking; the bleeding is light and stopped after a few minutes of pressure.", "Reasoning": "Based on the information I have, the cut doesn't seem severe, so the severity of the situation is relatively low.", "Score" : "2"} 
 
     #### Scenario 2:
     You need further information.
-    Output: {"Reasoning": "I don't have enough information to determine the severity of the situation. I need to ask another question.", "Question" : "Have you ever had allergic reactions in your life?"} 
+    Output: {"Summary": "The user was stung by a bee on the arm a few minutes ago.", "Reasoning": "I don't have enough information to determine the severity of the situation. I need to ask another question.", "Question" : "Have you ever had allergic reactions in your life?"} 
 
     ### Documents:
     {{full_retrieved_info}}
 
-    ### User's Medical Situation:
-    {{full_query}}
+    ### Current Summary:
+    {{summary}}
+
+    ### Your Last Question:
+    {{last_question}}
+
+    ### User's New Message:
+    {{new_message}}
     
     """)
-    system_prompt = system_prompt.render(full_retrieved_info=None, full_query=full_query)
+
+
+async def triage_evaluation(state:TriageState):
+    # Solo l'ultimo messaggio entra nel prompt: il resto della conversazione è già nel riassunto,
+    # così la dimensione del prompt resta costante per quanto si allunghi il triage
+    new_message = state['messages'][-1].content
+    summary = state.get('summary') or ""
+    last_question = state.get('last_question') or ""
+
+    # Il recupero usa il riassunto precedente più il nuovo messaggio, senza attendere un LLM
+    retrieval_query = f"{summary} {new_message}".strip()
+    ensemble_retriever_triage = state['ensemble_retriever_triage']
+    with tracer.span("triage_retriever", "retrieval"):
+        retrieved_docs = await ensemble_retriever_triage.ainvoke(retrieval_query)
+    print(f"len_retrieved_docs: {len(retrieved_docs)}")
+    retrieved_info = [doc.page_content for doc in retrieved_docs]
+    full_retrieved_info = " ".join([message for message in retrieved_info[:2]])
+
+    system_prompt = TRIAGE_PROMPT.render(full_retrieved_info=full_retrieved_info or None, summary=summary or None,
+                                         last_question=last_question or None, new_message=new_message)
     updated_prompt = [HumanMessage(system_prompt)]
     start_time = time.time()
-    response = llm_70b.invoke(updated_prompt).content
+    # Aggiornamento del riassunto e valutazione nella stessa chiamata strutturata
+    response_text, response = await model_router.ainvoke("triage_evaluation", updated_prompt,
+                                                         validate=parse_triage_response, fields=TRIAGE_FIELDS,
+                                                         on_field=state.get('on_field'))
     end_time = time.time()
     print(f"Time taken for LLM invoke: {end_time - start_time:.2f} seconds\n")
-    print(f"response: {response}")
-    response = extract_json_from_response(response)
+    print(f"response: {response_text}")
+    full_query = response['Summary'].strip()
+    print(f"full_query: {full_query}")
     # Analizza il tipo di risposta
     if 'Score' in response:
-        return {"severity": response['Score'], 'full_query': full_query}  # Restituisce il numero, 'next_node' : 'end'
+        return {"severity": response['Score'], 'full_query': full_query, 'summary': full_query}  # Restituisce il numero, 'next_node' : 'end'
     else:
-        return {"questions": response['Question']}  # , 'next_node' : 'new_question', Restituisce la domanda
+        return {"questions": response['Question'], 'summary': full_query}  # , 'next_node' : 'new_question', Restituisce la domanda
 
 
 def create_triage_agent():
     graph = StateGraph(TriageState)
-    graph.add_node("start_emergency_bot", start_emergency_bot)
+    graph.add_node("start_emergency_bot", traced_node("start_emergency_bot", start_emergency_bot))
     graph.set_entry_point("start_emergency_bot")
-    graph.add_node("triage_evaluation", triage_evaluation)
+    graph.add_node("triage_evaluation", traced_node("triage_evaluation", triage_evaluation))
     graph.add_edge("start_emergency_bot", "triage_evaluation")
     graph.set_finish_point("triage_evaluation")
 
+    # Le immagini del grafo si generano a parte: python -m src.render_graphs
     app = graph.compile() #checkpointer=memory
 
-    img_bytes = app.get_graph().draw_mermaid_png()
-    with open('presentation/agents/triage.png', 'wb') as f:
-        f.write(img_bytes)
-
     return app
\ No newline at end of file
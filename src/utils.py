@@ -1,22 +1,30 @@
 import streamlit as st
-from groq import Groq
 from jinja2 import Environment, FileSystemLoader, Template
-from PIL import Image
 from io import BytesIO
 import base64
 import json
 import os
 import re
-from google.cloud import storage
-from google.auth import credentials
 from datetime import datetime
-from gtts import gTTS
 import requests
+import time
+from typing import TYPE_CHECKING
+
+from src.json_stream import stream_json
+from src.llm_client import get_sync_client
+from src.translation import detect_language, same_language, timed_path, translation_cache, translation_cache_key
+
+# Groq, PIL, gTTS e Google Cloud Storage si importano nelle funzioni che li usano: pesano sull'avvio dell'app
+if TYPE_CHECKING:
+    from google.cloud import storage
+    from groq import Groq
+
+GITHUB_API_TIMEOUT_S = 3
 
 
 def get_latest_commit_hash(github_repo: str):
     try:
-        response = requests.get(f"https://api.github.com/repos/{github_repo}/commits?per_page=1")
+        response = requests.get(f"https://api.github.com/repos/{github_repo}/commits?per_page=1", timeout=GITHUB_API_TIMEOUT_S)
         response.raise_for_status()
         commits = response.json()
         return commits[0]['sha']
@@ -140,6 +148,7 @@ def get_sidebar(language):
 
 
 def resize_image(image_file, new_width):
+    from PIL import Image
     with Image.open(image_file) as img:
         aspect_ratio = img.height / img.width
         new_height = int(new_width * aspect_ratio)
@@ -166,13 +175,40 @@ def load_template(template_path: str) -> Template:
 
 
 def init_LLM(API_KEY=None):
-    client = Groq(
-        api_key= API_KEY,
-    )
+    # Stessa interfaccia di groq.Groq, ma sul pool di connessioni condiviso del processo
+    client = get_sync_client(API_KEY)
     return client
 
 
-def translate(llm: Groq, llm_model_name, temperature: float = 0.0, message: str = "", target_language: str = "") -> str:
+# Specialità ammesse nella classificazione (anche dall'analisi del grafo di emergenza)
+MEDICAL_SPECIALTIES = [
+    "cardiology", "psychiatry", "dermatology", "pulmonology", "gastroenterology", 
+    "neurology", "orthopedics", "endocrinology", "hematology", "oncology", 
+    "ophthalmology", "gynecology", "urology", "rheumatology", "infectious disease", 
+    "anesthesiology", "pediatrics", "general surgery", "plastic surgery", "geriatrics", 
+    "family medicine", "radiology", "nephrology", "trauma surgery", "vascular surgery", 
+    "internal medicine"
+]
+
+# Campi della risposta di traduzione: la generazione si interrompe appena sono completi
+TRANSLATION_FIELDS = [["translated_query", "source_language"]]
+
+
+def translate(llm: "Groq", llm_model_name, temperature: float = 0.0, message: str = "", target_language: str = "") -> str:
+    start_time = time.perf_counter()
+    message = message or ""
+    # Fast path locale: se il testo è già nella lingua di destinazione non serve chiamare l'LLM
+    detected_language = detect_language(message)
+    if detected_language and same_language(detected_language, target_language):
+        timed_path("bypass", start_time)
+        return message, detected_language
+
+    cache_key = translation_cache_key(message, detected_language, target_language)
+    cached = translation_cache.get(cache_key)
+    if cached is not None:
+        timed_path("cache", start_time)
+        return cached
+
     translate_command = f"""
         You are a language model capable of translating text between languages.
         Your task is to detect the source language from the given message and translate it into the target language. 
@@ -193,47 +229,40 @@ def translate(llm: Groq, llm_model_name, temperature: float = 0.0, message: str
         Do not add any additional information in the response.
     """
 
-    response = llm.chat.completions.create(
-        model=llm_model_name,
-        messages=[{"role": "user", "content": translate_command}],
-        temperature=temperature,
-        stop=None
-    )
-
-    response_content = response.choices[0].message.content
+    # La generazione si ferma appena i due campi sono completi
+    response_content = stream_json(llm, llm_model_name, translate_command, TRANSLATION_FIELDS,
+                                   temperature=temperature, stop=None)
 
     try:
+        result = json.loads(response_content)
+        translated_query, source_language = result["translated_query"], result["source_language"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        # Risposta senza un oggetto JSON valido: si recuperano i campi dal testo
         translated_query_match = re.search(r'"translated_query"\s*:\s*"([^"]+)', response_content)
         source_language_match = re.search(r'"source_language"\s*:\s*"([^"]+)', response_content)
-        
-        if translated_query_match:
-            translated_query = translated_query_match.group(1)
-        else:
-            raise ValueError(f"Unable to extract translated query from response: {response_content}")
 
-        if source_language_match:
-            source_language = source_language_match.group(1)
-        else:
-            raise ValueError(f"Unable to extract source language from response: {response_content}")
-
-    except Exception as e:
-        raise ValueError(f"Error extracting data: {e}")
+        if not translated_query_match:
+            raise ValueError(f"Error extracting data: Unable to extract translated query from response: {response_content}")
+        if not source_language_match:
+            raise ValueError(f"Error extracting data: Unable to extract source language from response: {response_content}")
+        translated_query, source_language = translated_query_match.group(1), source_language_match.group(1)
 
+    translation_cache.put(cache_key, (translated_query, source_language))
+    timed_path("llm", start_time)
     return translated_query, source_language
 
 
-def get_medical_class(llm: Groq, llm_model_name, temperature: float = 0.0, chat_history: list = []) -> str:
+def get_medical_class(llm: "Groq", llm_model_name, temperature: float = 0.0, chat_history: list = [], router=None) -> str:
+    """
+    Classifica la specialità medica della conversazione.
+
+    Se è indicato un router (src.model_router.ModelRouter), il modello viene scelto dal livello del nodo
+    "get_medical_class" e la richiesta passa al modello grande quando la risposta non è valida.
+    """
     if not chat_history or len(chat_history) < 1:
         raise ValueError("Chat history is insufficient for classification.")
 
-    medical_specialties = [
-        "cardiology", "psychiatry", "dermatology", "pulmonology", "gastroenterology", 
-        "neurology", "orthopedics", "endocrinology", "hematology", "oncology", 
-        "ophthalmology", "gynecology", "urology", "rheumatology", "infectious disease", 
-        "anesthesiology", "pediatrics", "general surgery", "plastic surgery", "geriatrics", 
-        "family medicine", "radiology", "nephrology", "trauma surgery", "vascular surgery", 
-        "internal medicine"
-    ]
+    medical_specialties = MEDICAL_SPECIALTIES
 
     classify_command = f"""
         You are a medical expert capable of classifying medical issues based on conversations. 
@@ -255,24 +284,25 @@ def get_medical_class(llm: Groq, llm_model_name, temperature: float = 0.0, chat_
         Please return only the JSON object, nothing else. The response must be **always** in **English**.
     """
 
-    response = llm.chat.completions.create(
-        model=llm_model_name,
-        messages=[{"role": "user", "content": classify_command}],
-        temperature=temperature,
-        stop=None
-    )
-
-    response_content = response.choices[0].message.content.strip()
+    def classify(model_name):
+        return stream_json(llm, model_name, classify_command, [["medical_class"]], temperature=temperature, stop=None)
 
-    try:
-        classification = json.loads(response_content)
-        medical_class = classification.get("medical_class", None)
-        if medical_class == "None" or medical_class not in medical_specialties:
+    def parse_class(response_content):
+        try:
+            medical_class = json.loads(response_content).get("medical_class", None)
+        except (json.JSONDecodeError, AttributeError):
+            raise ValueError(f"Error parsing the response: {response_content}")
+        if medical_class in (None, "None"):
             return None
-    except json.JSONDecodeError:
-        raise ValueError(f"Error parsing the response: {response_content}")
+        if router is not None and medical_class not in medical_specialties:
+            # Con il router una specialità fuori elenco è un output non valido: si ripete sul modello grande
+            raise ValueError(f"Unknown medical class: {medical_class}")
+        return medical_class if medical_class in medical_specialties else None
 
-    return medical_class
+    if router is not None:
+        _, medical_class = router.route("get_medical_class", classify, validate=parse_class)
+        return medical_class
+    return parse_class(classify(llm_model_name))
 
 
 mapping = {
@@ -335,6 +365,7 @@ def save_uploaded_audio(audio_bytes, output_filename):
 
 
 def text_to_speech(text: str, language = 'it', audio_file = "output.mp3"):
+    from gtts import gTTS
     # Converte il testo in audio
     tts = gTTS(text=text, lang=language, slow=False)
     # Salva l'audio in un file
@@ -355,6 +386,7 @@ def initialize_gcs_client(SERVICE_ACCOUNT_KEY):
     # Load the service account JSON
     service_account_info = json.loads(SERVICE_ACCOUNT_KEY)
     
+    from google.cloud import storage
     # Initialize the storage client with the service account credentials
     client = storage.Client.from_service_account_info(service_account_info)
     return client
@@ -368,7 +400,7 @@ def store_session_data(session_id: str, app_version: str, user_location: list, c
                         medical_class: str, severity: int,
                         hospital_details: list, youtube_video_details: list, query: str, response: str,
                         response_time: float, session_filename: str, local_path_name: str = None,
-                        bucket_name: str = None, client: storage.Client = None):
+                        bucket_name: str = None, client: "storage.Client" = None):
     def process_session_data(existing_data, session_found=False):
         """ Helper function to process and update the session data. """
         for session in existing_data:
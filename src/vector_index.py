@@ -0,0 +1,149 @@
+"""
+Modalità dell'indice vettoriale FAISS dei bundle: flat (scansione esatta), HNSW e IVF con
+quantizzazione scalare (SQ8) o a prodotto (PQ), e caricamento in memory-map degli store salvati.
+
+La modalità si sceglie al build (`python -m src.index_bundle build --vector-index hnsw`) e viene
+registrata nel manifest; i parametri di ricerca (efSearch, nprobe) si applicano al caricamento.
+"""
+import math
+import os
+import pickle
+from typing import Optional
+
+import numpy as np
+
+
+VECTOR_INDEX_MODES = ["flat", "hnsw", "hnsw-sq8", "ivf-sq8", "ivf-pq"]
+DEFAULT_VECTOR_INDEX = "flat"
+# Le modalità che conservano i vettori originali: da queste si può ricostruire un indice senza ricalcolare gli embedding
+LOSSLESS_MODES = ["flat", "hnsw"]
+DEFAULT_PARAMS = {
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,
+    "nlist": None,
+    "nprobe": 8,
+    "pq_m": None,
+}
+# FAISS chiede almeno 39 punti di training per centroide
+_MIN_POINTS_PER_CENTROID = 39
+
+
+def vector_index_config(mode: str = DEFAULT_VECTOR_INDEX, **params) -> Optional[dict]:
+    """
+    Configurazione dell'indice vettoriale da salvare negli input del manifest.
+    Per "flat" restituisce None, così i bundle esistenti restano validi e con la stessa versione.
+    """
+    if mode not in VECTOR_INDEX_MODES:
+        raise ValueError(f"Unknown vector index mode {mode!r}, expected one of {VECTOR_INDEX_MODES}")
+    if mode == DEFAULT_VECTOR_INDEX:
+        return None
+    merged = dict(DEFAULT_PARAMS)
+    merged.update({key: value for key, value in params.items() if value is not None})
+    return {"mode": mode, "params": merged}
+
+
+def index_factory_spec(mode: str, n_vectors: int, dim: int, params: dict) -> str:
+    """
+    Stringa per faiss.index_factory; nlist e sottoquantizzatori PQ si adattano alla dimensione del corpus.
+    """
+    if mode == "flat":
+        return "Flat"
+    if mode == "hnsw":
+        return f"HNSW{params['hnsw_m']}"
+    if mode == "hnsw-sq8":
+        return f"HNSW{params['hnsw_m']}_SQ8"
+
+    nlist = params.get("nlist") or int(4 * math.sqrt(n_vectors))
+    nlist = max(1, min(nlist, n_vectors // _MIN_POINTS_PER_CENTROID))
+    if mode == "ivf-sq8":
+        return f"IVF{nlist},SQ8"
+    # PQ: circa 16 dimensioni per sottoquantizzatore, con un divisore esatto di dim
+    pq_m = params.get("pq_m") or max(m for m in range(1, dim // 16 + 1) if dim % m == 0)
+    # 2^nbits centroidi per sottoquantizzatore: con pochi vettori si riducono i bit
+    nbits = max(1, min(8, int(math.log2(max(2, n_vectors // _MIN_POINTS_PER_CENTROID)))))
+    return f"IVF{nlist},PQ{pq_m}x{nbits}"
+
+
+def apply_search_params(index, params: dict):
+    """Imposta efSearch (HNSW) o nprobe (IVF) su un indice già costruito o caricato."""
+    import faiss
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = params.get("ef_search") or DEFAULT_PARAMS["ef_search"]
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(params.get("nprobe") or DEFAULT_PARAMS["nprobe"], ivf.nlist)
+
+
+def build_faiss_index(vectors: np.ndarray, mode: str, params: Optional[dict] = None):
+    """
+    Costruisce (ed eventualmente addestra) un indice FAISS L2 sui vettori dati, nella modalità richiesta.
+
+    Args:
+        vectors (np.ndarray): Matrice float32 (n, dim), nello stesso ordine degli id del docstore.
+        mode (str): Una delle VECTOR_INDEX_MODES.
+        params (dict): Parametri di build e di ricerca (vedi DEFAULT_PARAMS).
+
+    Returns:
+        faiss.Index: L'indice popolato.
+    """
+    import faiss
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n_vectors, dim = vectors.shape
+    index = faiss.index_factory(dim, index_factory_spec(mode, n_vectors, dim, params), faiss.METRIC_L2)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efConstruction = params["ef_construction"]
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # La ricerca MMR ricostruisce i vettori candidati per id
+        ivf.make_direct_map()
+    apply_search_params(index, params)
+    return index
+
+
+def reconstruct_vectors(index) -> np.ndarray:
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def reindex_store(vectorstore, vector_index: Optional[dict]):
+    """
+    Sostituisce l'indice di uno store FAISS con quello della modalità configurata (None per flat),
+    a partire dai vettori ricostruiti dall'indice attuale: va usata solo su indici LOSSLESS_MODES.
+    """
+    mode, params = (vector_index["mode"], vector_index["params"]) if vector_index else (DEFAULT_VECTOR_INDEX, DEFAULT_PARAMS)
+    vectorstore.index = build_faiss_index(reconstruct_vectors(vectorstore.index), mode, params)
+    return vectorstore
+
+
+def load_faiss_store(faiss_path: str, embedding, vector_index: Optional[dict] = None, mmap: bool = True):
+    """
+    Carica uno store FAISS salvato con save_local, mappando in memoria i codici dell'indice.
+
+    Con mmap i vettori restano nella page cache del sistema operativo, condivisa tra i worker
+    che aprono lo stesso bundle, invece di essere copiati nell'heap di ogni processo.
+
+    Args:
+        faiss_path (str): Cartella con index.faiss e index.pkl.
+        embedding: Modello di embedding delle query.
+        vector_index (dict): Configurazione dal manifest (None per flat), usata per i parametri di ricerca.
+        mmap (bool): Mappa in memoria i codici dell'indice, in sola lettura.
+
+    Returns:
+        FAISS: Il vector store LangChain.
+    """
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    io_flags = 0
+    if mmap and hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        io_flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    index = faiss.read_index(os.path.join(faiss_path, "index.faiss"), io_flags)
+    apply_search_params(index, vector_index["params"] if vector_index else DEFAULT_PARAMS)
+    # index.pkl è scritto dal build del bundle, validato tramite checksum del manifest
+    with open(os.path.join(faiss_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embedding, index, docstore, index_to_docstore_id)
@@ -0,0 +1,80 @@
+import pickle
+
+import numpy as np
+import pytest
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
+
+from src.bm25_index import MmapBM25Index, MmapBM25Retriever, build_bm25_index, convert_bm25_pickle
+
+
+EMERGENCY_BM25 = "data/index_bundle/emergency/bm25"
+QUERIES = [
+    "emorragia arto compressione",
+    "ustione acqua fredda",
+    "arresto cardiaco massaggio cardiaco",
+    "frattura immobilizzare",
+    "termine assente dal corpus",
+]
+
+
+@pytest.fixture(scope="module")
+def documents():
+    # I chunk del manuale di primo soccorso del bundle, con testo e metadati originali
+    index = MmapBM25Index(EMERGENCY_BM25)
+    return [index.get_document(doc_id) for doc_id in range(index.n_docs)]
+
+
+@pytest.fixture(scope="module")
+def pickled_retriever(documents, tmp_path_factory):
+    # Il formato precedente: BM25Retriever di LangChain (rank_bm25) serializzato con pickle
+    pickle_path = tmp_path_factory.mktemp("legacy") / "bm25.pkl"
+    with open(pickle_path, "wb") as f:
+        pickle.dump(BM25Retriever.from_documents(documents, k=4), f)
+    return pickle_path
+
+
+@pytest.fixture(scope="module")
+def legacy(pickled_retriever):
+    with open(pickled_retriever, "rb") as f:
+        return pickle.load(f)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_scores_match_rank_bm25(documents, legacy, tmp_path, query):
+    build_bm25_index(documents, str(tmp_path / "bm25"))
+    index = MmapBM25Index(str(tmp_path / "bm25"))
+    tokens = legacy.preprocess_func(query)
+    # idf e tf sono salvati in float32
+    np.testing.assert_allclose(index.get_scores(tokens), legacy.vectorizer.get_scores(tokens), rtol=1e-5, atol=1e-6)
+
+
+def test_converted_pickle_matches_legacy_retriever(legacy, pickled_retriever, tmp_path):
+    convert_bm25_pickle(str(pickled_retriever), str(tmp_path / "bm25"))
+    retriever = MmapBM25Retriever.load(str(tmp_path / "bm25"), k=4)
+    for query in QUERIES[:-1]:
+        expected = legacy.invoke(query)
+        assert [doc.page_content for doc in retriever.invoke(query)] == [doc.page_content for doc in expected]
+        assert [doc.metadata for doc in retriever.invoke(query)] == [doc.metadata for doc in expected]
+
+
+def test_shipped_bundle_matches_rank_bm25(legacy):
+    index = MmapBM25Index(EMERGENCY_BM25)
+    for query in QUERIES:
+        tokens = legacy.preprocess_func(query)
+        np.testing.assert_allclose(index.get_scores(tokens), legacy.vectorizer.get_scores(tokens), rtol=1e-5, atol=1e-6)
+
+
+def test_small_corpus_with_repeated_terms(tmp_path):
+    documents = [
+        Document(page_content="press press the wound", metadata={"id": 0}),
+        Document(page_content="cool the burn with water", metadata={"id": 1}),
+        Document(page_content="call emergency services", metadata={"id": 2}),
+    ]
+    build_bm25_index(documents, str(tmp_path / "bm25"), k1=1.2, b=0.5)
+    index = MmapBM25Index(str(tmp_path / "bm25"))
+    legacy = BM25Retriever.from_documents(documents, bm25_params={"k1": 1.2, "b": 0.5})
+    for query in ["press the wound", "burn water", "the", "unknown"]:
+        tokens = query.split()
+        np.testing.assert_allclose(index.get_scores(tokens), legacy.vectorizer.get_scores(tokens), rtol=1e-5, atol=1e-6)
+    assert index.get_document(1) == documents[1]
@@ -0,0 +1,19 @@
+from src.emergency_utils import route_analysis
+
+
+def test_red_flag_with_low_severity_searches_hospital():
+    state = {"keywords_youtube": "burn", "red_flag": True, "severity": 2, "user_location": (41.9, 12.5)}
+    assert route_analysis(state) == ["search_youtube_videos", "get_google_maps_url"]
+
+
+def test_red_flag_without_location_skips_hospital():
+    for location in [(None, None), None, ()]:
+        state = {"keywords_youtube": "burn", "red_flag": True, "severity": 2, "user_location": location}
+        assert route_analysis(state) == ["search_youtube_videos"]
+
+
+def test_no_red_flag_or_high_severity_skips_extra_hospital_branch():
+    base = {"keywords_youtube": "", "user_location": (41.9, 12.5)}
+    assert route_analysis({**base, "red_flag": False, "severity": 1}) == ["extract_keywords_youtube"]
+    # Con severità alta l'ospedale parte già da start_emergency_bot
+    assert route_analysis({**base, "red_flag": True, "severity": 4}) == ["extract_keywords_youtube"]
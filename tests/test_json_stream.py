@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from src.json_stream import JSONFieldExtractor
+
+
+TRIAGE_GROUPS = [["Summary", "Score"], ["Summary", "Question"]]
+
+
+def feed_tokens(extractor: JSONFieldExtractor, text: str, size: int = 3) -> bool:
+    """Passa il testo a piccoli pezzi come uno stream; True appena i campi richiesti sono completi."""
+    for start in range(0, len(text), size):
+        if extractor.feed(text[start:start + size]):
+            return True
+    return extractor.finish()
+
+
+@pytest.mark.parametrize("text", [
+    '```json\n{"Summary": "Chest pain", "Score": "4"}\n```',
+    'Here is the assessment:\n{"Summary": "Chest pain", "Score": "4"}\nLet me know if you need more.',
+    'Sure! ```\n{\n  "Summary": "Chest pain",\n  "Score": "4"\n}\n```',
+])
+def test_fenced_or_prose_wrapped_json(text):
+    extractor = JSONFieldExtractor(TRIAGE_GROUPS)
+    assert feed_tokens(extractor, text)
+    assert json.loads(extractor.result()) == {"Summary": "Chest pain", "Score": "4"}
+
+
+def test_alternative_groups_stop_at_first_complete_group():
+    extractor = JSONFieldExtractor(TRIAGE_GROUPS)
+    text = '{"Summary": "Fall from a ladder", "Reasoning": "Need details", "Question": "Is he conscious?", "Extra": "ignored"}'
+    assert feed_tokens(extractor, text)
+    assert extractor.fields == {"Summary": "Fall from a ladder", "Reasoning": "Need details", "Question": "Is he conscious?"}
+    # Il resto dello stream non viene più letto
+    assert extractor._pos < len(text)
+
+
+def test_incomplete_group_is_not_a_result():
+    extractor = JSONFieldExtractor(TRIAGE_GROUPS)
+    assert not feed_tokens(extractor, '{"Summary": "Fall", "Reasoning": "Need details"}')
+    assert extractor.result() is None
+
+
+def test_nested_values_with_brackets_in_strings():
+    extractor = JSONFieldExtractor([["ranking", "confident"]])
+    text = '{"ranking": [2, [1, 3]], "notes": {"why": "title has ] and } in it", "list": ["[x]"]}, "confident": true}'
+    assert feed_tokens(extractor, text)
+    assert extractor.fields == {
+        "ranking": [2, [1, 3]],
+        "notes": {"why": "title has ] and } in it", "list": ["[x]"]},
+        "confident": True,
+    }
+
+
+def test_scalar_closed_by_end_of_stream():
+    extractor = JSONFieldExtractor([["Score"]])
+    assert not extractor.feed('{"Score": 4')
+    assert extractor.finish()
+    assert extractor.fields == {"Score": 4}
+
+
+def test_raw_newline_in_string_keeps_earlier_fields():
+    received = []
+    extractor = JSONFieldExtractor(TRIAGE_GROUPS, on_field=lambda name, value: received.append((name, value)))
+    text = '{"Summary": "Burn on the arm", "Reasoning": "Hot water.\nNo blisters.", "Score": "3"}'
+    assert feed_tokens(extractor, text)
+    assert extractor.fields == {"Summary": "Burn on the arm", "Reasoning": "Hot water.\nNo blisters.", "Score": "3"}
+    # I campi già notificati a on_field restano nel risultato
+    assert received == list(extractor.fields.items())
+    assert json.loads(extractor.result())["Reasoning"] == "Hot water.\nNo blisters."
+
+
+def test_fields_sent_to_on_field_survive_a_reset():
+    received = []
+    extractor = JSONFieldExtractor(TRIAGE_GROUPS, on_field=lambda name, value: received.append((name, value)))
+    # Escape non valido: il valore di Reasoning non si decodifica e il parser riparte
+    text = '{"Summary": "Fall from a ladder", "Reasoning": "bad \\q escape", "Score": "3"}'
+    assert not feed_tokens(extractor, text)
+    assert received == [("Summary", "Fall from a ladder")]
+    assert extractor.fields == {"Summary": "Fall from a ladder"}
+
+
+def test_later_object_completes_fields_kept_across_a_reset():
+    received = []
+    extractor = JSONFieldExtractor(TRIAGE_GROUPS, on_field=lambda name, value: received.append((name, value)))
+    text = 'Draft: {"Summary": "Burn on the arm", "Reasoning": "bad \\q escape"}\nFinal: {"Score": "3"}'
+    assert feed_tokens(extractor, text)
+    assert json.loads(extractor.result()) == {"Summary": "Burn on the arm", "Score": "3"}
+    # Ogni campo notificato compare nel risultato
+    assert {name for name, _ in received} <= extractor.fields.keys()
@@ -0,0 +1,161 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from src.llm_client import _StreamUsage
+from src.rate_limiter import RateLimiter, TokenBucket, estimate_tokens, retry_after
+
+
+MODEL = "llama3-70b-8192"
+
+
+def test_bucket_waits_for_refill():
+    bucket = TokenBucket(6000)  # 100 token/s
+    start = bucket.updated_at
+    assert bucket.wait_time(6000, start) == 0.0
+    bucket.consume(6000, start)
+    assert bucket.wait_time(600, start) == pytest.approx(6.0)
+    # Dopo 3 s ne sono rientrati 300
+    assert bucket.wait_time(600, start + 3) == pytest.approx(3.0)
+    assert bucket.wait_time(300, start + 3) == pytest.approx(0.0)
+
+
+def test_bucket_balance_can_go_negative():
+    bucket = TokenBucket(600)  # 10 token/s
+    start = bucket.updated_at
+    bucket.consume(900, start)
+    assert bucket.tokens == pytest.approx(-300)
+    assert bucket.wait_time(100, start) == pytest.approx(40.0)
+
+
+def test_refund_is_capped_at_capacity():
+    bucket = TokenBucket(600)
+    start = bucket.updated_at
+    bucket.consume(-500, start)
+    assert bucket.tokens == pytest.approx(600)
+    bucket.consume(400, start)
+    bucket.consume(-1000, start)
+    assert bucket.tokens == pytest.approx(600)
+
+
+def test_refund_does_not_allow_a_burst_past_the_quota():
+    limiter = RateLimiter({"default": {"requests_per_min": 0, "tokens_per_min": 6000}, "models": {}})
+    # Stima molto più alta dell'uso reale su un bucket ancora pieno
+    limiter.adjust(MODEL, -3000)
+    bucket = limiter._limiter(MODEL).tokens
+    assert bucket.tokens == pytest.approx(6000)
+    bucket.consume(6000, bucket.updated_at)
+    assert bucket.wait_time(3000, bucket.updated_at) == pytest.approx(30.0)
+
+
+def test_request_larger_than_capacity_waits_for_full_bucket():
+    bucket = TokenBucket(600)
+    start = bucket.updated_at
+    bucket.consume(300, start)
+    assert bucket.wait_time(5000, start) == pytest.approx(30.0)
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(0)
+    bucket.consume(10 ** 6, bucket.updated_at)
+    assert bucket.unlimited
+    assert bucket.wait_time(10 ** 6, bucket.updated_at) == 0.0
+
+
+def test_estimate_tokens_counts_prompt_and_completion():
+    kwargs = {"messages": [{"role": "user", "content": "x" * 400}], "max_tokens": 50}
+    assert estimate_tokens(kwargs) == 150
+    assert estimate_tokens({"messages": []}) == 0
+
+
+def test_retry_after_headers():
+    assert retry_after({"retry-after-ms": "950"}) == pytest.approx(0.95)
+    assert retry_after({"retry-after": "7"}) == 7.0
+    assert retry_after({"x-ratelimit-reset-requests": "2m59.56s", "x-ratelimit-reset-tokens": "7.66s"}) == pytest.approx(179.56)
+    assert retry_after({}) is None
+
+
+def test_malformed_retry_after_ms_falls_back_to_other_headers():
+    assert retry_after({"retry-after-ms": "abc", "retry-after": "2"}) == 2.0
+    assert retry_after({"retry-after-ms": "abc", "x-ratelimit-reset-tokens": "950ms"}) == pytest.approx(0.95)
+    assert retry_after({"retry-after-ms": "abc"}) is None
+
+
+def test_acquire_spaces_requests_per_minute():
+    limiter = RateLimiter({"default": {"requests_per_min": 600, "tokens_per_min": 0}, "models": {}})
+
+    async def burst():
+        # Capacità 600: le prime passano subito, poi una ogni 0.1 s
+        limiter._limiter(MODEL).requests.tokens = 1
+        return [await limiter.acquire(MODEL, 10) for _ in range(3)]
+
+    waits = asyncio.run(burst())
+    assert waits[0] < 0.05
+    assert waits[1] == pytest.approx(0.1, abs=0.05)
+    assert waits[2] == pytest.approx(0.1, abs=0.05)
+    assert limiter.stats()["throttled"] == 2
+
+
+def test_acquire_waits_for_tokens_and_adjust_refunds():
+    limiter = RateLimiter({"default": {"requests_per_min": 0, "tokens_per_min": 6000}, "models": {}})
+
+    async def run():
+        await limiter.acquire(MODEL, 6000)
+        # Stima restituita quasi per intero: la richiesta successiva non attende
+        limiter.adjust(MODEL, -5900)
+        return await limiter.acquire(MODEL, 5000)
+
+    assert asyncio.run(run()) < 0.05
+
+
+def test_model_limits_override_default():
+    limiter = RateLimiter({"default": {"requests_per_min": 0, "tokens_per_min": 0},
+                           "models": {MODEL: {"requests_per_min": 30, "tokens_per_min": 6000}}})
+    assert limiter._limiter(MODEL).tokens.capacity == 6000
+    assert limiter._limiter("llama-3.1-8b-instant").tokens.unlimited
+
+
+def test_pause_delays_queued_requests():
+    limiter = RateLimiter({"default": {"requests_per_min": 0, "tokens_per_min": 0}, "models": {}})
+    limiter.pause(MODEL, 0.2)
+    start = time.monotonic()
+    asyncio.run(limiter.acquire(MODEL, 10))
+    assert time.monotonic() - start >= 0.19
+    assert limiter.stats()["rate_limited"] == 1
+
+
+def _stream_usage(limiter: RateLimiter) -> _StreamUsage:
+    kwargs = {"model": MODEL, "messages": [{"role": "user", "content": "x" * 400}], "stream": True}
+    return _StreamUsage(SimpleNamespace(rate_limiter=limiter), kwargs)
+
+
+def _chunk(content: str = None, usage: dict = None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    x_groq = SimpleNamespace(usage=SimpleNamespace(**usage)) if usage else None
+    return SimpleNamespace(model=MODEL, choices=choices, usage=None, x_groq=x_groq)
+
+
+def test_stream_settles_estimate_with_reported_usage():
+    limiter = RateLimiter({"default": {"requests_per_min": 0, "tokens_per_min": 6000}, "models": {}})
+    usage = _stream_usage(limiter)
+    bucket = limiter._limiter(MODEL).tokens
+    bucket.consume(estimate_tokens({"messages": [{"content": "x" * 400}]}), bucket.updated_at)
+    usage.observe(_chunk("Hello"))
+    usage.observe(_chunk(usage={"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}))
+    usage.close()
+    # Stima di 100 + 512 token, uso reale 120: nel bucket restano 6000 - 120
+    assert bucket.tokens == pytest.approx(6000 - 120, abs=1)
+
+
+def test_early_stopped_stream_refunds_unused_completion():
+    limiter = RateLimiter({"default": {"requests_per_min": 0, "tokens_per_min": 6000}, "models": {}})
+    usage = _stream_usage(limiter)
+    bucket = limiter._limiter(MODEL).tokens
+    bucket.consume(estimate_tokens({"messages": [{"content": "x" * 400}]}), bucket.updated_at)
+    usage.observe(_chunk("x" * 40))
+    usage.close()
+    usage.close()
+    # Prompt (100) più i 10 token generati prima dell'interruzione, una volta sola
+    assert bucket.tokens == pytest.approx(6000 - 110, abs=1)